@@ -16,22 +16,27 @@ fi
 # to find the config file ($ELMFUZZ_RUNDIR/config.yaml)
 export ELMFUZZ_RUNDIR="$1"
 export ELMFUZZ_RUN_NAME=$(basename "$ELMFUZZ_RUNDIR")
-seeds=$(./elmconfig.py get run.seeds)
+# Resolve the whole config once, as ELMCONFIG_* variables
+# (assigned first, so that set -e sees a failing export)
+elmconfig_exports="$(./elmconfig.py export)"
+eval "$elmconfig_exports"
+seeds=$ELMCONFIG_RUN_SEEDS
 if [ -n "${NUM_GENERATIONS:-}" ]; then
     num_gens=${NUM_GENERATIONS}
 else
-    num_gens=$(./elmconfig.py get run.num_generations)
+    num_gens=$ELMCONFIG_RUN_NUM_GENERATIONS
 fi
 # Generations are zero-indexed
 last_gen=$((num_gens - 1))
-genout_dir=$(./elmconfig.py get run.genoutput_dir -s GEN=. -s MODEL=.)
-export ENDPOINTS=$(./elmconfig.py get model.endpoints)
-export TYPE=$(./elmconfig.py get type)
-export PROJECT_NAME=$(./elmconfig.py get project_name)
+genout_dir=${ELMCONFIG_RUN_GENOUTPUT_DIR//\{GEN\}/.}
+genout_dir=${genout_dir//\{MODEL\}/.}
+export ENDPOINTS=$ELMCONFIG_MODEL_ENDPOINTS
+export TYPE=$ELMCONFIG_TYPE
+export PROJECT_NAME=$ELMCONFIG_PROJECT_NAME
 # normalize the path
 genout_dir=$(realpath -m "$genout_dir")
 # Check if we should remove the output dirs if they exist
-should_clean=$(./elmconfig.py get run.clean)
+should_clean=$ELMCONFIG_RUN_CLEAN
 if [ -d "$genout_dir" ]; then
     if [ "$should_clean" == "True" ]; then
         echo "Removing generated outputs in $genout_dir"
@@ -89,6 +94,15 @@ elif [ "$TYPE" == "docker" ]; then
     python prepare_fuzzbench.py -t docker
 fi
 
+# One coverage container serves every generation of the run; it only sees
+# the fuzzdata prefix shared with sibling containers, so outputs are moved
+# into its spool for each job
+if [ "$TYPE" == "fuzzbench" ] || [ "$TYPE" == "oss-fuzz" ] || [ "$TYPE" == "docker" ]; then
+    ELMFUZZ_COVDAEMON=$(python covdaemon.py start --image elmfuzz/"$PROJECT_NAME")
+    export ELMFUZZ_COVDAEMON
+    trap 'python covdaemon.py stop --spool "$ELMFUZZ_COVDAEMON"' EXIT
+fi
+
 if [ $start_gen -eq -1 ]; then
     mkdir -p "$ELMFUZZ_RUNDIR"/initial/{variants,seeds,logs}
     # Stamp dir tells us when a generation is fully finished
@@ -7,14 +7,15 @@ import re
 import plotext as plt
 import os
 
+from covstore import load_coverage
+
 gen_re = re.compile(r'gen(\d+)')
 
 def print_cov(covfiles):
     data = []
     for covfile in covfiles:
         gen = int(gen_re.search(covfile).group(1))
-        with open(covfile, 'r') as f:
-            cov = json.load(f)
+        cov = load_coverage(covfile)
         for model, generators in cov.items():
             for generator, cov in generators.items():
                 data.append((gen, model, generator, len(cov)))
@@ -24,11 +25,10 @@ def cumulative_cov(covfiles):
     cov_by_gen = defaultdict(set)
     for covfile in covfiles:
         gen = int(gen_re.search(covfile).group(1))
-        with open(covfile, 'r') as f:
-            cov = json.load(f)
+        cov = load_coverage(covfile)
         for model, generators in cov.items():
             for generator, cov in generators.items():
-                cov_by_gen[gen].update(cov)
+                cov_by_gen[gen].update(cov.hit_pairs())
     cumulative = set()
     data = []
     for gen, cov in sorted(cov_by_gen.items()):
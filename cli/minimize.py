@@ -102,18 +102,15 @@ def cmin(fuzzers, benchmarks, tmpdir):
                             os.path.join(prcs_dir, "100121.tar.zst"))
     cmin_out_dir = os.path.join(tmpdir, "cmin_out")
     BATCH_CMIN_MR = os.path.join(PROJECT_ROOT, "evaluation", "inputgen", "batchcmin_mr.py")
+    # Every input is traced once by afl-showmap and the corpus is minimized
+    #  over the stored traces, so there are no repeated afl-cmin rounds.
     BATCH_SIZE = 3000
-    # We fix the iterations to 10 because 1) the cmin process typically needs multiple runs
-    #  and 2) the number of the runs is definitely less than 10 in our experiments.
-    
-    
-    START_FROM = 1
-    END_AT = 10
-    click.echo(f"Running first cmin iteration. There will be {END_AT} iterations in total.")
+    ITERATION = 1
+    click.echo(f"Running single-pass cmin.")
     if not os.path.exists(cmin_out_dir):
         os.makedirs(cmin_out_dir, exist_ok=True)
-    cmd_first = [
-        "python", BATCH_CMIN_MR, "--shuffle",
+    cmd = [
+        "python", BATCH_CMIN_MR, "--single-pass",
         "-b", str(BATCH_SIZE),
         "--id", "100121",
         "-i", intermediate_dir,
@@ -121,36 +118,9 @@ def cmin(fuzzers, benchmarks, tmpdir):
         "--more-excludes", ",".join(exclude),
         "--move-instead-of-copy",
         "-1",
-        "-it", "1",
-    ]
-    subprocess.run(cmd_first, check=True)
-
-    for i in range(START_FROM + 1, END_AT):
-        click.echo(f"Running cmin iteration {i}. There will be {END_AT} iterations in total.")
-        cmd_i = [
-            "python", BATCH_CMIN_MR, "--shuffle",
-            "-b", str(BATCH_SIZE),
-            "-i", os.path.join(cmin_out_dir, str(i - 1)),
-            "-o", cmin_out_dir,
-            "--more-excludes", ",".join(exclude),
-            "--move-instead-of-copy",
-            "-it", str(i)
-        ]
-        subprocess.run(cmd_i, check=True)
-
-    click.echo(f"Running last cmin iteration. There will be {END_AT} iterations in total.")
-    cmd_last = [
-        "python", BATCH_CMIN_MR, "--shuffle",
-        "-b", str(BATCH_SIZE),
-        "--id", "100121",
-        "-i", os.path.join(cmin_out_dir, str(END_AT - 1)),
-        "-o", cmin_out_dir,
-        "--more-excludes", ",".join(exclude),
-        "--move-instead-of-copy",
-        "--last-run",
-        "-it", str(END_AT)
+        "-it", str(ITERATION),
     ]
-    subprocess.run(cmd_last, check=True)
+    subprocess.run(cmd, check=True)
     collect = []
     for benchmark in benchmarks:
         for fuzzer_raw in fuzzers:
@@ -163,7 +133,7 @@ def cmin(fuzzers, benchmarks, tmpdir):
             datetag = datetime.now().strftime("%y%m%d")
             output_file = os.path.join(output_dir, f"{datetag}.tar.zst")
             cmd_tar = [
-                'tar', '--zstd', '-cf', output_file, '-C', os.path.join(cmin_out_dir, str(END_AT), "cmin"), f'{benchmark}_{fuzzer}'
+                'tar', '--zstd', '-cf', output_file, '-C', os.path.join(cmin_out_dir, str(ITERATION), "cmin"), f'{benchmark}_{fuzzer}'
             ]
             subprocess.run(cmd_tar, check=True)
             collect.append(output_file)
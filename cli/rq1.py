@@ -187,8 +187,19 @@ def info_tarball_path(fuzzer, benchmark):
 def rq1_seed_cov_cmd_info_tarball(fuzzer, benchmark) -> int:
     info_tarball = info_tarball_path(fuzzer, benchmark)
     inside_dir = inside_tarball_path(fuzzer, benchmark)
-    cov_sum = f"{inside_dir}/sum.cov"
     with tempfile.TemporaryDirectory() as tmpdir:
+        # The elmfuzz driver writes sum.npz; the ISLa and Grammarinator
+        # drivers (and older elmfuzz runs) write sum.cov
+        cov_npz = f"{inside_dir}/sum.npz"
+        cmd = [
+            "tar", "--zstd", "-xf", info_tarball, "-C", tmpdir, cov_npz
+        ]
+        subprocess.run(cmd, stderr=subprocess.DEVNULL)
+        if os.path.exists(os.path.join(tmpdir, cov_npz)):
+            import numpy as np
+            with np.load(os.path.join(tmpdir, cov_npz)) as summary:
+                return len(summary["edges"])
+        cov_sum = f"{inside_dir}/sum.cov"
         cmd = [
             "tar", "--zstd", "-xf", info_tarball, "-C", tmpdir, cov_sum
         ]
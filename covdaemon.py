@@ -0,0 +1,189 @@
+# Long-lived coverage container for the fuzzbench/oss-fuzz/docker targets.
+#
+# `covdaemon.py start` runs covdaemon_inside_docker.py in the target image
+# once per run, with fuzzdata_prefix() bind-mounted at the same path and the
+# spool directory inside it. Only that prefix is shared with sibling
+# containers (see the README), so it is the only thing mounted. getcov_fuzzbench.py
+# then submits each generation as a job instead of starting a container;
+# outputs under the prefix are read in place, others are moved into the
+# spool first. `covdaemon.py stop` shuts the daemon down.
+
+import click
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import uuid
+from typing import Iterable, Iterator
+
+from elmconfig import on_nsf_access
+
+DAEMON_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'covdaemon_inside_docker.py')
+# The daemon touches its heartbeat at least this often (plus a job's poll)
+HEARTBEAT_TIMEOUT = 60.0
+SPOOL_DIRS = ['jobs', 'running', 'results', 'inputs']
+
+def fuzzdata_prefix() -> str:
+    """Host directory whose subdirectories are shared with the containers"""
+    access_info = on_nsf_access()
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    if access_info is not None:
+        prefix = os.path.join(cwd, 'tmp', 'fuzzdata') + '/'
+    elif bool(os.environ.get('REPROUDCE_MODE', 'false')):
+        prefix = '/tmp/host/fuzzdata/'
+    else:
+        prefix = '/tmp/fuzzdata/'
+    if not os.path.exists(prefix):
+        os.makedirs(prefix)
+    return prefix
+
+class CovDaemonClient:
+    def __init__(self, spool: str) -> None:
+        self.spool = spool
+
+    def info(self) -> dict:
+        with open(os.path.join(self.spool, 'daemon.json')) as f:
+            return json.load(f)
+
+    def alive(self) -> bool:
+        try:
+            age = time.time() - os.path.getmtime(os.path.join(self.spool, 'heartbeat'))
+        except FileNotFoundError:
+            return False
+        return age < HEARTBEAT_TIMEOUT
+
+    def visible(self, path: str) -> bool:
+        """Whether path is inside the daemon's mount"""
+        path = os.path.realpath(path)
+        mount = self.info()['mount']
+        return os.path.commonpath([path, mount]) == mount
+
+    def inputs_dir(self) -> str:
+        return os.path.join(self.spool, 'inputs')
+
+    def submit(self, input: str, prog: str, parallel_num: int, real_feedback: bool, afl_timeout: int,
+               prefixed: bool = False) -> str:
+        """Queue the coverage measurement of input (laid out as
+        model/generator/files); input must be visible to the daemon"""
+        job_id = f'{time.time_ns()}-{uuid.uuid4().hex[:8]}'
+        job = {
+            'input': os.path.realpath(input),
+            'prog': prog,
+            'parallel_num': parallel_num,
+            'real_feedback': real_feedback,
+            'afl_timeout': afl_timeout,
+            'prefixed': prefixed,
+        }
+        tmp_path = os.path.join(self.spool, 'jobs', job_id + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(job, f)
+        os.rename(tmp_path, os.path.join(self.spool, 'jobs', job_id + '.json'))
+        return job_id
+
+    def results(self, job_ids: Iterable[str], poll_interval: float = 0.5) -> Iterator[tuple[str, str]]:
+        """(job id, result file) for each job, in the order they finish
+
+        :raises RuntimeError: if a job fails or the daemon stops responding
+        """
+        pending = set(job_ids)
+        while pending:
+            for job_id in list(pending):
+                result = os.path.join(self.spool, 'results', job_id + '.json')
+                failed = os.path.join(self.spool, 'results', job_id + '.failed')
+                if os.path.exists(result):
+                    pending.discard(job_id)
+                    yield job_id, result
+                elif os.path.exists(failed):
+                    with open(failed) as f:
+                        raise RuntimeError(f'Coverage job {job_id} failed: {f.read()}')
+            if pending:
+                if not self.alive():
+                    raise RuntimeError(f'Coverage daemon at {self.spool} is not running')
+                time.sleep(poll_interval)
+
+def default_spool() -> str:
+    return os.path.join(fuzzdata_prefix(), f'covdaemon-{os.environ.get("ELMFUZZ_RUN_NAME", "default")}')
+
+@click.group()
+def main():
+    pass
+
+@main.command()
+@click.option('--image', type=str, required=True)
+@click.option('--spool', type=str, default=None, help='Spool directory (under the fuzzdata prefix)')
+def start(image: str, spool: str | None):
+    """Start the daemon and print its spool directory"""
+    if spool is None:
+        spool = default_spool()
+    spool = os.path.realpath(spool)
+    mount = os.path.realpath(fuzzdata_prefix())
+    if os.path.commonpath([spool, mount]) != mount:
+        raise click.BadParameter(f'{spool} is not under {mount}, the only directory shared with the daemon',
+                                 param_hint='--spool')
+    client = CovDaemonClient(spool)
+    if os.path.exists(os.path.join(spool, 'daemon.json')) and client.alive():
+        print(spool)
+        return
+    shutil.rmtree(spool, ignore_errors=True)
+    for d in SPOOL_DIRS:
+        os.makedirs(os.path.join(spool, d))
+    # The script is run from the spool, since this checkout may not be
+    # visible to the container engine
+    container_script = os.path.join(spool, 'covdaemon_inside_docker.py')
+    shutil.copyfile(DAEMON_SCRIPT, container_script)
+    serve_cmd = ['python3', container_script, '--spool', spool]
+    access_info = on_nsf_access()
+    info = {'image': image, 'mount': mount}
+    log = open(os.path.join(spool, 'daemon.log'), 'w')
+    if access_info is None:
+        name = f'elmcov-{os.path.basename(spool)}-{uuid.uuid4().hex[:8]}'
+        cmd = ['docker', 'run', '-d', '--rm', '--name', name, '-v', f'{mount}:{mount}', image]
+        cmd.extend(serve_cmd)
+        print(' '.join(cmd), file=sys.stderr)
+        subprocess.run(cmd, check=True, stdout=log, stderr=sys.stderr)
+        info['container'] = name
+    else:
+        cmd = ['apptainer', 'exec', '--cleanenv', '--bind', f'{mount}:{mount}:rw',
+               os.path.join(access_info['sif_root'], image)]
+        cmd.extend(serve_cmd)
+        print(' '.join(cmd), file=sys.stderr)
+        proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+        info['pid'] = proc.pid
+    with open(os.path.join(spool, 'daemon.json'), 'w') as f:
+        json.dump(info, f)
+    deadline = time.time() + HEARTBEAT_TIMEOUT
+    while not client.alive():
+        if time.time() > deadline:
+            raise RuntimeError(f'Coverage daemon did not start (see {spool}/daemon.log)')
+        time.sleep(0.5)
+    print(spool)
+
+@main.command()
+@click.option('--spool', type=str, default=None)
+@click.option('--grace', type=float, default=30.0, help='Seconds to let a running job finish')
+def stop(spool: str | None, grace: float):
+    """Stop the daemon and remove its spool directory"""
+    if spool is None:
+        spool = default_spool()
+    if not os.path.exists(os.path.join(spool, 'daemon.json')):
+        return
+    client = CovDaemonClient(spool)
+    info = client.info()
+    open(os.path.join(spool, 'stop'), 'w').close()
+    deadline = time.time() + grace
+    while os.path.exists(os.path.join(spool, 'heartbeat')) and time.time() < deadline:
+        time.sleep(0.5)
+    if 'container' in info:
+        subprocess.run(['docker', 'rm', '-f', info['container']],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    elif 'pid' in info:
+        try:
+            os.killpg(info['pid'], 9)
+        except ProcessLookupError:
+            pass
+    shutil.rmtree(spool, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
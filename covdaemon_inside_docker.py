@@ -0,0 +1,79 @@
+# Coverage daemon, run inside the target image by `covdaemon.py start`.
+#
+# Jobs are JSON files dropped into <spool>/jobs by the host. Each one is
+# claimed by moving it to <spool>/running, measured with the image's
+# elm_getcov_inside_docker.py, and answered with <spool>/results/<id>.json
+# (or <id>.failed). <spool>/heartbeat is touched while the daemon is up, and
+# creating <spool>/stop makes it exit once the current job is done.
+#
+# Only the standard library is used, since this runs on the image's Python.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+def touch(path):
+    with open(path, 'a'):
+        os.utime(path, None)
+
+def run_job(spool, getcov, job_id, job, poll_interval):
+    tmp_out = os.path.join(spool, 'results', job_id + '.tmp')
+    # An unshared host directory shows up as an empty one; don't measure it
+    if not os.path.isdir(job['input']) or not os.listdir(job['input']):
+        with open(os.path.join(spool, 'results', job_id + '.failed'), 'w') as f:
+            f.write(f'{job["input"]} is missing or empty inside the container\n')
+        return
+    cmd = [
+        sys.executable, getcov,
+        '--input', job['input'],
+        '--output', tmp_out,
+        '-j', str(job['parallel_num']),
+        '--prog=' + job['prog'],
+        '--real-feedback', str(job['real_feedback']),
+        '--afl-timeout=' + str(job['afl_timeout']),
+    ]
+    if job.get('prefixed'):
+        cmd.append('--prefixed')
+    print(' '.join(cmd), flush=True)
+    proc = subprocess.Popen(cmd)
+    while proc.poll() is None:
+        touch(os.path.join(spool, 'heartbeat'))
+        time.sleep(poll_interval)
+    if proc.returncode == 0 and os.path.exists(tmp_out):
+        os.rename(tmp_out, os.path.join(spool, 'results', job_id + '.json'))
+    else:
+        with open(os.path.join(spool, 'results', job_id + '.failed'), 'w') as f:
+            f.write(f'{" ".join(cmd)}\nreturn code {proc.returncode}\n')
+
+def serve(spool, getcov, poll_interval):
+    jobs_dir = os.path.join(spool, 'jobs')
+    running_dir = os.path.join(spool, 'running')
+    while not os.path.exists(os.path.join(spool, 'stop')):
+        touch(os.path.join(spool, 'heartbeat'))
+        pending = sorted(f for f in os.listdir(jobs_dir) if f.endswith('.json'))
+        if not pending:
+            time.sleep(poll_interval)
+            continue
+        job_file = pending[0]
+        job_id = job_file[:-len('.json')]
+        running = os.path.join(running_dir, job_file)
+        os.rename(os.path.join(jobs_dir, job_file), running)
+        with open(running) as f:
+            job = json.load(f)
+        run_job(spool, getcov, job_id, job, poll_interval)
+        os.remove(running)
+    try:
+        os.remove(os.path.join(spool, 'heartbeat'))
+    except FileNotFoundError:
+        pass
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--spool', required=True)
+    parser.add_argument('--getcov', default='/src/elm_getcov_inside_docker.py')
+    parser.add_argument('--poll-interval', type=float, default=0.5)
+    args = parser.parse_args()
+    serve(args.spool, args.getcov, args.poll_interval)
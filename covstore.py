@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+# Compact coverage store.
+#
+# Coverage used to be passed around as JSON of the form
+#   {model: {generator: ["edge:hitcount", ...]}}
+# and every consumer had to split the strings back apart. The binary format
+# here stores each variant's edges as a sorted little-endian uint32 array of
+# AFL map indices, followed by a parallel uint8 array of hit-count buckets:
+#
+#   magic (8 bytes) | index length (u32) | index (JSON) | pad to 4
+#   entry 0: edges (u32 * n) | buckets (u8 * n) | pad to 4
+#   entry 1: ...
+#
+# The index lists [model, generator, offset, n] for every entry. Files are
+# memory-mapped on load, so only the entries that are actually used get read.
+# load_coverage() also accepts the old JSON files, and save_coverage() picks
+# the format from the file extension (.json keeps writing JSON).
+
+import argparse
+import bisect
+import json
+import mmap
+import struct
+import sys
+from array import array
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+MAGIC = b'ELMCOV\x01\x00'
+HEADER = struct.Struct('<8sI')
+
+def parse_showmap_line(line: str) -> Tuple[int, int]:
+    """Parse one line of afl-showmap output ("edge:hitcount")."""
+    edge, hits = line.split(':')
+    return int(edge), int(hits)
+
+def edge_id(edge: Union[str, int]) -> int:
+    """Edge ID from an int or an "000123" / "000123:1" string (as found in
+    elites.json and baseline files written before the binary format)."""
+    if isinstance(edge, int):
+        return edge
+    return int(edge.split(':')[0])
+
+def to_bits(edges: Iterable[int]) -> int:
+    """Turn edge IDs into a bitset (bit i set iff edge i is covered)."""
+    if not isinstance(edges, (array, memoryview, np.ndarray)):
+        edges = list(edges)
+    edges = np.asarray(edges, dtype=np.int64)
+    if not edges.size:
+        return 0
+    bitmap = np.zeros(int(edges.max()) + 1, dtype=bool)
+    bitmap[edges] = True
+    return int.from_bytes(np.packbits(bitmap, bitorder='little').tobytes(), 'little')
+
+def bits_to_bytes(bits: int, nbytes: Optional[int] = None) -> np.ndarray:
+    """Bitset as a little-endian uint8 array (zero-padded to nbytes)."""
+    if nbytes is None:
+        nbytes = (bits.bit_length() + 7) // 8
+    return np.frombuffer(bits.to_bytes(nbytes, 'little'), dtype=np.uint8)
+
+def from_bits(bits: int) -> List[int]:
+    """Sorted edge IDs in a bitset."""
+    return np.flatnonzero(np.unpackbits(bits_to_bytes(bits), bitorder='little')).tolist()
+
+def popcount(bits: int) -> int:
+    return bits.bit_count()
+
+class EdgeSet:
+    """Covered edges of one variant: sorted edge IDs plus hit-count buckets.
+    Set operations go through a bitset that is built on first use."""
+    __slots__ = ('edges', 'buckets', '_bits')
+
+    def __init__(self, edges: Sequence[int], buckets: Optional[Sequence[int]] = None, bits: Optional[int] = None):
+        # edges must be sorted and unique
+        self.edges = edges
+        self.buckets = buckets
+        self._bits = bits
+
+    @classmethod
+    def from_pairs(cls, pairs: Iterable[Tuple[int, int]]) -> 'EdgeSet':
+        hits = {}
+        for edge, count in pairs:
+            hits[edge] = max(count, hits.get(edge, 0))
+        edges = sorted(hits)
+        return cls(array('I', edges), array('B', (min(hits[e], 255) for e in edges)))
+
+    @classmethod
+    def from_showmap(cls, lines: Iterable[str]) -> 'EdgeSet':
+        return cls.from_pairs(parse_showmap_line(l) for l in lines if l.strip())
+
+    @classmethod
+    def from_bits(cls, bits: int) -> 'EdgeSet':
+        return cls(array('I', from_bits(bits)), None, bits)
+
+    @property
+    def bits(self) -> int:
+        if self._bits is None:
+            self._bits = to_bits(self.edges)
+        return self._bits
+
+    def __len__(self) -> int:
+        return len(self.edges)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.edges)
+
+    def __contains__(self, edge: int) -> bool:
+        i = bisect.bisect_left(self.edges, edge)
+        return i < len(self.edges) and self.edges[i] == edge
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, EdgeSet):
+            return NotImplemented
+        return self.bits == other.bits
+
+    def __hash__(self) -> int:
+        return hash(self.bits)
+
+    def __le__(self, other: 'EdgeSet') -> bool:
+        return self.bits & ~other.bits == 0
+
+    def __lt__(self, other: 'EdgeSet') -> bool:
+        return len(self) < len(other) and self <= other
+
+    def __ge__(self, other: 'EdgeSet') -> bool:
+        return other <= self
+
+    def __gt__(self, other: 'EdgeSet') -> bool:
+        return other < self
+
+    def issubset(self, other: 'EdgeSet') -> bool:
+        return self <= other
+
+    def __or__(self, other: 'EdgeSet') -> 'EdgeSet':
+        return EdgeSet.from_bits(self.bits | other.bits)
+
+    def __and__(self, other: 'EdgeSet') -> 'EdgeSet':
+        return EdgeSet.from_bits(self.bits & other.bits)
+
+    def __sub__(self, other: 'EdgeSet') -> 'EdgeSet':
+        return EdgeSet.from_bits(self.bits & ~other.bits)
+
+    def hit_pairs(self) -> Iterator[Tuple[int, int]]:
+        if self.buckets is None:
+            return ((e, 1) for e in self.edges)
+        return zip(self.edges, self.buckets)
+
+    def to_showmap(self) -> List[str]:
+        """Back to afl-showmap's "edge:hitcount" strings."""
+        return [f'{e:06}:{h}' for e, h in self.hit_pairs()]
+
+    def __repr__(self) -> str:
+        return f'EdgeSet({len(self)} edges)'
+
+Coverage = Dict[str, Dict[str, EdgeSet]]
+
+def _as_edge_set(cov: Union[EdgeSet, Iterable[str]]) -> EdgeSet:
+    if isinstance(cov, EdgeSet):
+        return cov
+    return EdgeSet.from_showmap(cov)
+
+def write_coverage(path: str, cov: Mapping[str, Mapping[str, Union[EdgeSet, Iterable[str]]]]) -> None:
+    """Write coverage in the binary format. Values may be EdgeSets or lists
+    of afl-showmap lines."""
+    entries = [
+        (model, generator, _as_edge_set(edges))
+        for model, generators in cov.items()
+        for generator, edges in generators.items()
+    ]
+    # Offsets are relative to the start of the data area
+    index = []
+    offset = 0
+    for model, generator, edges in entries:
+        index.append([model, generator, offset, len(edges)])
+        offset += 5 * len(edges)
+        offset += -offset % 4
+    index_bytes = json.dumps({'entries': index}).encode()
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(index_bytes)))
+        f.write(index_bytes)
+        f.write(b'\0' * (-(HEADER.size + len(index_bytes)) % 4))
+        for _, _, edges in entries:
+            edge_array = array('I', edges.edges)
+            if sys.byteorder != 'little':
+                edge_array.byteswap()
+            f.write(edge_array.tobytes())
+            f.write(bytes(min(h, 255) for _, h in edges.hit_pairs()))
+            f.write(b'\0' * (-5 * len(edges) % 4))
+
+def _load_binary(f) -> Coverage:
+    header = f.read(HEADER.size)
+    magic, index_len = HEADER.unpack(header)
+    assert magic == MAGIC
+    index = json.loads(f.read(index_len))['entries']
+    data_start = HEADER.size + index_len
+    data_start += -data_start % 4
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+    cov: Coverage = {}
+    for model, generator, offset, n in index:
+        start = data_start + offset
+        if n == 0:
+            edges, buckets = array('I'), array('B')
+        elif sys.byteorder == 'little':
+            # Zero-copy views into the mapping
+            edges = view[start:start + 4 * n].cast('I')
+            buckets = view[start + 4 * n:start + 5 * n]
+        else:
+            edges = array('I', view[start:start + 4 * n].tobytes())
+            edges.byteswap()
+            buckets = array('B', view[start + 4 * n:start + 5 * n].tobytes())
+        cov.setdefault(model, {})[generator] = EdgeSet(edges, buckets)
+    return cov
+
+def _load_json(f) -> Coverage:
+    raw = json.load(f)
+    return {
+        model: {generator: EdgeSet.from_showmap(lines) for generator, lines in generators.items()}
+        for model, generators in raw.items()
+    }
+
+def is_binary_coverage(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def load_coverage(path: str) -> Coverage:
+    """Load a coverage file in either format as {model: {generator: EdgeSet}}."""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) == MAGIC:
+            f.seek(0)
+            return _load_binary(f)
+        f.seek(0)
+        return _load_json(f)
+
+def save_coverage(path: str, cov: Mapping[str, Mapping[str, Union[EdgeSet, Iterable[str]]]]) -> None:
+    """Save coverage; paths ending in .json keep the old JSON format."""
+    if path.endswith('.json'):
+        with open(path, 'w') as f:
+            json.dump({
+                model: {generator: _as_edge_set(edges).to_showmap() for generator, edges in generators.items()}
+                for model, generators in cov.items()
+            }, f)
+    else:
+        write_coverage(path, cov)
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert coverage files between JSON and the binary format')
+    parser.add_argument('input', help='Coverage file (either format)')
+    parser.add_argument('output', help='Output file; written as JSON if it ends in .json, binary otherwise')
+    args = parser.parse_args()
+    save_coverage(args.output, load_coverage(args.input))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+# Content hashes of generated outputs.
+#
+# driver.py hashes every output while writing it, and genoutputs.py saves the
+# digests of a variant's outputs in a manifest (MANIFEST_NAME) next to them.
+# Coverage collection uses the digests to run each distinct payload through
+# the target only once, however many files (and variants) produced it.
+
+import hashlib
+import json
+import os
+from typing import Dict, Iterable, List, Tuple
+
+HASH_NAME = 'sha256'
+MANIFEST_NAME = '.hashes.json'
+
+def new_hasher():
+    return hashlib.new(HASH_NAME)
+
+def digest_file(path: str) -> str:
+    hasher = new_hasher()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def write_manifest(outdir: str, results: Iterable[dict]) -> None:
+    """Save the digests of the successful outputs among driver Result records."""
+    manifest: Dict[str, Tuple[str, int]] = {}
+    for r in results:
+        if not r.get('output_hash') or not r.get('output_file'):
+            continue
+        try:
+            size = os.path.getsize(r['output_file'])
+        except FileNotFoundError:
+            continue
+        manifest[os.path.basename(r['output_file'])] = (r['output_hash'], size)
+    if manifest:
+        with open(os.path.join(outdir, MANIFEST_NAME), 'w') as f:
+            json.dump(manifest, f)
+
+def load_manifest(outdir: str) -> Dict[str, Tuple[str, int]]:
+    try:
+        with open(os.path.join(outdir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def output_digests(paths: List[str]) -> List[str]:
+    """Digest of each file; taken from the manifest in its directory when the
+    entry is there and the size still matches, computed otherwise."""
+    manifests: Dict[str, Dict[str, Tuple[str, int]]] = {}
+    digests = []
+    for path in paths:
+        dirname, name = os.path.split(path)
+        if dirname not in manifests:
+            manifests[dirname] = load_manifest(dirname)
+        entry = manifests[dirname].get(name)
+        if entry is not None and entry[1] == os.path.getsize(path):
+            digests.append(entry[0])
+        else:
+            digests.append(digest_file(path))
+    return digests
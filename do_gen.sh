@@ -5,13 +5,18 @@ set -euo pipefail
 
 prev_gen="$1"
 next_gen="$2"
-num_gens=$(./elmconfig.py get run.num_generations)
+# Resolve the whole config once, as ELMCONFIG_* variables; {MODEL} is left
+# in the per-model paths and filled in below
+# (assigned first, so that set -e sees a failing export)
+elmconfig_exports="$(./elmconfig.py export -s GEN=${next_gen})"
+eval "$elmconfig_exports"
+num_gens=$ELMCONFIG_RUN_NUM_GENERATIONS
 
 # MODELS="codellama starcoder starcoder_diff"
-MODELS=$(./elmconfig.py get model.names)
-NUM_VARIANTS=$(./elmconfig.py get cli.genvariants_parallel.num_variants)
-LOGDIR=$(./elmconfig.py get run.logdir -s GEN=${next_gen})
-NUM_SELECTED=$(./elmconfig.py get run.num_selected)
+MODELS=$ELMCONFIG_MODEL_NAMES
+NUM_VARIANTS=$ELMCONFIG_CLI_GENVARIANTS_PARALLEL_NUM_VARIANTS
+LOGDIR=$ELMCONFIG_RUN_LOGDIR
+NUM_SELECTED=$ELMCONFIG_RUN_NUM_SELECTED
 
 COLOR_RED='\033[0;31m'
 COLOR_GREEN='\033[0;32m'
@@ -35,17 +40,17 @@ else
     if [ -n "${SELECTION_STRATEGY:-}" ]; then
         selection_strategy="$SELECTION_STRATEGY"
     else
-        selection_strategy=$(./elmconfig.py get run.selection_strategy)
+        selection_strategy=$ELMCONFIG_RUN_SELECTION_STRATEGY
     fi
     # If strategy is elites, select best coverage across all generations
     # If it's best_of_generation, select best coverage from the previous generation
     # Hopefully eventually we will also have MAP-Elites
     if [ "$selection_strategy" == "elites" ]; then
         echo "$selection_strategy: Selecting best seeds from all generations"
-        cov_files=("$ELMFUZZ_RUNDIR"/*/logs/coverage.json)
+        cov_files=("$ELMFUZZ_RUNDIR"/*/logs/coverage.cov)
     elif [ "$selection_strategy" == "best_of_generation" ]; then
         echo "$selection_strategy: Selecting best seeds from previous generation"
-        cov_files=("$ELMFUZZ_RUNDIR/${prev_gen}/logs/coverage.json")
+        cov_files=("$ELMFUZZ_RUNDIR/${prev_gen}/logs/coverage.cov")
     elif [ "$selection_strategy" == "lattice" ]; then
         echo "$selection_strategy: Selecting seeds from the lattice"
     else
@@ -53,17 +58,17 @@ else
         exit 1
     fi
     if [ "$selection_strategy" == "lattice" ]; then
-        cov_file="$ELMFUZZ_RUNDIR"/${prev_gen}/logs/coverage.json
-        input_elite_file="$ELMFUZZ_RUNDIR"/${prev_gen}/logs/elites.json
-        output_elite_file="$ELMFUZZ_RUNDIR"/${next_gen}/logs/elites.json
+        cov_file="$ELMFUZZ_RUNDIR"/${prev_gen}/logs/coverage.cov
+        # Elites of all generations; `python elitearchive.py "$elite_archive" export -g <gen>` gives elites.json
+        elite_archive="$ELMFUZZ_RUNDIR"/elites.db
         # baseline="$ELMFUZZ_RUNDIR"/baseedges
-        # python select_seeds.py -g $prev_gen -n $NUM_SELECTED -c $cov_file -i $input_elite_file -o $output_elite_file -b $baseline | \
+        # python select_seeds.py -g $prev_gen -n $NUM_SELECTED -c $cov_file -a $elite_archive -b $baseline | \
         #     while read cov gen model generator ; do
         #         echo "Selecting $generator from $gen/$model with $cov edges covered"
         #         cp "$ELMFUZZ_RUNDIR"/${gen}/variants/${model}/${generator}.py \
         #         "$ELMFUZZ_RUNDIR"/${next_gen}/seeds/${gen}_${model}_${generator}.py
         #     done
-        python select_seeds.py -g $prev_gen -n $NUM_SELECTED -c $cov_file -i $input_elite_file -o $output_elite_file | \
+        python select_seeds.py -g $prev_gen -n $NUM_SELECTED -c $cov_file -a "$elite_archive" | \
             while read cov gen model generator ; do
                 echo "Selecting $generator from $gen/$model with $cov edges covered"
                 cp "$ELMFUZZ_RUNDIR"/${gen}/variants/${model}/${generator}.py \
@@ -95,43 +100,47 @@ else
     VARIANT_ARGS=""
 fi
 echo "Generating next generation: ${NUM_VARIANTS} variants for each seed with each model"
-for model_name in $MODELS ; do
-    MODEL=$(basename "$model_name")
-    GVLOG="${LOGDIR}/meta"
-    GOLOG="${LOGDIR}/outputgen_${MODEL}.jsonl"
-    GVOUT=$(./elmconfig.py get run.genvariant_dir -s MODEL=${MODEL} -s GEN=${next_gen})
-    GOOUT=$(./elmconfig.py get run.genoutput_dir -s MODEL=${MODEL} -s GEN=${next_gen})
-    echo "====================== $model_name ======================"
-    # TODO: have genvariants_parallel.py do all the models at once
-    # Will have to add in model-specific args to the config and merge
-    # in the starcoder_diff script
-    python genvariants_parallel.py $VARIANT_ARGS \
-        -M "${model_name}" -O "$GVOUT" -L "$GVLOG" \
-        "$ELMFUZZ_RUNDIR"/${next_gen}/seeds/*.py | \
-        python genoutputs.py -L "${GOLOG}" -O "${GOOUT}" -g "${next_gen}"
-    rm "$GOLOG"
-
-    # python shrink_variants_in_dir.py --source-dir "${GVOUT}"
-done
+# All models are driven by a single genvariants_parallel process; its output
+# feeds one shared genoutputs stage. {MODEL} is filled in per model.
+GVLOG="${LOGDIR}/meta/{MODEL}"
+GOLOG="${LOGDIR}/outputgen.jsonl"
+GVOUT=$ELMCONFIG_RUN_GENVARIANT_DIR
+GOOUT=$ELMCONFIG_RUN_GENOUTPUT_DIR
+# Outside the fuzzbench-style containers, genoutputs measures the coverage of
+# each generator as soon as its outputs are done, then deletes them
+if [ $TYPE == "fuzzbench" ] || [ $TYPE == "oss-fuzz" ] || [ $TYPE == "docker" ]; then
+    COVERAGE_ARGS=""
+else
+    COVERAGE_ARGS="--coverage ${LOGDIR}/coverage.cov --delete-outputs"
+fi
+echo "====================== $MODELS ======================"
+python genvariants_parallel.py $VARIANT_ARGS -A \
+    -O "$GVOUT" -L "$GVLOG" \
+    "$ELMFUZZ_RUNDIR"/${next_gen}/seeds/*.py | \
+    python genoutputs.py -L "${GOLOG}" -O "${GOOUT}" -g "${next_gen}" $COVERAGE_ARGS
+rm "$GOLOG"
 
-# Collect the coverage of the generators
-echo "Collecting coverage of the generators"
-all_models_genout_dir=$(realpath -m "$GOOUT"/..)
+# for model_name in $MODELS ; do
+#     python shrink_variants_in_dir.py --source-dir "$(./elmconfig.py get run.genvariant_dir -s MODEL=$(basename "$model_name") -s GEN=${next_gen})"
+# done
 
+# Collect the coverage of the generators (already done by genoutputs otherwise);
+# getcov_fuzzbench.py uses the run's coverage daemon when $ELMFUZZ_COVDAEMON is set
 if [ $TYPE == "fuzzbench" ] || [ $TYPE == "oss-fuzz" ] || [ $TYPE == "docker" ]; then
-    python getcov_fuzzbench.py --image elmfuzz/"$PROJECT_NAME" --input "$all_models_genout_dir" --covfile "${LOGDIR}/coverage.json"
-else
-    python getcov.py -O "${LOGDIR}/coverage.json" "$all_models_genout_dir"
+    echo "Collecting coverage of the generators"
+    all_models_genout_dir=$(realpath -m "${ELMCONFIG_RUN_GENOUTPUT_DIR//\{MODEL\}/.}")
+    python getcov_fuzzbench.py --image elmfuzz/"$PROJECT_NAME" --input "$all_models_genout_dir" --covfile "${LOGDIR}/coverage.cov"
 fi
 
 
 for model_name in $MODELS ; do
-    GOOUT=$(./elmconfig.py get run.genoutput_dir -s MODEL=${MODEL} -s GEN=${next_gen})
+    MODEL=$(basename "$model_name")
+    GOOUT=${ELMCONFIG_RUN_GENOUTPUT_DIR//\{MODEL\}/$MODEL}
     rm -rf "$GOOUT"
 done
 
 # Plot coverage
-python analyze_cov.py -m $num_gens -p "$ELMFUZZ_RUNDIR"/*/logs/coverage.json
+python analyze_cov.py -m $num_gens -p "$ELMFUZZ_RUNDIR"/*/logs/coverage.cov
 
 # Create a stamp file to indicate that this generation is finished
 touch "$ELMFUZZ_RUNDIR"/stamps/${next_gen}.stamp
@@ -17,6 +17,8 @@ from concurrent.futures import ProcessPoolExecutor, as_completed
 import logging
 
 from drive_log import set_loglevel
+from dedup import new_hasher
+from prefixes import PREFIXES, prefix_bytes
 logger = logging.getLogger('root')
 
 class ExceptionInfo(NamedTuple):
@@ -65,6 +67,8 @@ class Result(NamedTuple):
     function_name: Union[str,None] = None
     output_file: Union[str,None] = None
     args: Union[argparse.Namespace,None] = None
+    # Content hash of the output (see dedup.py), for successful runs
+    output_hash: Union[str,None] = None
 
     def _convert(self, item):
         """
@@ -186,6 +190,49 @@ class Sandbox():
             stderr = self.stderr.getvalue(),
         )
 
+# Sandbox that can be entered once per run in a batch. The temporary
+# directory and capture buffers are created once and reset between runs
+# instead of being rebuilt every time.
+class ReusableSandbox(Sandbox):
+    def __init__(self, timeout, memory_limit):
+        self.timeout = TimedExecution(timeout)
+        self.memory_limit = MemoryLimit(memory_limit)
+        self.tempdir = TemporaryDirectory()
+        self.stdout = io.StringIO()
+        self.stderr = io.StringIO()
+        self.old_cwd = None
+
+    def __enter__(self):
+        for buf in (self.stdout, self.stderr):
+            buf.seek(0)
+            buf.truncate()
+        self.capture_stdout = redirect_stdout(self.stdout)
+        self.capture_stderr = redirect_stderr(self.stderr)
+        self.capture_stderr.__enter__()
+        self.capture_stdout.__enter__()
+        self.old_cwd = os.getcwd()
+        os.chdir(self.tempdir.name)
+        self.timeout.__enter__()
+        self.memory_limit.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.memory_limit.__exit__(exc_type, exc_value, traceback)
+        self.timeout.__exit__(exc_type, exc_value, traceback)
+        os.chdir(self.old_cwd)
+        # Only pay for a cleanup if the generator left something behind
+        with os.scandir(self.tempdir.name) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.remove(entry.path)
+        self.capture_stdout.__exit__(exc_type, exc_value, traceback)
+        self.capture_stderr.__exit__(exc_type, exc_value, traceback)
+
+    def close(self):
+        self.tempdir.cleanup()
+
 class TooBigException(Exception):
     pass
 
@@ -193,12 +240,17 @@ class SizeLimitedBinaryFile(io.BufferedWriter):
     def __init__(self, *args, max_size: int, **kwargs):
         super().__init__(*args, **kwargs)
         self.max_size = max_size
+        self.hasher = new_hasher()
 
     def write(self, b: bytes) -> int:
         new_position = self.tell() + len(b)
         if new_position > self.max_size:
             raise TooBigException(f"Writing would exceed the size limit of {self.max_size} bytes")
+        self.hasher.update(b)
         return super().write(b)
+
+    def hexdigest(self) -> str:
+        return self.hasher.hexdigest()
     
 def generate_one(
         output_file: str,
@@ -215,15 +267,29 @@ def generate_one(
 
     global ELMFUZZ_RUNDIR
 
-    with open('/dev/urandom', 'rb') as rng, \
-         SizeLimitedBinaryFile(open(output_file, 'wb'), max_size=args.size_limit) as output:
+    with open('/dev/urandom', 'rb') as rng:
+        return run_one(output_file, function, args, rng, Sandbox(args.timeout, args.max_mem))
+
+def run_one(
+        output_file: str,
+        function: Callable[[BinaryIO, BinaryIO, BinaryIO],None],
+        args: argparse.Namespace,
+        rng: BinaryIO,
+        s: Sandbox,
+    ) -> Result:
+    # The target's metadata prefix goes in front of the payload and does not
+    # count towards the size limit
+    prefix = prefix_bytes(args.metadata_prefix, rng)
+    with SizeLimitedBinaryFile(open(output_file, 'wb'), max_size=args.size_limit + len(prefix)) as output:
+        output.write(prefix)
         try:
-            with Sandbox(args.timeout, args.max_mem) as s:
+            with s:
                 function(rng, output)
             r = Result(
                 result_type = GenResult.Success,
                 error = None,
                 data = s.result(),
+                output_hash = output.hexdigest(),
             )
         except MemoryError as e:
             # Reset the memory limit immediately
@@ -255,6 +321,97 @@ def generate_one(
         os.remove(output_file)
     return r
 
+# Exit status a batch worker uses to ask for a fresh process
+BATCH_RESPAWN = 3
+
+def current_rss() -> int:
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+def _batch_worker(tasks: List[str], function, args, conn) -> int:
+    # Runs in the forked batch process: one import, one rng, one sandbox
+    # for every output, with a per-run alarm from the sandbox
+    baseline_rss = current_rss()
+    dirnames = set(os.path.dirname(t) for t in tasks)
+    for dirname in dirnames:
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+    s = ReusableSandbox(args.timeout, args.max_mem)
+    try:
+        with open('/dev/urandom', 'rb') as rng:
+            for i, output_file in enumerate(tasks):
+                r = run_one(output_file, function, args, rng, s)
+                conn.send((i, r))
+                if r.error is not None and r.error.exception_class == 'builtins.MemoryError':
+                    return BATCH_RESPAWN
+                if current_rss() - baseline_rss > args.batch_max_growth:
+                    return BATCH_RESPAWN
+    finally:
+        s.close()
+    return 0
+
+def generate_batch(
+        tasks: List[str],
+        function: Callable[[BinaryIO, BinaryIO, BinaryIO],None],
+        args: argparse.Namespace,
+        emit: Callable[[str, Result], None],
+    ) -> None:
+    """Generate one output per file in tasks, reusing a single forked process
+    for as many runs as possible. A new process is only started when a run
+    crashes the current one, hangs past the alarm, or leaks memory."""
+    from multiprocessing.connection import Connection
+    # Generous watchdog in case the generator blocks SIGALRM (e.g., in C code)
+    watchdog = 2 * args.timeout + 5
+    pending = list(tasks)
+    while pending:
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            status = 1
+            try:
+                status = _batch_worker(pending, function, args, Connection(w))
+            finally:
+                os._exit(status)
+        os.close(w)
+        conn = Connection(r)
+        done = 0
+        killed = False
+        try:
+            while True:
+                if not conn.poll(watchdog):
+                    os.kill(pid, signal.SIGKILL)
+                    killed = True
+                    break
+                i, result = conn.recv()
+                emit(pending[i], result)
+                done = i + 1
+        except EOFError:
+            pass
+        finally:
+            conn.close()
+        _, status = os.waitpid(pid, 0)
+        if not killed and os.WIFEXITED(status) and os.WEXITSTATUS(status) in (0, BATCH_RESPAWN):
+            pending = pending[done:]
+            continue
+        if done >= len(pending):
+            # Every run was reported, so the worker died while shutting down
+            logger.warning(f"Batch worker exited badly after finishing its batch (status {status})")
+            break
+        # The run at pending[done] took the process down with it
+        crashed = pending[done]
+        logger.debug(f"Batch worker died on {crashed} (status {status}); respawning")
+        try:
+            os.remove(crashed)
+        except FileNotFoundError:
+            pass
+        emit(crashed, Result(
+            result_type = GenResult.Timeout if killed else GenResult.RunError,
+            error = None,
+            data = None,
+        ))
+        pending = pending[done+1:]
+
 def get_function(module_path, function_name, args):
     try:
         # This needs to wrapped in the sandbox because modules can exec
@@ -302,6 +459,9 @@ def make_parser(description):
     parser.add_argument(
         '-s', '--output-suffix', type=str, default='.dat',
         help='Output suffix')
+    parser.add_argument(
+        '-P', '--metadata-prefix', type=str, default='none', choices=list(PREFIXES),
+        help='Metadata prefix written before each output (see prefixes.py)')
     parser.add_argument(
         '-t', '--timeout', type=int, default=10,
         help='Timeout for the run (in seconds)')
@@ -314,6 +474,12 @@ def make_parser(description):
     # parser.add_argument(
     #     '--real-feedback', action='store_true', default=False,
     # )
+    parser.add_argument(
+        '-b', '--batch', action='store_true',
+        help='Run all outputs in one reused process instead of one pool task each')
+    parser.add_argument(
+        '--batch-max-growth', type=int, default=256*1024*1024,
+        help='In batch mode, start a fresh process once RSS has grown by this much (in bytes)')
     parser.add_argument('-q', '--quiet', action='store_true')
     parser.add_argument('-v', '--verbose', action='store_true')
     parser.add_argument('-i', '--inputs', type=str)
@@ -328,39 +494,55 @@ def fill_result(result, module_path, function_name, output_file, args):
         function_name = function_name,
         output_file = output_file,
         args = args,
+        output_hash = result.output_hash,
     )
 
+def output_file_name(args, seed_input, i):
+    return f'{args.output_prefix}_{os.path.basename(seed_input).replace(".", "-")}_{i:08}{args.output_suffix}'
+
+def run_generator(args, emit: Callable[[Result], None]) -> None:
+    """Import the generator in args.module_path and run it args.num times
+    per seed input, passing each filled-in Result to emit()."""
+    seed_inputs: list[str] = list(map(lambda x: x.strip(), args.inputs.split(';')))
+    module_path = os.path.abspath(args.module_path)
+    function_name = args.function
+    function_or_result = get_function(module_path, function_name, args)
+    if isinstance(function_or_result, Result):
+        result = function_or_result
+        emit(fill_result(result, module_path, function_name, None, args))
+        return
+
+    function = function_or_result
+    if args.batch:
+        tasks = [
+            output_file_name(args, seed_input, i)
+            for seed_input in seed_inputs
+            for i in range(args.num)
+        ]
+        generate_batch(tasks, function, args, lambda output_file, result: emit(
+            fill_result(result, module_path, function_name, output_file, args)
+        ))
+        return
+    with ProcessPoolExecutor() as executor:
+        futures = {}
+        for seed_input in seed_inputs:
+            for i in range(args.num):
+                output_file = output_file_name(args, seed_input, i)
+                future = executor.submit(generate_one, output_file, function, args)
+                futures[future] = output_file
+        for future in as_completed(futures):
+            output_file = futures[future]
+            result = future.result()
+            emit(fill_result(result, module_path, function_name, output_file, args))
+
 def main():
     parser = make_parser('Run an input generator function in a loop')
     args = parser.parse_args()
     set_loglevel(logger, args)
 
-    seed_inputs: list[str] = list(map(lambda x: x.strip(), args.inputs.split(';')))
-
     # if not args.real_feedback:
     with open(args.logfile, 'w') if args.logfile else nullcontext(sys.stdout) as f:
-        module_path = os.path.abspath(args.module_path)
-        function_name = args.function
-        function_or_result = get_function(module_path, function_name, args)
-        if isinstance(function_or_result, Result):
-            result = function_or_result
-            final_result = fill_result(result, module_path, function_name, None, args)
-            print(final_result.json(), file=f)
-            return
-
-        function = function_or_result
-        with ProcessPoolExecutor() as executor:
-            futures = {}
-            for seed_input in seed_inputs:
-                for i in range(args.num):
-                    output_file = f'{args.output_prefix}_{os.path.basename(seed_input).replace(".", "-")}_{i:08}{args.output_suffix}'
-                    future = executor.submit(generate_one, output_file, function, args)
-                    futures[future] = output_file
-            for future in as_completed(futures):
-                output_file = futures[future]
-                result = future.result()
-                final_result = fill_result(result, module_path, function_name, output_file, args)
-                print(final_result.json(), file=f)
+        run_generator(args, lambda r: print(r.json(), file=f))
     # else:
     #     with open(args.logfile, 'w') if args.logfile else nullcontext(sys.stdout) as log_f:
     #         module_path = os.path.abspath(args.module_path)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# Persistent elite archive for select_seeds.
+#
+# elites.json holds the full edge list of every elite and used to be read and
+# rewritten in full every generation. The archive is a SQLite database with
+# one row per elite (source size plus edge bitset, see covstore.to_bits) and
+# an append-only log of the elites each generation added and removed. A
+# selection round only writes what changed, and the elite set after any
+# generation can still be reconstructed (and exported as elites.json). Each
+# selection round also logs a 'select' marker, so that a generation whose
+# selection changed nothing is still on record.
+
+import argparse
+import json
+import sqlite3
+import sys
+from typing import Dict, Optional, Tuple
+
+from covstore import edge_id, to_bits, from_bits
+
+# {key: (edge bitset, size)}, as used by select_seeds
+Elites = Dict[str, Tuple[int, int]]
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS elites (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    edges BLOB NOT NULL,
+    active INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS elites_active ON elites(active);
+CREATE TABLE IF NOT EXISTS history (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    generation TEXT NOT NULL,
+    key TEXT NOT NULL,
+    action TEXT NOT NULL CHECK (action IN ('select', 'add', 'remove'))
+);
+CREATE INDEX IF NOT EXISTS history_generation ON history(generation);
+'''
+
+def _pack(edges: int) -> bytes:
+    return edges.to_bytes((edges.bit_length() + 7) // 8, 'little')
+
+def _unpack(blob: bytes) -> int:
+    return int.from_bytes(blob, 'little')
+
+class EliteArchive:
+    def __init__(self, path: str):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def rollback(self, generation: str) -> None:
+        """Undo the changes recorded for generation and everything after it,
+        so that selection for that generation can be rerun."""
+        row = self.db.execute('SELECT MIN(seq) FROM history WHERE generation = ?', (generation,)).fetchone()
+        if row[0] is None:
+            return
+        with self.db:
+            undo = self.db.execute(
+                'SELECT seq, key, action FROM history WHERE seq >= ? ORDER BY seq DESC', (row[0],)
+            ).fetchall()
+            for _, key, action in undo:
+                if action == 'select':
+                    continue
+                self.db.execute('UPDATE elites SET active = ? WHERE key = ?', (0 if action == 'add' else 1, key))
+            self.db.execute('DELETE FROM history WHERE seq >= ?', (row[0],))
+
+    def load(self, generation: str) -> Elites:
+        """Current elites, as they were before selection for generation."""
+        self.rollback(generation)
+        return {
+            key: (_unpack(edges), size)
+            for key, size, edges in self.db.execute('SELECT key, size, edges FROM elites WHERE active = 1')
+        }
+
+    def update(self, generation: str, old: Elites, new: Elites) -> None:
+        """Record the selection result for generation; only elites that
+        entered or left the archive are written."""
+        removed = old.keys() - new.keys()
+        added = new.keys() - old.keys()
+        with self.db:
+            for key in removed:
+                self.db.execute('UPDATE elites SET active = 0 WHERE key = ?', (key,))
+            for key in added:
+                edges, size = new[key]
+                self.db.execute(
+                    'INSERT INTO elites (key, size, edges, active) VALUES (?, ?, ?, 1) '
+                    'ON CONFLICT(key) DO UPDATE SET size = excluded.size, edges = excluded.edges, active = 1',
+                    (key, size, _pack(edges)),
+                )
+            self.db.executemany(
+                'INSERT INTO history (generation, key, action) VALUES (?, ?, ?)',
+                [(generation, '', 'select')] +
+                [(generation, key, 'remove') for key in sorted(removed)] +
+                [(generation, key, 'add') for key in sorted(added)],
+            )
+
+    def snapshot(self, generation: Optional[str] = None) -> Elites:
+        """Elites after selection for generation (the latest if None)."""
+        if generation is None:
+            keys = [key for key, in self.db.execute('SELECT key FROM elites WHERE active = 1')]
+        else:
+            row = self.db.execute('SELECT MAX(seq) FROM history WHERE generation = ?', (generation,)).fetchone()
+            if row[0] is None:
+                raise KeyError(f'No selection recorded for {generation}')
+            active = set()
+            for key, action in self.db.execute('SELECT key, action FROM history WHERE seq <= ? ORDER BY seq', (row[0],)):
+                if action == 'add':
+                    active.add(key)
+                elif action == 'remove':
+                    active.discard(key)
+            keys = sorted(active)
+        elites = {}
+        for key in keys:
+            size, edges = self.db.execute('SELECT size, edges FROM elites WHERE key = ?', (key,)).fetchone()
+            elites[key] = (_unpack(edges), size)
+        return elites
+
+def to_json(elites: Elites) -> dict:
+    return {key: (from_bits(edges), size) for key, (edges, size) in elites.items()}
+
+def from_json(elites_raw: dict) -> Elites:
+    return {key: (to_bits(map(edge_id, edges)), size) for key, (edges, size) in elites_raw.items()}
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or migrate the elite archive')
+    parser.add_argument('archive', help='Elite archive (SQLite)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help='Write the elites after a generation as elites.json')
+    export_parser.add_argument('-g', '--generation', default=None, help='Generation (default: latest)')
+    export_parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout)
+    import_parser = subparsers.add_parser('import', help='Seed the archive from an existing elites.json')
+    import_parser.add_argument('-g', '--generation', required=True,
+                               help='Generation whose selection produced the file')
+    import_parser.add_argument('input', type=argparse.FileType('r'))
+    args = parser.parse_args()
+
+    with EliteArchive(args.archive) as archive:
+        if args.command == 'export':
+            json.dump(to_json(archive.snapshot(args.generation)), args.output)
+        else:
+            old = archive.load(args.generation)
+            archive.update(args.generation, old, from_json(json.load(args.input)))
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,14 @@
 
 import argparse
 import copy
+import functools
 from datetime import datetime
 from enum import Enum
 import sys
 import textwrap
 from typing import Any, Dict, List, Optional, Sequence, TextIO, Tuple
 import os
+import shlex
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, Action, Namespace
 from pathlib import Path, PosixPath
 from ruamel.yaml import YAML
@@ -306,6 +308,11 @@ class ELMFuzzConfig:
                            help="Source files in the target")
         group.add_argument("--target.covbin", type=Path,
                            help="Path to the target binary with coverage instrumentation")
+        group.add_argument("--target.harness", type=str, default='oneshot', choices=['oneshot', 'persistent'],
+                           help="Entry point spliced into fuzzbench/oss-fuzz targets (one of: oneshot, persistent); "
+                                "persistent loops over inputs delivered through AFL shared memory")
+        group.add_argument("--target.persistent_iterations", type=int, default=1000,
+                           help="Inputs a persistent harness runs before its process is respawned")
         self.subgroup_help['model'] = 'Options to configure the model(s) used for variant generation'
         group.add_argument("--model.names", type=str, nargs='+', action='extend', help="List of model names")
         group.add_argument("--model.endpoints", type=str, nargs='+', action=StoreDictKeyPair,
@@ -735,10 +742,23 @@ class ELMFuzzConfig:
         else:
             return f"ELMFuzzConfig(prog={self.parser.prog}, [not yet parsed])"
 
+def prog_module(prog: str):
+    """The module of prog, without importing a second copy of the running
+    program (genoutputs, for one, sets up logging when imported)"""
+    main = sys.modules.get('__main__')
+    main_file = getattr(main, '__file__', None)
+    if main_file is not None and Path(main_file).stem == prog:
+        return main
+    return __import__(prog)
+
 def get_config_for_progs(progs: List[str], **kwargs) -> CommentedMap:
+    if not progs:
+        # Only the shared options (target, run, model, ...)
+        config = ELMFuzzConfig(prog='elmconfig')
+        return config.get_config(config.parse_args_nofail(['--dump-config']), **kwargs)
     full_config = None
     for prog in progs:
-        module = __import__(prog)
+        module = prog_module(prog)
         parser = module.make_parser()
         config = ELMFuzzConfig(
             prog=prog,
@@ -792,9 +812,58 @@ def mget(d, keys, default=None):
     else:
         return d
 
-def get_cmd(args):
+# Resolving the config means importing every program and parsing its options
+# plus the merged YAML files, so it is done once per process (per set of
+# config files that would be found) and shared by all lookups
+@functools.lru_cache(maxsize=None)
+def _resolved_config(progs: Tuple[str, ...], search_key: Tuple[Optional[str], ...]) -> CommentedMap:
+    return get_config_for_progs(list(progs))
+
+def resolved_config(progs: Optional[Sequence[str]] = None) -> CommentedMap:
+    """Merged config of progs (default: all programs); treat it as read-only"""
+    progs = tuple(progs) if progs is not None else tuple(ALL_PROGS)
+    search_key = (
+        os.getcwd(),
+        os.environ.get('ELMFUZZ_RUNDIR'),
+        os.environ.get('ELMFUZZ_CONFIG'),
+    )
+    return _resolved_config(progs, search_key)
+
+def owner_progs(key: str) -> Tuple[str, ...]:
+    """Programs whose options are needed to resolve key: the owning program
+    for cli.<prog>.* keys, none (just the shared options) otherwise"""
+    parts = key.split('.')
+    if len(parts) > 1 and parts[0] == 'cli' and parts[1] in ALL_PROGS:
+        return (parts[1],)
+    return ()
+
+def lookup(key: str, progs: Optional[Sequence[str]] = None) -> Any:
+    """Typed value of a config option, e.g. lookup('run.num_generations') == 10
+
+    :raises KeyError: if key is not a valid key
+    """
+    try:
+        return mget(resolved_config(progs), key.split('.'), Raise)
+    except (KeyError, IndexError):
+        raise KeyError(key)
+
+class _KeepMissing(dict):
+    def __missing__(self, key):
+        return '{' + key + '}'
+
+def format_value(val: Any,
+                 substitutions: Optional[Dict[str, str]] = None,
+                 no_subst=False, no_expand=False, no_env=False,
+                 keep_missing=False,
+                 ) -> str:
+    """Format a config value the way `elmconfig.py get` prints it
+
+    :param substitutions: Values for {VAR} placeholders in strings
+    :param keep_missing: Leave placeholders without a value as they are
+        (otherwise they raise KeyError)
+    """
     def expand_path(val):
-        return str(val.expanduser() if not args.no_expand else val)
+        return str(val.expanduser() if not no_expand else val)
     def conv(val):
         val_converters = [
             (Path, expand_path),
@@ -805,21 +874,15 @@ def get_cmd(args):
             if isinstance(val, ty):
                 return conv_func(val)
         return val
-    conf_dict = get_config_for_progs(args.progs)
-    keys = args.key.split('.')
-    try:
-        val = mget(conf_dict, keys, Raise)
-    except (KeyError, IndexError):
-        print(f"Error: {args.key} is not a valid key", file=sys.stderr)
-        sys.exit(1)
     val = conv(val)
-    if isinstance(val, str) and not args.no_subst:
+    if isinstance(val, str) and not no_subst:
         # Do any substitutions
-        subst_dict = dict([ s.split('=', 1) for s in args.substitutions ])
+        subst_dict = _KeepMissing() if keep_missing else {}
+        subst_dict.update(substitutions or {})
         # Expand environment variables
-        if not args.no_env:
+        if not no_env:
             subst_dict.update(os.environ)
-        val = val.format(**subst_dict)
+        val = val.format_map(subst_dict)
     access_info = on_nsf_access()
     cwd = os.path.dirname(os.path.realpath(__file__))
     if access_info is not None and isinstance(val, str):
@@ -827,7 +890,51 @@ def get_cmd(args):
             val = val.replace('/home/appuser/elmfuzz', cwd)
         elif val.startswith('/home/appuser'):
             val = val.replace('/home/appuser', os.path.join(cwd, os.path.pardir))
-    print(val)
+    return str(val)
+
+def get_value(key: str,
+              substitutions: Optional[Dict[str, str]] = None,
+              progs: Optional[Sequence[str]] = None,
+              **kwargs) -> str:
+    """In-process equivalent of `elmconfig.py get key -s VAR=VAL ...`"""
+    return format_value(lookup(key, progs), substitutions, **kwargs)
+
+def parse_substitutions(substitutions: List[str]) -> Dict[str, str]:
+    return dict([ s.split('=', 1) for s in substitutions ])
+
+def get_cmd(args):
+    try:
+        val = lookup(args.key, args.progs)
+    except KeyError:
+        print(f"Error: {args.key} is not a valid key", file=sys.stderr)
+        sys.exit(1)
+    print(format_value(
+        val, parse_substitutions(args.substitutions),
+        no_subst=args.no_subst, no_expand=args.no_expand, no_env=args.no_env,
+    ))
+
+def shell_var_name(key: str, prefix: str = 'ELMCONFIG_') -> str:
+    """Shell variable for a config key, e.g. run.num_generations -> ELMCONFIG_RUN_NUM_GENERATIONS"""
+    return prefix + ''.join(c if c.isalnum() else '_' for c in key).upper()
+
+def export_cmd(args):
+    conf_dict = resolved_config(args.progs)
+    keys = args.prefix.split('.') if args.prefix else []
+    try:
+        sub_dict = mget(conf_dict, keys, Raise)
+    except (KeyError, IndexError):
+        print(f"Error: {args.prefix} is not a valid prefix", file=sys.stderr)
+        sys.exit(1)
+    if isinstance(sub_dict, dict):
+        flat_prefix = '.'.join(keys) + '.' if keys else ''
+        flat_dict = ELMFuzzConfig.flattened_conf(sub_dict, prefix=flat_prefix)
+    else:
+        flat_dict = {args.prefix: sub_dict}
+    substitutions = parse_substitutions(args.substitutions)
+    for key, val in flat_dict.items():
+        val = format_value(val, substitutions, no_subst=args.no_subst, no_expand=args.no_expand,
+                           no_env=args.no_env, keep_missing=True)
+        print(f'export {shell_var_name(key, args.var_prefix)}={shlex.quote(val)}')
 
 def list_cmd(args):
     conf_dict = get_config_for_progs(args.progs)
@@ -899,6 +1006,18 @@ def main():
     cmd.add_argument('-s', '--substitute', type=str, action='append', dest='substitutions',
                      default=[], metavar="VAR=VAL", help="Substitute VAR with VAL in strings")
     cmd.set_defaults(func=get_cmd)
+    cmd = subparsers.add_parser('export', help="Print the resolved config as shell export lines, "
+                                "so that scripts can `eval` it once instead of calling `get` per key")
+    cmd.add_argument('prefix', type=str, nargs='?', default='', help="Only export options under this prefix")
+    cmd.add_argument('--var-prefix', type=str, default='ELMCONFIG_',
+                     help="Prefix for variable names (e.g. run.num_generations -> ELMCONFIG_RUN_NUM_GENERATIONS)")
+    cmd.add_argument('--no-subst', action='store_true', help="Don't do any substitutions")
+    cmd.add_argument('--no-expand', action='store_true', help="Don't expand ~ in paths")
+    cmd.add_argument('--no-env', action='store_true', help="Don't expand environment variables")
+    cmd.add_argument('-s', '--substitute', type=str, action='append', dest='substitutions',
+                     default=[], metavar="VAR=VAL",
+                     help="Substitute VAR with VAL in strings; placeholders without a value are kept")
+    cmd.set_defaults(func=export_cmd)
     cmd = subparsers.add_parser('list', help="List config options")
     cmd.add_argument('prefix', type=str, nargs='?', default='', help="Prefix to filter options")
     cmd.set_defaults(func=list_cmd)
@@ -0,0 +1,277 @@
+# Crash replay for triage.
+#
+# Triage runs the same instrumented binary over and over, with one
+# FIXREVERTER setting per run. Starting it with fork+exec every time spends
+# most of the time in the loader and the target's initialization, so runs
+# go through the binary's AFL forkserver instead: one forkserver per
+# (binary, environment) is started on first use and kept warm, and each run
+# only costs a fork. Binaries without a forkserver fall back to a plain
+# subprocess per run. The environment is passed to the child only; the
+# calling process's os.environ is never modified.
+
+import os
+import select
+import signal
+import struct
+import subprocess
+import tempfile
+from collections import OrderedDict
+from typing import Callable, Literal
+
+FORKSRV_FD = 198
+# AFL++ forkserver option bits in the hello message
+FS_OPT_ENABLED = 0x80000001
+FS_OPT_SHDMEM_FUZZ = 0x01000000
+FS_OPT_AUTODICT = 0x10000000
+# AFL++ >= 4.20 opens with a versioned hello ("AFL\0" + version) instead
+FS_NEW_VERSION_BASE = 0x41464c00
+FS_NEW_VERSION_MAX = 1
+FS_NEW_OPT_MAPSIZE = 0x00000001
+FS_NEW_OPT_SHDMEM_FUZZ = 0x00000002
+FS_NEW_OPT_AUTODICT = 0x00000800
+
+HANDSHAKE_TIMEOUT = 10.0
+
+Status = Literal['CRASH', 'NORMAL', 'TIMEOUT']
+
+def parse_bug_lines(output: str) -> tuple[set[str], set[str]]:
+    """The triggered and reached bug indices printed by the FIXREVERTER runtime"""
+    triggered = set()
+    reached = set()
+    for line in output.splitlines():
+        lt = line.strip()
+        if lt.startswith('triggered bug index '):
+            triggered.add(lt.split()[-1])
+        elif lt.startswith('reached bug index '):
+            reached.add(lt.split()[-1])
+    return triggered, reached
+
+class PopenExecutor:
+    """One fork+exec per run"""
+    def __init__(self, binary: str, env: dict[str, str], merge_output: bool = False,
+                 preexec_fn: Callable[[], None] | None = None) -> None:
+        self.binary = binary
+        self.env = env
+        self.merge_output = merge_output
+        self.preexec_fn = preexec_fn
+
+    def run(self, test_case: str, timeout: float, output_limit: int) -> tuple[Status, str]:
+        proc = subprocess.Popen(
+            [self.binary, test_case],
+            stdout=subprocess.PIPE if self.merge_output else subprocess.DEVNULL,
+            stderr=subprocess.STDOUT if self.merge_output else subprocess.PIPE,
+            env=self.env, preexec_fn=self.preexec_fn,
+        )
+        pipe = proc.stdout if self.merge_output else proc.stderr
+        assert pipe is not None
+        try:
+            stdout_b, stderr_b = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            output_b = pipe.read(output_limit)
+            proc.wait()
+            return 'TIMEOUT', output_b.decode('utf-8', errors='replace')
+        output_b = stdout_b if self.merge_output else stderr_b
+        status: Status = 'NORMAL' if proc.returncode == 0 else 'CRASH'
+        return status, output_b[:output_limit].decode('utf-8', errors='replace')
+
+    def close(self) -> None:
+        pass
+
+class ForkserverExecutor:
+    """Runs through the binary's AFL forkserver. The test case is copied to a
+    fixed input file, which is the binary's only argument, and the output of
+    each run goes to a file that is truncated before the next one."""
+    def __init__(self, binary: str, env: dict[str, str], merge_output: bool = False,
+                 preexec_fn: Callable[[], None] | None = None) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='replay-')
+        self.input_path = os.path.join(self.tmpdir.name, 'input')
+        open(self.input_path, 'wb').close()
+        self.output_fd = os.open(os.path.join(self.tmpdir.name, 'output'), os.O_RDWR | os.O_CREAT)
+        ctl_r, self.ctl_w = os.pipe()
+        self.st_r, st_w = os.pipe()
+        def child_setup():
+            os.dup2(ctl_r, FORKSRV_FD)
+            os.dup2(st_w, FORKSRV_FD + 1)
+            os.setsid()
+            if preexec_fn is not None:
+                preexec_fn()
+        self.proc = subprocess.Popen(
+            [binary, self.input_path],
+            stdin=subprocess.DEVNULL,
+            stdout=self.output_fd if merge_output else subprocess.DEVNULL,
+            stderr=self.output_fd,
+            env=env, preexec_fn=child_setup, close_fds=False,
+        )
+        os.close(ctl_r)
+        os.close(st_w)
+        self.was_killed = 0
+        # Runs completed through the forkserver
+        self.runs = 0
+        self.alive = self._handshake()
+        if not self.alive:
+            self.close()
+
+    def _read_exact(self, size: int, timeout: float | None) -> bytes | None:
+        data = b''
+        while len(data) < size:
+            ready, _, _ = select.select([self.st_r], [], [], timeout)
+            if not ready:
+                return None
+            chunk = os.read(self.st_r, size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def _read_status(self, timeout: float | None) -> int | None:
+        data = self._read_exact(4, timeout)
+        if data is None:
+            return None
+        return struct.unpack('<I', data)[0]
+
+    def _handshake_new(self, hello: int) -> bool:
+        version = hello - FS_NEW_VERSION_BASE
+        if not 1 <= version <= FS_NEW_VERSION_MAX:
+            return False
+        os.write(self.ctl_w, struct.pack('<I', hello ^ 0xffffffff))
+        options = self._read_status(HANDSHAKE_TIMEOUT)
+        if options is None:
+            return False
+        # A shared-memory test case would bypass the input file
+        if options & FS_NEW_OPT_SHDMEM_FUZZ:
+            return False
+        if options & FS_NEW_OPT_MAPSIZE and self._read_status(HANDSHAKE_TIMEOUT) is None:
+            return False
+        if options & FS_NEW_OPT_AUTODICT:
+            dict_len = self._read_status(HANDSHAKE_TIMEOUT)
+            if dict_len is None or self._read_exact(dict_len, HANDSHAKE_TIMEOUT) is None:
+                return False
+        # The forkserver repeats the hello once it is done
+        return self._read_status(HANDSHAKE_TIMEOUT) == hello
+
+    def _handshake(self) -> bool:
+        hello = self._read_status(HANDSHAKE_TIMEOUT)
+        if hello is None:
+            return False
+        if hello & 0xffffff00 == FS_NEW_VERSION_BASE:
+            return self._handshake_new(hello)
+        # The forkserver waits for our options when it could share memory
+        # or send a dictionary; we want neither
+        if hello & FS_OPT_ENABLED == FS_OPT_ENABLED and hello & (FS_OPT_SHDMEM_FUZZ | FS_OPT_AUTODICT):
+            os.write(self.ctl_w, struct.pack('<I', 0))
+        return True
+
+    def run(self, test_case: str, timeout: float, output_limit: int) -> tuple[Status, str] | None:
+        """Result of one run, or None if the forkserver has died"""
+        with open(test_case, 'rb') as src, open(self.input_path, 'wb') as dst:
+            dst.write(src.read())
+        os.ftruncate(self.output_fd, 0)
+        os.lseek(self.output_fd, 0, os.SEEK_SET)
+        try:
+            os.write(self.ctl_w, struct.pack('<I', self.was_killed))
+        except BrokenPipeError:
+            return None
+        child_pid = self._read_status(HANDSHAKE_TIMEOUT)
+        if child_pid is None:
+            return None
+        self.was_killed = 0
+        status = self._read_status(timeout)
+        timed_out = status is None
+        if timed_out:
+            try:
+                os.kill(child_pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            self.was_killed = 1
+            status = self._read_status(HANDSHAKE_TIMEOUT)
+            if status is None:
+                return None
+        self.runs += 1
+        output = os.pread(self.output_fd, output_limit, 0).decode('utf-8', errors='replace')
+        if timed_out:
+            return 'TIMEOUT', output
+        # A persistent-mode child stops itself between runs
+        if os.WIFSTOPPED(status) or (os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0):
+            return 'NORMAL', output
+        return 'CRASH', output
+
+    def close(self) -> None:
+        if self.proc.poll() is None:
+            try:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            self.proc.wait()
+        for fd in (self.ctl_w, self.st_r, self.output_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self.tmpdir.cleanup()
+        self.alive = False
+
+class ReplayExecutor:
+    """Runs test cases against (binary, env) pairs, keeping up to
+    max_servers forkservers warm (least recently used ones are closed)."""
+    def __init__(self, max_servers: int = 16, merge_output: bool = False,
+                 preexec_fn: Callable[[], None] | None = None, output_limit: int = 1024 * 1024) -> None:
+        self.max_servers = max_servers
+        self.merge_output = merge_output
+        self.preexec_fn = preexec_fn
+        self.output_limit = output_limit
+        self.servers: OrderedDict[tuple[str, tuple], ForkserverExecutor] = OrderedDict()
+        # Binaries whose forkserver did not come up
+        self.no_forkserver: set[str] = set()
+
+    def _server(self, binary: str, env: dict[str, str]) -> ForkserverExecutor | None:
+        if binary in self.no_forkserver:
+            return None
+        key = (binary, tuple(sorted(env.items())))
+        server = self.servers.get(key)
+        if server is not None:
+            self.servers.move_to_end(key)
+            return server
+        server = ForkserverExecutor(binary, env, self.merge_output, self.preexec_fn)
+        if not server.alive:
+            self.no_forkserver.add(binary)
+            return None
+        self.servers[key] = server
+        while len(self.servers) > self.max_servers:
+            _, old = self.servers.popitem(last=False)
+            old.close()
+        return server
+
+    def run(self, binary: str, env: dict[str, str], test_case: str, timeout: float) -> tuple[Status, set[str], set[str]]:
+        server = self._server(binary, env)
+        result = server.run(test_case, timeout, self.output_limit) if server is not None else None
+        if result is None:
+            if server is not None:
+                # Died (e.g. killed by the rlimit); start over next time,
+                # unless it never got through a single run
+                self.servers.pop((binary, tuple(sorted(env.items()))), None)
+                if server.runs == 0:
+                    self.no_forkserver.add(binary)
+                server.close()
+            result = PopenExecutor(binary, env, self.merge_output, self.preexec_fn).run(
+                test_case, timeout, self.output_limit)
+        status, output = result
+        if status == 'NORMAL':
+            return 'NORMAL', set(), set()
+        triggered, reached = parse_bug_lines(output)
+        return status, triggered, reached
+
+    def close(self) -> None:
+        for server in self.servers.values():
+            server.close()
+        self.servers.clear()
+
+# One executor per process and configuration, so that ProcessPoolExecutor
+# workers each keep their own forkservers
+_executors: dict[tuple[int, bool], ReplayExecutor] = {}
+
+def get_executor(merge_output: bool = False, preexec_fn: Callable[[], None] | None = None) -> ReplayExecutor:
+    key = (os.getpid(), merge_output)
+    if key not in _executors:
+        _executors[key] = ReplayExecutor(merge_output=merge_output, preexec_fn=preexec_fn)
+    return _executors[key]
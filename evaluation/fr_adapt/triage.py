@@ -1,6 +1,6 @@
 import os
 import os.path
-from typing import Callable, Literal, TypeVar, Generic
+from typing import Callable, Literal, TypeVar
 from enum import Enum
 from tqdm import tqdm
 import subprocess
@@ -11,44 +11,58 @@ import click as clk
 import dill
 from concurrent.futures import ProcessPoolExecutor
 from io import FileIO
-from pexpect import run
 
 from itertools import combinations
 
+from triage_cache import TriageCache, build_cached_collect_bugs
+
 T = TypeVar('T')
 
-class Lattice(Generic[T]):
-    def __init__(self, elements: set[T]) -> None:
-        if len(elements) > 14:
-            logger.warning(f'The number of elements is too large {len(elements)}')
-        bottom = frozenset()
-        subsets = {0: {bottom}}
-        predecessors = {bottom: set()}
-        for i in range(1, len(elements) + 1):
-            for pre in subsets[i - 1]:
-                for e in elements:
-                    if e in pre:
-                        continue
-                    new_set = pre.union({e})
-                    if i not in subsets:
-                        subsets[i] = set()
-                    if new_set in subsets[i]:
-                        continue
-                    subsets[i].add(new_set)
-                    pre_predecessors = predecessors[pre]
-                    inc_predecessors  = {new_set: pre_predecessors.union({pre}) for pre in pre_predecessors}
-                    predecessors[new_set] = pre_predecessors.union(inc_predecessors).union({pre})
-        self.elements = elements
-        self.bottom = bottom
-        self.predecessors = predecessors
-        topo_order = []
-        for i in range(1, len(elements) + 1):
-            tmp = list(subsets[i])
-            tmp.sort()
-            topo_order.extend(tmp)
-        self.subsets = topo_order
-    def is_predecessor(self, a: frozenset[T], b: frozenset[T]) -> bool:
-        return a in self.predecessors[b]
+# Attribution of a crash to the injected bugs (FIXREVERTER toggles) behind
+# it. A cause is a minimal set of bugs that crashes the target when only
+# those are enabled; enabling more bugs is assumed never to stop a crash.
+
+def quickxplain(crashes: Callable[[frozenset[T]], bool], candidates: list[T]) -> frozenset[T]:
+    """A minimal subset of candidates that crashes, given that all of them
+    together do. Takes O(k log n) runs for a cause of k out of n bugs."""
+    def qx(base: frozenset[T], has_delta: bool, cands: list[T]) -> frozenset[T]:
+        if has_delta and crashes(base):
+            return frozenset()
+        if len(cands) == 1:
+            return frozenset(cands)
+        mid = len(cands) // 2
+        d2 = qx(base.union(cands[:mid]), True, cands[mid:])
+        d1 = qx(base | d2, len(d2) > 0, cands[:mid])
+        return d1 | d2
+    return qx(frozenset(), False, candidates)
+
+def minimal_causes(elements: set[T], crashes: Callable[[frozenset[T]], bool]) -> list[frozenset[T]]:
+    """All causes among elements. Walks a hitting-set tree: each node
+    excludes some elements; if the rest still crash, the node gets a cause
+    avoiding its exclusions (a known one if possible, else a new one from
+    quickxplain) and one child per element of that cause."""
+    ordered = sorted(elements)
+    causes: list[frozenset[T]] = []
+    # Exclusions that leave nothing crashing; so does any superset of them
+    dead_ends: list[frozenset[T]] = []
+    seen: set[frozenset[T]] = set()
+    stack: list[frozenset[T]] = [frozenset()]
+    while stack:
+        excluded = stack.pop()
+        if excluded in seen or any(d <= excluded for d in dead_ends):
+            continue
+        seen.add(excluded)
+        cause = next((c for c in causes if not c & excluded), None)
+        if cause is None:
+            remaining = [e for e in ordered if e not in excluded]
+            if not remaining or not crashes(frozenset(remaining)):
+                dead_ends.append(excluded)
+                continue
+            cause = quickxplain(crashes, remaining)
+            causes.append(cause)
+        for e in sorted(cause, reverse=True):
+            stack.append(excluded | {e})
+    return causes
 
 logger = logging.getLogger(__file__)
 mailogger = MailLogger.load_from_config(__file__, "/home/appuser/elmfuzz/cli/config.toml", logger)
@@ -105,19 +119,10 @@ def initilize():
     import resource
     resource.setrlimit(resource.RLIMIT_AS, (10 * 1024 * 1024, resource.RLIM_INFINITY))
 
-STDERR_SIZE_LIMIT = 16 * 1024
 def build_collect_bugs(binary: str, filtered_bug_file: str, env: dict[str, str]) -> CollectBugFunction:
     def collect_bugs(test_case: str, only_enable: set[str] | None, timeout=5.0) -> tuple[Literal['CRASH', 'NORMAL', 'TIMEOUT'], set[str], set[str]]:
-        import os
-        import subprocess
-        from datetime import datetime
-        import random
         import copy
-        import tempfile
-        import signal
-        cmd = [
-            binary, test_case
-        ]
+        import replay
         filtered = set()
         nonlocal env
         env = copy.deepcopy(env)
@@ -129,31 +134,9 @@ def build_collect_bugs(binary: str, filtered_bug_file: str, env: dict[str, str])
             env['FIXREVERTER'] = f'on {" ".join(only_enable)}'
         else:
             env['FIXREVERTER'] = f'off {" ".join(filtered)}'
-        proc = subprocess.Popen(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=env, preexec_fn=initilize)
-        try:
-           _, stderr_b = proc.communicate(timeout=timeout)
-           stderr = stderr_b.decode('utf-8')
-        except subprocess.TimeoutExpired as t:
-            assert proc.stderr is not None
-            stderr = proc.stderr.read(STDERR_SIZE_LIMIT).decode('utf-8')
-            os.kill(proc.pid, 9)
-            retcode = 'TIMEOUT'
-        else:
-            if proc.returncode == 0:
-                return 'NORMAL', set(), set()
-            retcode = 'CRASH'
-
-        triggered = set()
-        reached = set()
-        for line in stderr.splitlines():
-            lt = line.strip()
-            if lt.startswith('triggered bug index '):
-                bug = lt.split()[-1]
-                triggered.add(bug)
-            elif lt.startswith('reached bug index '):
-                bug = lt.split()[-1]
-                reached.add(bug)
-        return retcode, triggered, reached
+        # Runs through a warm forkserver per FIXREVERTER setting
+        executor = replay.get_executor(preexec_fn=initilize)
+        return executor.run(binary, env, test_case, timeout)
     return collect_bugs
 
 def build_collect_bugs4python(binary: str, filtered_bug_file: str, env: dict[str, str]) -> CollectBugFunction:
@@ -163,49 +146,19 @@ def build_collect_bugs4python(binary: str, filtered_bug_file: str, env: dict[str
             filtered.add(line.strip())
     def collect_bugs4python(test_case: str, only_enable: set[str] | None, timeout=5.0) -> tuple[Literal['NORMAL', 'CRASH', 'TIMEOUT'], set[str], set[str]]:
         import os
-        import subprocess
-        from datetime import datetime
-        import tempfile
-        import random
-        import copy
-        cmd = [
-            binary, test_case
-        ]
-        old_env = os.environ.copy()
-        nonlocal env
-        env = copy.deepcopy(env)
+        import replay
+        # The interpreter needs the full environment; it is passed to the
+        # child only
+        run_env = dict(os.environ)
+        run_env.update(env)
         if only_enable is not None:
             assert len(only_enable.intersection(filtered)) == 0
-            env['FIXREVERTER'] = f'on {" ".join(only_enable)}'
+            run_env['FIXREVERTER'] = f'on {" ".join(only_enable)}'
         else:
-            env['FIXREVERTER'] = f'off {" ".join(filtered)}'
-        os.environ.update(env)
-        n = datetime.now().strftime('%Y%m%d%H%M%S')
-
-        try:
-            out, r = run(
-                f'{binary} {test_case}', timeout=timeout, env=os.environ, withexitstatus=True
-            )
-        except subprocess.TimeoutExpired as t:
-            retcode = 'TIMEOUT'
-        else:
-            if r == 0:
-                return 'NORMAL', set(), set()
-            retcode = 'CRASH'
-        os.environ.update(old_env)
-        stderr = out.decode('utf-8')
-
-        triggered = set()
-        reached = set()
-        for line in stderr.splitlines():
-            lt = line.strip()
-            if lt.startswith('triggered bug index '):
-                bug = lt.split()[-1]
-                triggered.add(bug)
-            elif lt.startswith('reached bug index '):
-                bug = lt.split()[-1]
-                reached.add(bug)
-        return retcode, triggered, reached
+            run_env['FIXREVERTER'] = f'off {" ".join(filtered)}'
+        # Bug lines may go to stdout or stderr
+        executor = replay.get_executor(merge_output=True)
+        return executor.run(binary, run_env, test_case, timeout)
     return collect_bugs4python
 
 
@@ -232,19 +185,15 @@ def triage_one_batch(test_cases: list[str],
             logger.warning(f'{test_case} does not crash')
             continue
         assert len(triggered) > 0, test_case
-        individual_causes = set()
-        lattice = Lattice(triggered)
-        for subset in lattice.subsets:
-            exclude = False
-            for s in individual_causes:
-                if lattice.is_predecessor(s, subset):
-                    exclude = True
-                    break
-            if exclude:
-                continue
-            crash_or_timeout, _, _ = collect_bugs(test_case, subset, timeout)
-            if crash_or_timeout:
-                individual_causes.add(subset)
+        # Outcome of every toggle configuration tried for this test case
+        outcomes: dict[frozenset[str], bool] = {}
+        def crashes(enabled: frozenset[str]) -> bool:
+            if enabled not in outcomes:
+                crash_or_timeout, _, _ = collect_bugs(test_case, set(enabled), timeout)
+                outcomes[enabled] = crash_or_timeout != 'NORMAL'
+            return outcomes[enabled]
+        individual_causes = minimal_causes(triggered, crashes)
+        logger.debug(f'{test_case}: {len(individual_causes)} causes in {len(outcomes)} runs')
         if len(individual_causes) > 0:
             attempt_result = set()
             for s in individual_causes:
@@ -376,7 +325,8 @@ def build_load_cache(cache_dir: str, pickled_encode_filename: bytes, abnormal_tr
                     result.add(line.strip())
     return __load_cache
 
-def triage(afl_root: str, output_dir, cache_dir: str | None = None, parallel: int = 1, load_cache: bool = False, force_rerun: list[str] = []):
+def triage(afl_root: str, output_dir, cache_dir: str | None = None, parallel: int = 1, load_cache: bool = False, force_rerun: list[str] = [],
+           run_cache: str | None = None):
     if cache_dir is not None:
         os.makedirs(cache_dir, exist_ok=True)
         persist_result = build_persist_result(cache_dir, pickled_encode_filename)
@@ -396,6 +346,8 @@ def triage(afl_root: str, output_dir, cache_dir: str | None = None, parallel: in
             build_collect_bugs(binary, filtered_bug_file, env) if benchmark != 'cpython3'
             else build_collect_bugs4python(binary, filtered_bug_file,env)
         ) if benchmark not in NO_CACHE else None
+        if collect_bugs is not None and run_cache is not None and os.path.exists(binary):
+            collect_bugs = build_cached_collect_bugs(collect_bugs, run_cache, binary, filtered_bug_file)
         # collect_bugs = build_collect_bugs(binary, filtered_bug_file, env)
         for fuzzer in FUZZERS:
             try:
@@ -410,6 +362,9 @@ def triage(afl_root: str, output_dir, cache_dir: str | None = None, parallel: in
                         print(f'Force rerun {benchmark}_{fuzzer}')
                         load_cache_func = None
 
+                if run_cache is not None:
+                    with TriageCache(run_cache) as cache_stats:
+                        hits_before, misses_before = cache_stats.stats()
                 if cache_dir is not None:
                     single_results, result = triage_single_exp(
                         os.path.join(afl_root, f'{benchmark}_{fuzzer}'),
@@ -422,6 +377,10 @@ def triage(afl_root: str, output_dir, cache_dir: str | None = None, parallel: in
                     for k, v in single_results.items():
                         if not isinstance(v, set):
                             abnormals.append((k, v))
+                if run_cache is not None:
+                    with TriageCache(run_cache) as cache_stats:
+                        hits, misses = cache_stats.stats()
+                    print(f'{benchmark}_{fuzzer}: {hits - hits_before} cached runs, {misses - misses_before} executed')
                 output_file = os.path.join(output_dir, f'{benchmark}_{fuzzer}.txt')
                 with open(output_file, 'w') as f:
                     for bugs in result:
@@ -445,7 +404,10 @@ NO_CACHE = set()
 @clk.option('--parallel', '-j', type=int, required=False, default=1)
 @clk.option('--use-cache', '-c', is_flag=True, default=False)
 @clk.option('--force-rerun', type=str, default="")
-def main(afl_root, output, parallel, use_cache, force_rerun):
+@clk.option('--run-cache', type=clk.Path(), default=os.path.join(WORKDIR_ROOT, 'triage_cache.sqlite3'),
+            help='Cache of target runs, shared by all experiments and repetitions')
+@clk.option('--no-run-cache', is_flag=True, default=False)
+def main(afl_root, output, parallel, use_cache, force_rerun, run_cache, no_run_cache):
     force_rerun_list = [token.strip() for token in force_rerun.split(',') if token.strip()]
     if 'NO_CACHE' in os.environ:
         NO_CACHE.update(os.environ['NO_CACHE'].strip(' '))
@@ -454,7 +416,8 @@ def main(afl_root, output, parallel, use_cache, force_rerun):
     cache_dir = os.path.join(output, 'cache')
     if not os.path.exists(cache_dir):
         os.makedirs(cache_dir)
-    triage(afl_root, output, cache_dir, parallel, use_cache, force_rerun=force_rerun_list)
+    triage(afl_root, output, cache_dir, parallel, use_cache, force_rerun=force_rerun_list,
+           run_cache=None if no_run_cache else run_cache)
 
 if __name__=='__main__':
     main()
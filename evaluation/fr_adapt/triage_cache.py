@@ -0,0 +1,141 @@
+# Persistent cache of triage runs.
+#
+# Every run of a target binary during triage (see triage.CollectBugFunction)
+# is recorded under (SHA-256 of the test case, SHA-256 of the binary,
+# FIXREVERTER setting). Runs are shared by all time points, fuzzers,
+# repetitions and re-runs that use the same database, so re-triaging an
+# input that was seen before replays its runs instead of executing them.
+# The database is SQLite in WAL mode; every ProcessPoolExecutor worker opens
+# its own connection, and keeps its hit/miss counts in memory until it exits
+# (at the end of the experiment), so lookups never take the write lock.
+# Timeouts depend on the machine's load and are not cached.
+
+import hashlib
+import multiprocessing.util
+import os
+import sqlite3
+from typing import Callable, Literal
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    test_case TEXT NOT NULL,
+    binary TEXT NOT NULL,
+    config TEXT NOT NULL,
+    status TEXT NOT NULL,
+    triggered TEXT NOT NULL,
+    reached TEXT NOT NULL,
+    PRIMARY KEY (test_case, binary, config)
+);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+'''
+
+RunOutcome = tuple[Literal['CRASH', 'NORMAL', 'TIMEOUT'], set[str], set[str]]
+
+def digest_file(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def fixreverter_config(only_enable: set[str] | None, filtered: set[str]) -> str:
+    """The FIXREVERTER value collect_bugs sets for only_enable (bugs in
+    sorted order, so equal settings give equal keys)"""
+    if only_enable is not None:
+        return f'on {" ".join(sorted(only_enable))}'
+    return f'off {" ".join(sorted(filtered))}'
+
+class TriageCache:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=600)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        self.counts = {'hits': 0, 'misses': 0}
+
+    def close(self) -> None:
+        self.flush_stats()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def flush_stats(self) -> None:
+        """Add the hits and misses counted so far to the database"""
+        if not any(self.counts.values()):
+            return
+        with self.db:
+            self.db.executemany(
+                'INSERT INTO stats (name, count) VALUES (?, ?) '
+                'ON CONFLICT(name) DO UPDATE SET count = count + excluded.count',
+                list(self.counts.items()),
+            )
+        self.counts = {name: 0 for name in self.counts}
+
+    def get(self, test_case: str, binary: str, config: str) -> RunOutcome | None:
+        row = self.db.execute(
+            'SELECT status, triggered, reached FROM runs WHERE test_case = ? AND binary = ? AND config = ?',
+            (test_case, binary, config),
+        ).fetchone()
+        self.counts['hits' if row is not None else 'misses'] += 1
+        if row is None:
+            return None
+        status, triggered, reached = row
+        return status, set(triggered.split()), set(reached.split())
+
+    def put(self, test_case: str, binary: str, config: str, outcome: RunOutcome) -> None:
+        status, triggered, reached = outcome
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO runs (test_case, binary, config, status, triggered, reached) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (test_case, binary, config, status, ' '.join(sorted(triggered)), ' '.join(sorted(reached))),
+            )
+
+    def stats(self) -> tuple[int, int]:
+        """Total (hits, misses) recorded in the database"""
+        counts = dict(self.db.execute('SELECT name, count FROM stats'))
+        return counts.get('hits', 0), counts.get('misses', 0)
+
+# One connection per worker process
+_connections: dict[tuple[int, str], TriageCache] = {}
+
+def open_cache(path: str) -> TriageCache:
+    key = (os.getpid(), path)
+    if key not in _connections:
+        cache = TriageCache(path)
+        # Flushes the counts when the worker process exits
+        multiprocessing.util.Finalize(cache, cache.close, exitpriority=10)
+        _connections[key] = cache
+    return _connections[key]
+
+def build_cached_collect_bugs(collect_bugs: Callable, cache_path: str, binary: str,
+                              filtered_bug_file: str) -> Callable:
+    """Wrap collect_bugs so that runs are looked up in (and added to) the
+    cache at cache_path"""
+    binary_hash = digest_file(binary)
+    filtered = set()
+    with open(filtered_bug_file, 'r') as f:
+        for line in f:
+            filtered.add(line.strip())
+    content_hashes: dict[str, str] = {}
+    def cached_collect_bugs(test_case: str, only_enable: set[str] | None, timeout=5.0) -> RunOutcome:
+        import triage_cache
+        cache = triage_cache.open_cache(cache_path)
+        if test_case not in content_hashes:
+            content_hashes[test_case] = triage_cache.digest_file(test_case)
+        content_hash = content_hashes[test_case]
+        config = triage_cache.fixreverter_config(only_enable, filtered)
+        outcome = cache.get(content_hash, binary_hash, config)
+        if outcome is None:
+            outcome = collect_bugs(test_case, only_enable, timeout)
+            if outcome[0] != 'TIMEOUT':
+                cache.put(content_hash, binary_hash, config, outcome)
+        return outcome
+    return cached_collect_bugs
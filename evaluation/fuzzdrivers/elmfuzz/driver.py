@@ -12,6 +12,7 @@ import shutil
 from datetime import datetime
 import concurrent.futures
 # import multiprocessing
+import numpy as np
 
 
 class RNG(io.BytesIO):
@@ -47,9 +48,40 @@ class SizedWriter(io.BufferedWriter):
 
 logger = logging.getLogger(__file__)
 
+class HitCounts:
+    """Hit counts of every edge, summed over the batch .cov files
+    (afl-showmap "edge:hits" lines). Checkpoints and the summary are saved
+    as .npz files holding the covered edge IDs and their counts."""
+    def __init__(self, map_size: int) -> None:
+        self.counts = np.zeros(map_size, dtype=np.uint64)
+
+    def add(self, edges: np.ndarray, hits: np.ndarray) -> None:
+        if edges.size and edges.max() >= self.counts.size:
+            grown = np.zeros(int(edges.max()) + 1, dtype=np.uint64)
+            grown[:self.counts.size] = self.counts
+            self.counts = grown
+        np.add.at(self.counts, edges, hits)
+
+    def add_showmap(self, path: str) -> None:
+        with open(path, 'rb') as f:
+            pairs = np.array(f.read().replace(b':', b' ').split(), dtype=np.int64).reshape(-1, 2)
+        self.add(pairs[:, 0], pairs[:, 1].astype(np.uint64))
+
+    def save(self, path: str) -> None:
+        edges = np.flatnonzero(self.counts)
+        with open(path, 'wb') as f:
+            np.savez(f, edges=edges.astype(np.uint32), hits=self.counts[edges])
+
+    def write_text(self, path: str) -> None:
+        """Export in the old sum.cov format ("edge:hits" per line)"""
+        edges = np.flatnonzero(self.counts)
+        with open(path, 'w') as f:
+            f.writelines(f'{edge:06}:{hit}\n' for edge, hit in zip(edges.tolist(), self.counts[edges].tolist()))
+
 g_size_limit = 1024
 
-def wrapper(module_names: list[str], function: str, outdir: str, num: int, callback: str | None) -> int:
+def wrapper(module_names: list[str], function: str, outdir: str, num: int, callback: str | None,
+            deadline: float | None = None) -> int:
     rng = RNG(random.Random())
     modules = []
     
@@ -62,6 +94,8 @@ def wrapper(module_names: list[str], function: str, outdir: str, num: int, callb
     
     error_count = 0
     for i in range(num):
+        if deadline is not None and time.time() > deadline:
+            break
         f_module = random.choice(modules)
         fuzzer = getattr(f_module, function)
         with open(os.path.join(outdir, f'{i}.seed'), 'wb') as f:
@@ -85,6 +119,8 @@ class MyTmpDir(TemporaryDirectory):
 import time
 import threading
 import signal
+import select
+import struct
 def start_process_to_terminate_when_parent_process_dies(ppid):
     pid = os.getpid()
 
@@ -99,6 +135,136 @@ def start_process_to_terminate_when_parent_process_dies(ppid):
     thread = threading.Thread(target=f, daemon=True)
     thread.start()
 
+def stash_batch(td: str, out_dir: str, working_dir: str, target_name: str, i: int) -> None:
+    try:
+        shutil.move(os.path.join(td, f'{i}'), os.path.join(out_dir, f'{i}'))
+    except:
+        pass
+    if target_name == 'libxml2':
+        logger.debug('Remove an extra tmp dir for libxml2')
+        tmp_dir = os.path.join(working_dir, f'{i}-tmp')
+        try:
+            shutil.move(tmp_dir, os.path.join(out_dir, f'{i}-tmp'))
+        except:
+            pass
+
+# Time a batch gets past its deadline to finish the test case in progress
+BATCH_GRACE = 1.0
+
+def run_batch(module_names: list[str], function: str, outdir: str, num: int, callback: str | None,
+              deadline: float) -> tuple[int, bool]:
+    """wrapper() in a forked child, killed if it is still running shortly
+    after the deadline (a hanging generator never gets back to the deadline
+    check). Returns (error count, whether the batch was cut off)."""
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        status = 1
+        try:
+            error_count = wrapper(module_names, function, outdir, num, callback, deadline)
+            os.write(w, struct.pack('<I', error_count))
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(w)
+    try:
+        ready, _, _ = select.select([r], [], [], max(0.0, deadline + BATCH_GRACE - time.time()))
+        if not ready:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            return 0, True
+        data = os.read(r, 4)
+    finally:
+        os.close(r)
+    _, status = os.waitpid(pid, 0)
+    if len(data) != 4:
+        raise RuntimeError(f'Batch process for {outdir} died (status {status})')
+    return struct.unpack('<I', data)[0], False
+
+def run_pipelined(fuzzer_module_names, function, callback, cov_module, working_dir, td, out_dir, target_name,
+                  num, time_limit, batch_size, batch_timeout, check_point, gen_workers, cov_workers,
+                  queue_size, showmap_path, race_mode, hit_counts: HitCounts) -> tuple[int, float]:
+    """Generate batches on gen_workers processes while cov_workers threads
+    measure the finished ones. At most queue_size batches wait for (or are
+    in) coverage; generation pauses beyond that. The time limit is wall
+    clock time over all workers. Returns (test cases, seconds taken)."""
+    start_time = time.time()
+    deadline = start_time + time_limit if time_limit > 0 else None
+    left = num if num > 0 else (2 ** 32 - 1)
+    count = 0
+    next_batch = 0
+    last_checkpoint = 0
+    generating: dict[concurrent.futures.Future, int] = {}
+    batch_deadlines: dict[concurrent.futures.Future, float] = {}
+    covering: dict[concurrent.futures.Future, int] = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=gen_workers) as gen_pool, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=cov_workers) as cov_pool:
+        while True:
+            while (left > 0 and len(generating) < gen_workers and len(covering) < queue_size
+                   and (deadline is None or time.time() < deadline)):
+                current = min(left, batch_size)
+                if num > 0:
+                    left -= current
+                batch_dir = os.path.join(td, f'{next_batch}')
+                os.makedirs(batch_dir)
+                timeout = current * 0.5 if batch_timeout < 0 else batch_timeout
+                batch_deadline = time.time() + timeout
+                if deadline is not None:
+                    batch_deadline = min(batch_deadline, deadline)
+                logger.info(f'Batch {next_batch} fuzzing {current} seeds')
+                future = gen_pool.submit(run_batch, fuzzer_module_names, function, batch_dir, current, callback,
+                                         batch_deadline)
+                generating[future] = next_batch
+                batch_deadlines[future] = batch_deadline
+                next_batch += 1
+            if not generating and not covering:
+                break
+            # Batches are killed at their deadline, so waking up then is enough
+            wait_timeout = None
+            if generating:
+                wait_timeout = max(0.0, min(batch_deadlines[f] for f in generating) + BATCH_GRACE - time.time()) + 1.0
+            done, _ = concurrent.futures.wait(
+                list(generating) + list(covering), timeout=wait_timeout,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future in generating:
+                    i = generating.pop(future)
+                    del batch_deadlines[future]
+                    try:
+                        error_count, timed_out = future.result()
+                        if error_count > 0:
+                            logger.debug(f'Batch {i} has {error_count} errors')
+                        if timed_out:
+                            logger.warning(f'Batch {i} timeout')
+                    except Exception as e:
+                        logger.debug(f'Batch {i} error: {e}')
+                    batch_count = len(os.listdir(os.path.join(td, f'{i}')))
+                    logger.info(f'Batch {i} finished with {batch_count} seeds')
+                    count += batch_count
+                    if race_mode:
+                        stash_batch(td, out_dir, working_dir, target_name, i)
+                    else:
+                        covering[cov_pool.submit(cov_module.get_cov_conc, working_dir, td, td, 1, 1, i,
+                                                 showmap_path)] = i
+                else:
+                    i = covering.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error(f'Err: {e}')
+                    try:
+                        hit_counts.add_showmap(os.path.join(td, f'{i}.cov'))
+                    except Exception as e:
+                        logger.debug(f'Error in batch {i}: {e}')
+                    stash_batch(td, out_dir, working_dir, target_name, i)
+            elapsed = time.time() - start_time
+            if check_point > 0 and not race_mode and elapsed - last_checkpoint > check_point:
+                logger.info(f'Save checkpoint ({count} test cases in {elapsed:.0f} seconds)')
+                hit_counts.save(os.path.join(working_dir, f'cp_{int(elapsed)}.npz'))
+                last_checkpoint = elapsed
+    return count, time.time() - start_time
+
 @clk.command()
 @clk.option('--function', '-g', type=str, required=True)
 @clk.option('--working-dir', '-d', type=clk.Path(exists=True, file_okay=False, dir_okay=True), required=False, default='.')
@@ -115,9 +281,21 @@ def start_process_to_terminate_when_parent_process_dies(ppid):
 @clk.option('--stat-file', '-sf', type=clk.File('w'), required=False, default='-')
 @clk.option('--batch-timeout', '-q', type=int, required=False, default=-1)
 @clk.option('--check-point', '-c', type=int, required=False, default=-1)
+@clk.option('--map-size', type=int, required=False, default=2097152, help="Initial size of the hit-count map")
+@clk.option('--text-cov', is_flag=True, required=False, default=False,
+            help="Also write the summary as text (sum.cov) next to sum.npz")
+@clk.option('--pipelined', '-p', is_flag=True, required=False, default=False,
+            help="Generate on several processes while finished batches are measured")
+@clk.option('--gen-workers', '-w', type=int, required=False, default=os.cpu_count(),
+            help="Generator processes (with --pipelined)")
+@clk.option('--cov-workers', type=int, required=False, default=-1,
+            help="Concurrent coverage batches (with --pipelined; default: --para-num)")
+@clk.option('--queue-size', type=int, required=False, default=-1,
+            help="Finished batches that may wait for coverage (with --pipelined; default: 2 * --cov-workers)")
 def main(function, working_dir, num, time_limit, force, batch_size, para_num, 
          afl_dir, callback, debug_level, size_limit, race_mode, stat_file, 
-         batch_timeout, check_point):
+         batch_timeout, check_point, map_size, text_cov, pipelined, gen_workers, cov_workers,
+         queue_size):
     
     target_name = os.path.basename(working_dir).split('_')[0]
     out_dir = os.path.join(working_dir, 'out')
@@ -137,7 +315,8 @@ def main(function, working_dir, num, time_limit, force, batch_size, para_num,
     g_size_limit = size_limit
 
     overall_start_time = datetime.now()
-    if not force and os.path.exists(os.path.join(working_dir, 'sum.cov')):
+    if not force and (os.path.exists(os.path.join(working_dir, 'sum.npz'))
+                      or os.path.exists(os.path.join(working_dir, 'sum.cov'))):
         logger.warning('Coverage file already exists. Add --force to overwrite it.')
         return
     sys.path.insert(0, working_dir)
@@ -153,6 +332,25 @@ def main(function, working_dir, num, time_limit, force, batch_size, para_num,
     assert cov_module is not None
     if hasattr(cov_module, 'm_batch_size'):
         cov_module.m_batch_size = batch_size
+
+    if pipelined:
+        cov_workers = para_num if cov_workers <= 0 else cov_workers
+        queue_size = 2 * cov_workers if queue_size <= 0 else queue_size
+        with MyTmpDir() as td:
+            hit_counts = HitCounts(map_size)
+            count, time_sum = run_pipelined(
+                fuzzer_module_names, function, callback, cov_module, working_dir, td, out_dir, target_name,
+                num, time_limit, batch_size, batch_timeout, check_point, gen_workers, cov_workers,
+                queue_size, os.path.join(afl_dir, 'afl-showmap'), race_mode, hit_counts,
+            )
+            if not race_mode:
+                hit_counts.save(os.path.join(working_dir, 'sum.npz'))
+                if text_cov:
+                    hit_counts.write_text(os.path.join(working_dir, 'sum.cov'))
+        logger.info('Done')
+        stat_file.write(f'{count} test cases in {time_sum} seconds\n')
+        sys.path.pop(0)
+        return
     
     with MyTmpDir() as td, RNG(random.Random()) as rng, \
          concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
@@ -166,6 +364,18 @@ def main(function, working_dir, num, time_limit, force, batch_size, para_num,
         last_checkpoint = 0
         last_checkpoint_batch = 0
         time_sum = 0
+        # Coverage of batches 0 .. merged_batch - 1
+        hit_counts = HitCounts(map_size)
+        merged_batch = 0
+        def merge_batches(end):
+            nonlocal merged_batch
+            for i in range(merged_batch, end):
+                try:
+                    hit_counts.add_showmap(os.path.join(td, f'{i}.cov'))
+                except Exception as e:
+                    logger.debug(f'Error in batch {i}: {e}')
+            logger.debug(f'Merged batches {merged_batch} .. {end - 1}')
+            merged_batch = end
         while left > 0:
             elapsed_time = (datetime.now() - overall_start_time)
             logger.info(f'Total elapsed time: {elapsed_time}')
@@ -178,73 +388,42 @@ def main(function, working_dir, num, time_limit, force, batch_size, para_num,
             
             if check_point > 0 and time_sum - last_checkpoint > check_point:
                 logger.info('Save checkpoint')
-                with open(os.path.join(working_dir, f'cp_{time_sum}.cov'), 'w') as cp_f:
-                    edge_count = {}
-                    
-                    if last_checkpoint > 0:
-                        with open(os.path.join(working_dir, f'cp_{last_checkpoint}.cov'), 'r') as last_cp_f:
-                            logger.debug(f'Load checkpoint {last_checkpoint}')
-                            for l in last_cp_f:
-                                (edge, hit) = l.strip().split(':')
-                                edge_count[edge] = int(hit)
-                    
-                    ###################
-                    not_evaled = []
-                    for i in range(last_checkpoint_batch, batch):
-                        if not os.path.exists(os.path.join(td, f'{i}.cov')):
-                            logger.warning(f'Batch {i} evaled')
-                            not_evaled.append(i)
-                    
-                    if not_evaled:
-                        start = not_evaled[0]
-                        end = not_evaled[-1]
-                        if not end + 1 - start == len(not_evaled):
-                            logger.warning(f'Not evaled may have problem: {not_evaled}')
-                        logger.debug('Getting coverage')
-                        if not race_mode:
-                            try:
-                                cov_module.get_cov_conc(working_dir, td, td, len(not_evaled), len(not_evaled), start, os.path.join(afl_dir, 'afl-showmap'))
-                            except Exception as e:
-                                logger.debug(f'Err: {e}')
-                        for i in not_evaled:
-                            batch_dir = os.path.join(td, f'{i}')
+                ###################
+                not_evaled = []
+                for i in range(last_checkpoint_batch, batch):
+                    if not os.path.exists(os.path.join(td, f'{i}.cov')):
+                        logger.warning(f'Batch {i} evaled')
+                        not_evaled.append(i)
+                
+                if not_evaled:
+                    start = not_evaled[0]
+                    end = not_evaled[-1]
+                    if not end + 1 - start == len(not_evaled):
+                        logger.warning(f'Not evaled may have problem: {not_evaled}')
+                    logger.debug('Getting coverage')
+                    if not race_mode:
+                        try:
+                            cov_module.get_cov_conc(working_dir, td, td, len(not_evaled), len(not_evaled), start, os.path.join(afl_dir, 'afl-showmap'))
+                        except Exception as e:
+                            logger.debug(f'Err: {e}')
+                    for i in not_evaled:
+                        batch_dir = os.path.join(td, f'{i}')
+                        try:
+                            shutil.move(batch_dir, os.path.join(out_dir, f'{i}'))
+                        except:
+                            pass
+                        if target_name == 'libxml2':
+                            logger.debug('Remove an extra tmp dir for libxml2')
+                            tmp_dir = os.path.join(working_dir, f'{i}-tmp')
                             try:
-                                shutil.move(batch_dir, os.path.join(out_dir, f'{i}'))
+                                shutil.move(tmp_dir, os.path.join(out_dir, f'{i}-tmp'))
                             except:
                                 pass
-                            if target_name == 'libxml2':
-                                logger.debug('Remove an extra tmp dir for libxml2')
-                                tmp_dir = os.path.join(working_dir, f'{i}-tmp')
-                                try:
-                                    shutil.move(tmp_dir, os.path.join(out_dir, f'{i}-tmp'))
-                                except:
-                                    pass
-                        batch_acc =0 
-                        batch_record = batch
-                    ###################
-                        
-                    
-                    for i in range(last_checkpoint_batch, batch):
-                        logger.debug(f'Merging batch {i} / {batch - 1}')
-                        try:
-                            with open(os.path.join(td, f'{i}.cov'), 'r') as batch_cov:
-                                total_lines = sum(1 for _ in batch_cov)
-                                batch_cov.seek(0)
-                                for ii, l in enumerate(batch_cov):
-                                    logger.debug(f'Merging batch {ii + 1}/{total_lines} (in batch {i})')
-                                    (edge, hit) = l.strip().split(':')
-                                    if edge in edge_count:
-                                        edge_count[edge] += int(hit)
-                                    else:
-                                        edge_count[edge] = int(hit)
-                        except Exception as e:
-                            logger.debug(f'Error in batch {i}: {e}')
-                    logger.debug(f'Writing to checkpoint {time_sum}.cov')
-                    total_items = len(edge_count)
-                    for i, (edge, hit) in enumerate(edge_count.items()):
-                        logger.debug(f'Writing edge {i + 1}/{total_items}')
-                        cp_f.write(f'{edge}:{hit}\n')
-                
+                    batch_acc =0 
+                    batch_record = batch
+                ###################
+                merge_batches(batch)
+                hit_counts.save(os.path.join(working_dir, f'cp_{time_sum}.npz'))
                 last_checkpoint_batch = batch
                 last_checkpoint = time_sum
             
@@ -325,39 +504,10 @@ def main(function, working_dir, num, time_limit, force, batch_size, para_num,
     
         logger.info('Merging coverage files')
         if not race_mode:
-            with open(os.path.join(td, 'sum.cov'), 'w') as f:
-                edge_count = {}
-                start = 0
-                if check_point > 0:
-                    start = last_checkpoint_batch
-                    if last_checkpoint > 0:
-                        with open(os.path.join(working_dir, f'cp_{last_checkpoint}.cov'), 'r') as last_cp_f:
-                            logger.debug(f'Load checkpoint {last_checkpoint}')
-                            for l in last_cp_f:
-                                (edge, hit) = l.strip().split(':')
-                                edge_count[edge] = int(hit)
-                
-                for i in range(start, batch):
-                    logger.debug(f'Merging batch {i} / {batch - 1}')
-                    try:
-                        with open(os.path.join(td, f'{i}.cov'), 'r') as batch_cov:
-                            total_lines = sum(1 for _ in batch_cov)
-                            batch_cov.seek(0)
-                            for ii, l in enumerate(batch_cov):
-                                logger.debug(f'Merging batch {ii + 1}/{total_lines} (in batch {i})')
-                                (edge, hit) = l.strip().split(':')
-                                if edge in edge_count:
-                                    edge_count[edge] += int(hit)
-                                else:
-                                    edge_count[edge] = int(hit)
-                    except Exception as e:
-                        logger.error(f'Error in batch {i}: {e}')
-                logger.debug('Writing to sum.cov')
-                total_items = len(edge_count)
-                for i, (edge, hit) in enumerate(edge_count.items()):
-                    logger.debug(f'Writing edge {i + 1}/{total_items}')
-                    f.write(f'{edge}:{hit}\n')
-            shutil.copy(os.path.join(td, 'sum.cov'), os.path.join(working_dir, 'sum.cov'))
+            merge_batches(batch)
+            hit_counts.save(os.path.join(working_dir, 'sum.npz'))
+            if text_cov:
+                hit_counts.write_text(os.path.join(working_dir, 'sum.cov'))
         executor.shutdown(wait=False)
     logger.info('Done')
     stat_file.write(f'{count} test cases in {time_sum} seconds\n')
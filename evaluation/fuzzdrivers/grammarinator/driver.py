@@ -11,8 +11,9 @@ from tempfile import TemporaryDirectory
 import shutil
 from datetime import datetime
 import concurrent.futures
-import subprocess
+import time
 # import multiprocessing
+from grammarinator.tool import DefaultGeneratorFactory, GeneratorTool
 
 
 class RNG(io.BytesIO):
@@ -50,26 +51,63 @@ logger = logging.getLogger(__file__)
 
 g_size_limit = 1024
 
-def wrapper(workdir: str, generator: str, outdir: str, num: int, timeout: int) -> int:
-    MAX_DEPTH = 10
-    cmd = [
-        'grammarinator-generate',
-        '-o', f'{outdir}/%d.seed',
-        '-d', str(MAX_DEPTH),
-        '-j', '1',
-        '--sys-path', workdir,
-        '-n', str(num),
-        generator,
-    ]
-    subprocess.run(cmd, check=True, stderr=sys.stderr, stdout=sys.stdout, timeout=timeout)
-    return 0
+MAX_DEPTH = 10
+
+# Each generator worker loads the generator class once, into these
+g_tool: GeneratorTool | None = None
+g_preprocess = None
+
+def init_worker(generator: str, callback: str | None) -> None:
+    """generator is in module.Class format, as for grammarinator-generate"""
+    global g_tool, g_preprocess
+    # DefaultModel draws from the global random module, which every forked
+    # worker would otherwise share the state of
+    random.seed()
+    module_name, class_name = generator.rsplit('.', 1)
+    generator_class = getattr(importlib.import_module(module_name), class_name)
+    # The settings of grammarinator-generate -d MAX_DEPTH, without saving
+    g_tool = GeneratorTool(generator_factory=DefaultGeneratorFactory(generator_class),
+                           out_format='', max_depth=MAX_DEPTH, cleanup=False)
+    if callback is not None:
+        g_preprocess = getattr(importlib.import_module(callback), 'preprocess', None)
+
+def wrapper(outdir: str, start: int, num: int, deadline: float | None) -> int:
+    """Write {start}.seed to {start + num - 1}.seed in outdir, with the
+    callback's prefix, stopping at the deadline. Returns the number of
+    failed test cases."""
+    error_count = 0
+    with RNG(random.Random()) as rng:
+        for i in range(start, start + num):
+            if deadline is not None and time.time() > deadline:
+                break
+            path = os.path.join(outdir, f'{i}.seed')
+            try:
+                test = str(g_tool.generate())
+                with open(path, 'wb') as out:
+                    if g_preprocess is not None:
+                        g_preprocess(rng, out)
+                    out.write(test.encode('utf-8'))
+            except Exception as e:
+                logger.debug(f'Error in {path}: {e}')
+                error_count += 1
+    return error_count
+
+def split_batch(num: int, workers: int) -> list[tuple[int, int]]:
+    """(start, count) of each worker's share of a batch"""
+    shares = []
+    start = 0
+    for w in range(workers):
+        count = num // workers + (1 if w < num % workers else 0)
+        if count > 0:
+            shares.append((start, count))
+        start += count
+    return shares
 
 class MyTmpDir(TemporaryDirectory):
     def __init__(self) -> None:
         super().__init__(ignore_cleanup_errors=True)
         self._rmtree = shutil.rmtree
 
-import time
 import threading
 import signal
 def start_process_to_terminate_when_parent_process_dies(ppid):
@@ -86,38 +124,6 @@ def start_process_to_terminate_when_parent_process_dies(ppid):
     thread = threading.Thread(target=f, daemon=True)
     thread.start()
 
-# prepend, actually
-def append_metadata(callback: str, batch_dir: str):
-    cb_module = importlib.import_module(callback)
-    preprocess = getattr(cb_module, 'preprocess')
-    if preprocess is None:
-        return
-    seeds = os.listdir(batch_dir)
-    with RNG(random.Random()) as rng:
-        for seed in seeds:
-            with open(os.path.join(batch_dir, seed), 'rb') as f:
-                bytes = f.read()
-            with open(os.path.join(batch_dir, seed), 'wb') as f:
-                preprocess(rng, f)
-                f.write(bytes)
-
-def append_metadata_conc(callback: str | None, 
-                    batches_start: int, 
-                    batches_num: int, 
-                    batches_root: str, 
-                    paranum: int):
-    if callback is None:
-        return
-    with concurrent.futures.ProcessPoolExecutor(max_workers=paranum) as executor:
-        futures = []
-        for i in range(batches_num):
-            batch_dir = os.path.join(batches_root, f'{i+batches_start}')
-            future = executor.submit(append_metadata, callback, batch_dir)
-            futures.append(future)
-        for future in concurrent.futures.as_completed(futures):
-            future.result()
-        executor.shutdown(wait=False)
-
 @clk.command()
 @clk.option('--generator', '-g', type=str, required=True)
 @clk.option('--working-dir', '-d', type=clk.Path(exists=True, file_okay=False, dir_okay=True), required=False, default='.')
@@ -132,8 +138,10 @@ def append_metadata_conc(callback: str | None,
 @clk.option('--race-mode', '-r', is_flag=True, required=False, default=False)
 @clk.option('--stat-file', '-sf', type=clk.File('w'), required=False, default='-')
 @clk.option('--check-point', '-c', type=int, required=False, default=-1)
+@clk.option('--gen-workers', '-w', type=int, required=False, default=1,
+            help="Generator processes; each batch is spread over them")
 def main(generator, working_dir, num, time_limit, force, batch_size, para_num, 
-         afl_dir, callback, debug_level, race_mode, stat_file, check_point):
+         afl_dir, callback, debug_level, race_mode, stat_file, check_point, gen_workers):
     target_name = os.path.basename(working_dir).split('_')[0]
     out_dir = os.path.join(working_dir, 'out')
     if race_mode:
@@ -161,8 +169,9 @@ def main(generator, working_dir, num, time_limit, force, batch_size, para_num,
     if hasattr(cov_module, 'm_batch_size'):
         cov_module.m_batch_size = batch_size
     
-    with MyTmpDir() as td, RNG(random.Random()) as rng, \
-         concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+    with MyTmpDir() as td, \
+         concurrent.futures.ProcessPoolExecutor(max_workers=gen_workers, initializer=init_worker,
+                                                initargs=(generator, callback)) as executor:
         count = 0
         batch = 0
         left = num if num > 0 else (2 ** 32 - 1)
@@ -260,13 +269,15 @@ def main(generator, working_dir, num, time_limit, force, batch_size, para_num,
             
             logger.info(f'Batch {batch} fuzzing {current} seeds')
             start_time = datetime.now()
-            try:
-                batch_timeout = current * 0.5
-                error_count = wrapper(working_dir, generator, batch_dir, current, batch_timeout)
-            except subprocess.TimeoutExpired:
+            deadline = time.time() + current * 0.5
+            futures = [executor.submit(wrapper, batch_dir, share_start, share_num, deadline)
+                       for share_start, share_num in split_batch(current, gen_workers)]
+            error_count = sum(future.result() for future in futures)
+            if error_count > 0:
+                logger.debug(f'Batch {batch} has {error_count} errors')
+            if time.time() > deadline:
                 logger.warning(f'Batch {batch} timeout')
             end_time = datetime.now()
-            assert error_count == 0
             batch_count = len(os.listdir(batch_dir))
             logger.info(f'Batch {batch} finished with {batch_count} seeds')
             batch += 1
@@ -275,9 +286,6 @@ def main(generator, working_dir, num, time_limit, force, batch_size, para_num,
             
             batch_acc += 1 
             if batch_acc >= para_num:
-                logger.info('Appending metadata')
-                if not race_mode:
-                    append_metadata_conc(callback, batch_record, batch_acc, td, para_num)
                 logger.info('Getting coverage')
                 if not race_mode:
                     cov_module.get_cov_conc(working_dir, td, td, para_num, batch_acc, batch_record, os.path.join(afl_dir, 'afl-showmap'))
@@ -298,9 +306,6 @@ def main(generator, working_dir, num, time_limit, force, batch_size, para_num,
                 batch_record = batch
         
         if batch_acc > 0:
-            logger.info('Appending metadata')
-            if not race_mode:
-                append_metadata_conc(callback, batch_record, batch_acc, td, para_num)
             logger.info('Getting coverage')
             if not race_mode:
                 cov_module.get_cov_conc(working_dir, td, td, para_num, batch_acc, batch_record, os.path.join(afl_dir, 'afl-showmap'))
@@ -13,6 +13,9 @@ import shutil
 from datetime import datetime
 import concurrent.futures
 import subprocess
+import select
+import signal
+import time
 # import multiprocessing
 import dill as pickle
 from isla.solver import ISLaSolver
@@ -53,25 +56,74 @@ logger = logging.getLogger(__file__)
 
 g_size_limit = 1024
 
-def solve_single(pickled_solver: bytes) -> str:
-    # We must re-construct the initial solver, since ISLaSolver is stateful, and
-    # it refuse to generate more solutions after some of them.
-    solver : ISLaSolver = pickle.loads(pickled_solver)
-    return str(solver.solve())
+# Each generator worker unpickles the solver once, into these
+g_solver: ISLaSolver | None = None
+g_preprocess = None
 
-def wrapper(pickled_solver: bytes, outdir: str, num: int, callback: str | None) -> int:
+def init_worker(pickled_solver: bytes, callback: str | None) -> None:
+    global g_solver, g_preprocess
+    g_solver = pickle.loads(pickled_solver)
     if callback is not None:
-        cb_module = importlib.import_module(callback)
-        preprocess = cb_module.preprocess
-    with RNG(random.Random()) as rng:
-        for i in range(num):
-            logger.info(f'Generating {i}.seed ({num}) in {os.path.basename(outdir)}')
-            solution = solve_single(pickled_solver)
-            with open(os.path.join(outdir, f'{i}.seed'), 'wb') as out:
-                if callback is not None:
-                    preprocess(rng, out)
-                out.write(solution.encode('utf-8'))
-    return 0
+        g_preprocess = importlib.import_module(callback).preprocess
+
+def solve_forked(path: str, deadline: float | None) -> bool:
+    """Write one solution to path. ISLaSolver is stateful, and it refuses to
+    generate more solutions after some of them, so every solution is solved
+    in a forked copy of the worker: the child starts from the initial solver
+    and its state is thrown away with it. Returns whether it succeeded."""
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            # Otherwise every child would repeat the same random choices
+            random.seed()
+            rng = RNG(random.Random())
+            with open(path, 'wb') as out:
+                if g_preprocess is not None:
+                    g_preprocess(rng, out)
+                out.write(str(g_solver.solve()).encode('utf-8'))
+            status = 0
+        finally:
+            os._exit(status)
+    if deadline is not None:
+        pidfd = os.pidfd_open(pid)
+        try:
+            ready, _, _ = select.select([pidfd], [], [], max(0.0, deadline - time.time()))
+        finally:
+            os.close(pidfd)
+        if not ready:
+            os.kill(pid, signal.SIGKILL)
+    _, status = os.waitpid(pid, 0)
+    if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+        return True
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return False
+
+def wrapper(outdir: str, start: int, num: int, deadline: float | None) -> int:
+    """Write {start}.seed to {start + num - 1}.seed in outdir, stopping at
+    the deadline. Returns the number of failed solutions."""
+    error_count = 0
+    for i in range(start, start + num):
+        if deadline is not None and time.time() > deadline:
+            break
+        logger.info(f'Generating {i}.seed ({num}) in {os.path.basename(outdir)}')
+        if not solve_forked(os.path.join(outdir, f'{i}.seed'), deadline):
+            error_count += 1
+    return error_count
+
+def split_batch(num: int, workers: int) -> list[tuple[int, int]]:
+    """(start, count) of each worker's share of a batch"""
+    shares = []
+    start = 0
+    for w in range(workers):
+        count = num // workers + (1 if w < num % workers else 0)
+        if count > 0:
+            shares.append((start, count))
+        start += count
+    return shares
 
 class MyTmpDir(TemporaryDirectory):
     def __init__(self) -> None:
@@ -94,9 +146,11 @@ class MyTmpDir(TemporaryDirectory):
 @clk.option('--race-mode', '-r', is_flag=True, required=False, default=False)
 @clk.option('--stat-file', '-sf', type=clk.File('w'), required=False, default='-')
 @clk.option('--check-point', '-c', type=int, required=False, default=-1)
+@clk.option('--gen-workers', '-w', type=int, required=False, default=1,
+            help="Solver processes; each batch is spread over them")
 def main(working_dir, num, time_limit, force, batch_size, para_num, 
          afl_dir, callback, debug_level, batch_timeout, use_semantics,
-         race_mode, stat_file, check_point):
+         race_mode, stat_file, check_point, gen_workers):
     target_name = os.path.basename(working_dir).split('_')[0]
     out_dir = os.path.join(working_dir, 'out')
     if race_mode:
@@ -136,8 +190,9 @@ def main(working_dir, num, time_limit, force, batch_size, para_num,
         solver = ISLaSolver(grammar)
     picked_solver = pickle.dumps(solver)
     
-    with MyTmpDir() as td, RNG(random.Random()) as rng, \
-         concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+    with MyTmpDir() as td, \
+         concurrent.futures.ProcessPoolExecutor(max_workers=gen_workers, initializer=init_worker,
+                                                initargs=(picked_solver, callback)) as executor:
         count = 0
         batch = 0
         left = num if num > 0 else (2 ** 32 - 1)
@@ -233,12 +288,15 @@ def main(working_dir, num, time_limit, force, batch_size, para_num,
             
             logger.info(f'Batch {batch} fuzzing {current} seeds')
             start_time = datetime.now()
-            future = executor.submit(wrapper, picked_solver, batch_dir, current, callback)
-            try:
-                batch_timeout1 = current * 0.5 if batch_timeout is None else batch_timeout
-                error_count = future.result(batch_timeout1)
-                assert error_count == 0
-            except concurrent.futures.TimeoutError:
+            batch_timeout1 = current * 0.5 if batch_timeout is None else batch_timeout
+            deadline = time.time() + batch_timeout1
+            futures = [executor.submit(wrapper, batch_dir, share_start, share_num, deadline)
+                       for share_start, share_num in split_batch(current, gen_workers)]
+            # The workers stop (and kill a running solution) at the deadline
+            error_count = sum(future.result() for future in futures)
+            if error_count > 0:
+                logger.debug(f'Batch {batch} has {error_count} errors')
+            if time.time() > deadline:
                 logger.warning(f'Batch {batch} timeout')
             end_time = datetime.now()
             batch_count = len(os.listdir(batch_dir))
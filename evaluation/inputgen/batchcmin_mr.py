@@ -10,6 +10,7 @@ import os.path
 import sys
 import subprocess
 import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 
 logger = logging.getLogger(__file__)
@@ -125,6 +126,95 @@ def process_batch_librsvg(binary: str, env: dict[str, str], root_dir: str, move_
         return [os.path.join(batch_output_dir, f) for f in os.listdir(batch_output_dir)]
     return __process
 
+def collect_traces(benchmark: str, batch_dir: str, trace_dir: str, timeout: int) -> None:
+    """One afl-showmap run over every input in batch_dir, leaving a trace
+    (edge:bucket lines) per input in trace_dir"""
+    binary = BINARIES[benchmark]
+    if benchmark != 'librsvg':
+        cmd = ['afl-showmap', '-i', batch_dir, '-o', trace_dir, '-t', str(timeout), '--', binary, '@@']
+    else:
+        cmd = ['cargo', 'afl', 'showmap', '-i', batch_dir, '-o', trace_dir, '-t', str(timeout), '--', binary]
+    # Keep the traces of crashing and hanging inputs, as `afl-cmin -A` does
+    env = {**os.environ, **ENV[benchmark], 'AFL_CMIN_ALLOW_ANY': '1'}
+    try:
+        subprocess.run(cmd, check=True, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except Exception as e:
+        logger.warning(f'afl-showmap exception: {e}')
+
+def greedy_cover(traces: dict[str, list[int]], sizes: dict[str, int]) -> list[str]:
+    """afl-cmin's selection over stored traces: every tuple is assigned the
+    smallest file that has it, and tuples are visited from the rarest up;
+    a tuple not covered yet brings in its file and everything that file
+    covers."""
+    best: dict[int, str] = {}
+    counts: dict[int, int] = {}
+    for f in sorted(traces, key=lambda f: (sizes[f], f)):
+        for t in traces[f]:
+            if t not in best:
+                best[t] = f
+                counts[t] = 1
+            else:
+                counts[t] += 1
+    covered: set[int] = set()
+    selected = []
+    for t in sorted(counts, key=lambda t: (counts[t], t)):
+        if t in covered:
+            continue
+        f = best[t]
+        selected.append(f)
+        covered.update(traces[f])
+    return selected
+
+def process_single_pass(benchmark: str, seed_files: list[str], root: str, output: str, progress: tqdm,
+                        batch_size: int, para_num: int = 30, timeout: int = 5000,
+                        move_instead_of_copy=False) -> list[str]:
+    """Minimize seed_files with one coverage sweep: the inputs are traced
+    once (batch_size per afl-showmap run, para_num runs at a time), the
+    traces are kept as tuple ids, and the cover is solved in memory. The
+    selected files are put in output."""
+    batches = [seed_files[i:i + batch_size] for i in range(0, len(seed_files), batch_size)]
+    tuple_ids: dict[str, int] = {}
+    traces: dict[str, list[int]] = {}
+    sizes: dict[str, int] = {}
+
+    def trace_batch(i: int, batch: list[str]) -> tuple[str, str]:
+        batch_dir = os.path.join(root, f'in{i}')
+        trace_dir = os.path.join(root, f'trace{i}')
+        os.makedirs(batch_dir, exist_ok=True)
+        os.makedirs(trace_dir, exist_ok=True)
+        for seed_file in batch:
+            if move_instead_of_copy:
+                shutil.move(seed_file, batch_dir)
+            else:
+                shutil.copy(seed_file, batch_dir)
+        collect_traces(benchmark, batch_dir, trace_dir, timeout)
+        return batch_dir, trace_dir
+
+    with ThreadPoolExecutor(max_workers=para_num) as executor:
+        futures = {executor.submit(trace_batch, i, batch): batch for i, batch in enumerate(batches)}
+        for future in as_completed(futures):
+            batch_dir, trace_dir = future.result()
+            for name in os.listdir(batch_dir):
+                path = os.path.join(batch_dir, name)
+                sizes[path] = os.path.getsize(path)
+                trace = []
+                try:
+                    with open(os.path.join(trace_dir, name)) as f:
+                        for l in f:
+                            if l.strip():
+                                trace.append(tuple_ids.setdefault(l.strip(), len(tuple_ids)))
+                except FileNotFoundError:
+                    pass
+                traces[path] = trace
+            shutil.rmtree(trace_dir, ignore_errors=True)
+            progress.update(len(futures[future]))
+
+    results = []
+    for path in greedy_cover(traces, sizes):
+        shutil.move(path, output)
+        results.append(os.path.join(output, os.path.basename(path)))
+    return results
+
 def sum(out_dir: str):
     def __sum(batch_results: list[list[str]]) -> list[str]:
         for batch_result in batch_results:
@@ -162,8 +252,10 @@ def process(benchmark, fuzzer, batch_size, file_list, root, output, progress: tq
 @clk.option('--move-instead-of-copy', '-m', is_flag=True, default=False)
 @clk.option('--last-run', '-l', is_flag=True, default=False)
 @clk.option('--more-excludes', '-e', type=str, default="")
+@clk.option('--single-pass', '-s', is_flag=True, default=False,
+            help='Trace every input once and minimize over the stored traces instead of running afl-cmin per batch')
 @watch(mailogger, report_ok=True)
-def main(shuffle, batch_size, id, input, output, iteration, first_run, move_instead_of_copy, last_run, more_excludes):
+def main(shuffle, batch_size, id, input, output, iteration, first_run, move_instead_of_copy, last_run, more_excludes, single_pass):
     logging.basicConfig(level=logging.INFO)
     if more_excludes:
         more_excludes = more_excludes.split(',')
@@ -223,7 +315,7 @@ def main(shuffle, batch_size, id, input, output, iteration, first_run, move_inst
                 tmp_in = seed_file_dir
                 seed_files = [os.path.join(tmp_in, f) for f in os.listdir(tmp_in) if not (f.startswith('record_') and f.endswith('.txt'))]
             in_num = len(seed_files)
-            if in_num < batch_size and not last_run:
+            if in_num < batch_size and not last_run and not single_pass:
                 for seed_file in seed_files:
                     shutil.move(seed_file, output_dir)
                 mailogger.log(f'{benchmark}_{fuzzer} skipped', f'{in_num} < {batch_size}')
@@ -234,11 +326,15 @@ def main(shuffle, batch_size, id, input, output, iteration, first_run, move_inst
             tmp_out = os.path.join(td, 'out_s')
             os.makedirs(tmp_out)
             with tqdm(total=in_num, desc=f'{benchmark}_{fuzzer}') as progress:
-                if last_run:
-                    actual_batch_size = in_num + 1
+                if single_pass:
+                    results = process_single_pass(benchmark, seed_files, td, tmp_out, progress, batch_size,
+                                                  move_instead_of_copy=first_run or move_instead_of_copy)
                 else:
-                    actual_batch_size = batch_size
-                results = process(benchmark, fuzzer, actual_batch_size, seed_files, td, tmp_out, progress, move_instead_of_copy=first_run or move_instead_of_copy)
+                    if last_run:
+                        actual_batch_size = in_num + 1
+                    else:
+                        actual_batch_size = batch_size
+                    results = process(benchmark, fuzzer, actual_batch_size, seed_files, td, tmp_out, progress, move_instead_of_copy=first_run or move_instead_of_copy)
             result_num = len(results)
             for f in results:
                 shutil.move(f, output_dir)
@@ -246,7 +342,7 @@ def main(shuffle, batch_size, id, input, output, iteration, first_run, move_inst
                           f'{in_num} -> {result_num}' +
                           f'\nargs: {benchmark=}, {fuzzer=}, {batch_size=}, {id=}, {iteration=}, {first_run=}, {shuffle=}, {output_dir=}' +
                           (f' {seed_file=}' if first_run else f' {seed_file_dir=}'))
-            if in_num - result_num < batch_size and not last_run:
+            if in_num - result_num < batch_size and not last_run and not single_pass:
                 mailogger.log(f'Warning: {benchmark}_{fuzzer} low reduction', f'{in_num=} - {result_num=} < {batch_size=}')
 
 if __name__ == '__main__':
@@ -8,6 +8,10 @@ import click as clk
 from tqdm import tqdm
 import sys
 
+# The metadata prefixes are shared with genoutputs and the fuzz drivers
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from prefixes import RandomReader, prefix_bytes
+
 BATCH_SIZE = 1000
 
 def process(file_list: list[str],
@@ -90,12 +94,13 @@ def process_one(benchmark, input_dir, output_dir):
     cwd = os.path.dirname(__file__)
 
     gen_seed = os.path.join(cwd, '..', 'binary', 'libxml2', 'genSeed')
+    rng = RandomReader()
     process_batches = {
-        'cpython3': __process_batch_prepend_data(lambda: b'\x02' + random.randbytes(1)),
-        're2': __process_batch_prepend_data(lambda: random.randbytes(2)),
-        'sqlite3': __process_batch_prepend_data(lambda: random.randbytes(1) + b'\n'),
+        'cpython3': __process_batch_prepend_data(lambda: prefix_bytes('cpython3', rng)),
+        're2': __process_batch_prepend_data(lambda: prefix_bytes('re2', rng)),
+        'sqlite3': __process_batch_prepend_data(lambda: prefix_bytes('sqlite3', rng)),
         'libxml2': __process_batch_libxml2(gen_seed),
-        'jsoncpp': __process_batch_prepend_data(lambda: random.randbytes(4)),
+        'jsoncpp': __process_batch_prepend_data(lambda: prefix_bytes('jsoncpp', rng)),
     }
 
     with tqdm(total=len(files)) as progress:
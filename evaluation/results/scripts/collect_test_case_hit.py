@@ -3,8 +3,8 @@ import os.path
 import subprocess
 import click as clk
 import tempfile
-from idontwannadoresearch.mapreduce import project, segment, accumulate, mapping
-import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import gzip
 from tqdm import tqdm
 import json
 import sys
@@ -17,80 +17,143 @@ COV_SRC = os.path.join(BIANRY_DIR, 'sqlite3_src.tar.xz')
 BLD_DIR_MAP_FILE = os.path.join(BIANRY_DIR, 'bld_src_map')
 TARBALL_ROOT = 'src/sqlite3'
 
-def clear_gcda(root):
+class HitIndex:
+    """Which inputs hit which source lines: file -> line -> input ids"""
+    def __init__(self) -> None:
+        self.inputs: list[str] = []
+        self.lines: dict[str, dict[int, set[int]]] = {}
+
+    def add(self, input: str, hits: dict[str, list[int]]) -> None:
+        input_id = len(self.inputs)
+        self.inputs.append(input)
+        for file, lines in hits.items():
+            file_lines = self.lines.setdefault(file, {})
+            for line in lines:
+                file_lines.setdefault(line, set()).add(input_id)
+
+    def inputs_hitting(self, file: str, line: int | None = None) -> list[str]:
+        """Inputs that hit the line, or any line of the file when line is
+        None. file may be given by its suffix (e.g. 'vacuum.c')."""
+        ids = set()
+        for f, file_lines in self.lines.items():
+            if f != file and not f.endswith('/' + file):
+                continue
+            if line is not None:
+                ids.update(file_lines.get(line, ()))
+            else:
+                for hit in file_lines.values():
+                    ids.update(hit)
+        return sorted(self.inputs[i] for i in ids)
+
+    def file_counts(self) -> dict[str, int]:
+        """Number of inputs that hit each file"""
+        return {f: len(set().union(*file_lines.values())) for f, file_lines in self.lines.items()}
+
+    def save(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump({
+                'inputs': self.inputs,
+                'lines': {
+                    file: {str(line): sorted(ids) for line, ids in file_lines.items()}
+                    for file, file_lines in self.lines.items()
+                },
+            }, f)
+
+    @staticmethod
+    def load(path: str) -> 'HitIndex':
+        with open(path, 'r') as f:
+            data = json.load(f)
+        index = HitIndex()
+        index.inputs = data['inputs']
+        index.lines = {
+            file: {int(line): set(ids) for line, ids in file_lines.items()}
+            for file, file_lines in data['lines'].items()
+        }
+        return index
+
+# Per-worker state: the source tree is extracted once per worker process and
+# reused for all of its batches
+_worker_dir: str | None = None
+_gcda_files: list[str] = []
+
+def init_worker(base_dir: str):
+    global _worker_dir
+    _worker_dir = tempfile.mkdtemp(dir=base_dir)
+    extract_cmd = [
+        'tar', '-xJf', COV_SRC, '-C', _worker_dir
+    ]
+    subprocess.run(extract_cmd, check=True, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+    os.makedirs(os.path.join(_worker_dir, 'gcov_out'))
+
+def find_gcda(root) -> list[str]:
+    result = []
     for root, dirs, files in os.walk(root):
         for f in files:
             if f.endswith('.gcda'):
-                os.remove(os.path.join(root, f))
-
-def process_one_batch(inputs: list[str]) -> dict[str, int]:
-    pattern2 = re.compile(r'Lines executed:(\d+\.\d+)% of \d+')
-    pattern1 = re.compile(r"File '(.*)'")
-    result = {}
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        extract_cmd = [
-            'tar', '-xJf', COV_SRC, '-C', tmp_dir
-        ]
-        subprocess.run(extract_cmd, check=True, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
-        
-        for input in inputs:
-            clear_gcda(tmp_dir)
-            run_cmd = [
-                COV_BIN, input
-            ]
-            to_inspects = []
-            subprocess.run(run_cmd, check=True, cwd=tmp_dir, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL, env={'GCOV_PREFIX': tmp_dir})
-            for root, dirs, files in os.walk(tmp_dir):
-                for f in files:
-                    if f.endswith('.gcda'):
-                        to_inspects.append(os.path.join(root, f))
-            for to_inspect in to_inspects:
-                gcov_cmd = [
-                    GCOV, os.path.join(TARBALL_ROOT, to_inspect)
-                ]
-                
-                r = subprocess.run(gcov_cmd, capture_output=True, text=True,
-                                    env={'GCOV_PREFIX': tmp_dir}, check=True, cwd=tmp_dir)
-                lines = r.stdout.split('\n')
-                current_file = None
-                for l in lines:
-                    m1 = pattern1.match(l)
-                    m2 = pattern2.match(l)
-                    if m1:
-                        current_file = m1.group(1)
-                    elif m2:
-                        assert current_file is not None
-                        if not current_file.startswith('/' + TARBALL_ROOT):
-                            continue
-                        cov = float(m2.group(1))
-                        if cov != 0.0:
-                            if current_file.endswith('vacuum.c'):
-                                print(f'vucuum.c: {input}')
-                            elif current_file.endswith('ctime.c'):
-                                print(f'ctime.c: {input}')
-                            elif current_file.endswith('vdbesort.c'):
-                                print(f'vdbesort.c: {input}')
-                            if current_file not in result:
-                                result[current_file] = 0
-                            result[current_file] += 1
-
+                result.append(os.path.join(root, f))
     return result
 
-def combine_batches(results: list[dict[str, int]]) -> dict[str, int]:
-    result = {}
-    for r in results:
-        for k, v in r.items():
-            if k not in result:
-                result[k] = 0
-            result[k] += v
-    return result
+def clear_gcda():
+    for f in _gcda_files:
+        try:
+            os.remove(f)
+        except FileNotFoundError:
+            pass
+
+def read_gcov_json(gcov_out: str) -> dict[str, list[int]]:
+    """Executed lines per source file in the tarball, from the JSON reports
+    of one gcov run"""
+    hits: dict[str, set[int]] = {}
+    for name in os.listdir(gcov_out):
+        if not name.endswith('.gcov.json.gz'):
+            continue
+        with gzip.open(os.path.join(gcov_out, name), 'rt') as f:
+            report = json.load(f)
+        for file in report['files']:
+            # Relative to the build directory when compiled that way
+            path = os.path.join(report.get('current_working_directory', ''), file['file'])
+            if not path.startswith('/' + TARBALL_ROOT):
+                continue
+            executed = [l['line_number'] for l in file['lines'] if l['count'] > 0]
+            if executed:
+                hits.setdefault(path, set()).update(executed)
+    return {f: sorted(lines) for f, lines in hits.items()}
+
+def process_one_batch(inputs: list[str]) -> list[tuple[str, dict[str, list[int]]]]:
+    global _gcda_files
+    assert _worker_dir is not None
+    gcov_out = os.path.join(_worker_dir, 'gcov_out')
+    results = []
+    for input in inputs:
+        clear_gcda()
+        run_cmd = [
+            COV_BIN, input
+        ]
+        subprocess.run(run_cmd, check=True, cwd=_worker_dir, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL, env={'GCOV_PREFIX': _worker_dir})
+        # The binary writes the same set of .gcda files on every run, so the
+        # tree is only searched for them after the first one
+        if not _gcda_files:
+            _gcda_files = find_gcda(_worker_dir)
+        for name in os.listdir(gcov_out):
+            os.remove(os.path.join(gcov_out, name))
+        # One gcov run for all the data files, with JSON reports
+        gcov_cmd = [
+            GCOV, '--json-format', '--preserve-paths', *_gcda_files
+        ]
+        subprocess.run(gcov_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       env={'GCOV_PREFIX': _worker_dir}, check=True, cwd=gcov_out)
+        results.append((input, read_gcov_json(gcov_out)))
+    return results
 
 @clk.command()
 @clk.option('--parallel', '-j', type=int, default=1)
 @clk.option('--input', '-i', type=clk.Path(exists=True))
 @clk.option('--output', '-o', type=str)
 @clk.option('--selected', '-s', type=clk.Path(exists=True), default=None)
-def main(parallel, input, output, selected):
+@clk.option('--index', '-x', type=str, default=None, help='Also save the file -> line -> inputs index here')
+@clk.option('--report', '-r', type=str, default='vacuum.c,ctime.c,vdbesort.c',
+            help='Comma-separated source files whose hitting inputs are printed')
+def main(parallel, input, output, selected, index, report):
     bld_dir_map = {}
     skip = set()
 
@@ -115,15 +178,23 @@ def main(parallel, input, output, selected):
             os.path.join(os.path.abspath(input), f) for f in os.listdir(input)
         ]
     
-    with tqdm(total=len(input_files)) as pbar:
-        results = (
-            project(input_files) >>
-            segment(len(input_files) // BATCH_SIZE) >>
-            mapping(process_one_batch, para_num=parallel, callback=lambda inputs, _future: pbar.update(len(inputs))) >> # type: ignore
-            accumulate(combine_batches)
-        ) # type: ignore
+    batches = [input_files[i:i + BATCH_SIZE] for i in range(0, len(input_files), BATCH_SIZE)]
+    hit_index = HitIndex()
+    with tqdm(total=len(input_files)) as pbar, \
+         tempfile.TemporaryDirectory() as base_dir, \
+         ProcessPoolExecutor(max_workers=parallel, initializer=init_worker, initargs=(base_dir,)) as executor:
+        futures = [executor.submit(process_one_batch, batch) for batch in batches]
+        for future in as_completed(futures):
+            for input_file, hits in future.result():
+                hit_index.add(input_file, hits)
+                pbar.update(1)
+    for file in filter(None, report.split(',')):
+        for input_file in hit_index.inputs_hitting(file):
+            print(f'{file}: {input_file}')
+    if index is not None:
+        hit_index.save(index)
     with clk.open_file(output, 'w') as f:
-        json.dump(results, f, indent=4)
+        json.dump(hit_index.file_counts(), f, indent=4)
 
 if __name__ == '__main__':
     main()
@@ -1,4 +1,6 @@
 from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+from typing import Iterable, Iterator
 from idontwannadoresearch import MailLogger, watch
 import logging
 
@@ -15,93 +17,79 @@ def read_cov(file) -> frozenset[str]:
     del result
     return r
 
-def cluster_cov(cov_files: list[str]) -> list[tuple[frozenset[str], list[str]]]:
-    clusters: list[tuple[frozenset[str], list[str]]] = []
-    for f in cov_files:
-        cov = read_cov(f)
-        found = False
-        for c_cov, c in clusters:
+def cov_digest(cov: frozenset[str]) -> str:
+    """Stable digest of an edge set (independent of set iteration order)"""
+    return hashlib.sha256('\n'.join(sorted(cov)).encode()).hexdigest()
+
+class ClusterMap:
+    """Files grouped by identical coverage. Clusters are looked up by the
+    digest of their edge set; edge sets are only compared when two
+    different ones share a digest."""
+    def __init__(self) -> None:
+        self.buckets: dict[str, list[tuple[frozenset[str], list[str]]]] = {}
+
+    def add(self, cov: frozenset[str], files: list[str], digest: str | None = None) -> None:
+        if digest is None:
+            digest = cov_digest(cov)
+        bucket = self.buckets.setdefault(digest, [])
+        for c_cov, c in bucket:
             if cov == c_cov:
-                c.append(f)
-                found = True
-                del cov
-                break
-        if not found:
-            clusters.append((cov, [f]))
-    return clusters
+                c.extend(files)
+                return
+        bucket.append((cov, files))
 
-class QuickSet:
-    def __init__(self, data: list[str]):
-        self.data = data
-        self.data.sort()
-    
-    def __eq__(self, other):
-        if len(self.data) != len(other.data):
-            return False
-        for a, b in zip(self.data, other.data):
-            if a != b:
-                return False
-        return True
+    def merge(self, other: 'ClusterMap') -> None:
+        for digest, bucket in other.buckets.items():
+            for cov, files in bucket:
+                self.add(cov, files, digest)
 
+    def clusters(self) -> Iterator[tuple[frozenset[str], list[str]]]:
+        for bucket in self.buckets.values():
+            yield from bucket
+
+    def __len__(self) -> int:
+        return sum(len(bucket) for bucket in self.buckets.values())
+
+def cluster_cov(cov_files: list[str]) -> ClusterMap:
+    clusters = ClusterMap()
+    for f in cov_files:
+        clusters.add(read_cov(f), [f])
+    return clusters
 
-def combine_clusters(clusters_list: list[list[tuple[frozenset[str], list[str]]]]) -> list[tuple[frozenset[str], list[str]]]:
-    result: list[tuple[frozenset[str], list[str]]] = []
+def combine_clusters(clusters_list: Iterable[ClusterMap]) -> ClusterMap:
+    result = ClusterMap()
     for clusters in clusters_list:
-        total = len(clusters) * len(result)
-        count = 0
-        for cov, files in clusters:
-            found = False
-            for c_cov, c in result:
-                count += 1
-                print(f'{count/total:.2f}')
-                if cov == c_cov:
-                    c.extend(files)
-                    found = True
-                    del cov
-                    break
-            if not found:
-                result.append((cov, files))
+        result.merge(clusters)
     return result
 
-def recursive_del(to_del: list[tuple[frozenset[str], list[str]]]):
-    for cov, files in to_del:
-        del cov
-        del files
-    del to_del
-    
-def one_big_batch(big_batch: list[str], parallel: int, output_file: str, prefix: str):
-    BATCH_SIZE = 20
-    with tqdm(total=len(big_batch)) as pbar:
-        result: list[tuple[frozenset[str], list[str]]] = (
-            project(big_batch) >>
-            segment(len(big_batch) // BATCH_SIZE) >>
-            mapping(cluster_cov, para_num=parallel, callback=lambda input, _future: pbar.update(len(input))) >> # type: ignore
-            accumulate(combine_clusters)
-        )
+def write_clusters(output_file: str, clusters: ClusterMap, prefix: str = '') -> None:
     with open(output_file, 'w') as f:
-        for cov, files in result:
-            trimmed = []
-            for ff in files:
-                trimmed.append(ff.removeprefix(prefix))
-            f.write(';'.join(cov) + '|' + ';'.join(trimmed) + '\n')
-
-def read_and_combine(files: list[str], output_file: str) -> tuple[int, str]:
-    cluster_list = []
-    for file in files:
-        with open(file, 'r') as f:
-            tmp = []
-            for l in f:
-                cov, file_list = l.split('|')
-                cov_s =frozenset(cov.split(';'))
-                file_s = file_list.split(';')
-                tmp.append((cov_s, file_s)) 
-        cluster_list.append(tmp)
-    combined = combine_clusters(cluster_list)
-    with open(output_file, 'w') as f:
-        for cov, files in combined:
-            f.write(';'.join(cov) + '|' + ';'.join(files) + '\n')
-    return len(combined), output_file
+        for cov, files in clusters.clusters():
+            trimmed = [ff.removeprefix(prefix) for ff in files]
+            f.write(';'.join(sorted(cov)) + '|' + ';'.join(trimmed) + '\n')
 
+def read_clusters(file: str) -> ClusterMap:
+    clusters = ClusterMap()
+    with open(file, 'r') as f:
+        for l in f:
+            cov, file_list = l.rstrip('\n').split('|')
+            clusters.add(frozenset(cov.split(';')), file_list.split(';'))
+    return clusters
+
+def one_big_batch(big_batch: list[str], parallel: int, output_file: str, prefix: str):
+    """Cluster one batch of coverage files, read by parallel workers in
+    chunks; partial maps are merged as they come in."""
+    BATCH_SIZE = 20
+    chunks = [big_batch[i:i + BATCH_SIZE] for i in range(0, len(big_batch), BATCH_SIZE)]
+    result = ClusterMap()
+    with tqdm(total=len(big_batch)) as pbar, \
+         ProcessPoolExecutor(max_workers=parallel) as executor:
+        futures = {executor.submit(cluster_cov, chunk): len(chunk) for chunk in chunks}
+        for future in as_completed(futures):
+            result.merge(future.result())
+            pbar.update(futures[future])
+    write_clusters(output_file, result, prefix)
+    return len(result)
 
 import click as clk
 @clk.command()
@@ -118,8 +106,6 @@ def main(input, output, parallel, cache):
     big_batches = []
     for i in range(0, len(files), BIGBATCH_SIZE):
         big_batches.append(files[i:i + BIGBATCH_SIZE])
-    residule = len(files) % BIGBATCH_SIZE
-    big_batches[-1].extend(files[-residule:])
     
     time_records = []
     # with ProcessPoolExecutor(max_workers=1) as executor:
@@ -141,45 +127,19 @@ def main(input, output, parallel, cache):
         rest = mean * (len(big_batches) - i)
         print(f'Finished big batch {i} / {len(big_batches)} ({already_elapsed/3600:.2f}h / {rest/3600:.2f}h)')
 
-    cluster_lists: list[str] = []
-    for i in range(len(big_batches)):
-        cluster_lists.append(os.path.join(cache, f'big_batch_{i}'))
-
-    CLUSTER_BATCH_SIZE = 2
-    epoch = 1
-    def update(pbar, num):
-        def __update(_f):
-            pbar.update(num)
-        return __update
-    while len(cluster_lists) > 1:
-        cluster_batches = []
-        for i in range(0, len(cluster_lists), CLUSTER_BATCH_SIZE):
-            cluster_batches.append(cluster_lists[i:i + CLUSTER_BATCH_SIZE])
-        residule = len(cluster_lists) % CLUSTER_BATCH_SIZE
-        cluster_batches[-1].extend(cluster_lists[-residule:])
-        with ProcessPoolExecutor(max_workers=parallel) as executor, \
-            tqdm(total=len(cluster_batches)) as pbar:
-                futures = []
-                merged = []
-                for i, cluster_batch in enumerate(cluster_batches):
-                    future = executor.submit(read_and_combine, cluster_batch, os.path.join(cache, f'cluster_batch_{epoch}_{i}'))
-                    future.add_done_callback(update(pbar, len(cluster_batch)))
-                    futures.append(future)
-                for future in as_completed(futures):
-                    r, m = future.result()
-                    merged.append(m)
-                    print(f'{m}: {r}')
-                print(f'After epoch {epoch}, {len(merged)} clusters')
-                cluster_lists = merged
-                epoch += 1
-                
-    print(f'Final result: {cluster_lists[0]}')
+    # Merging is linear in the number of clusters, so all partial maps are
+    # combined in one pass
+    result = ClusterMap()
+    for i in tqdm(range(len(big_batches)), desc='Merging'):
+        result.merge(read_clusters(os.path.join(cache, f'big_batch_{i}')))
+    for cov, files in result.clusters():
+        output.write(';'.join(sorted(cov)) + '|' + ';'.join(files) + '\n')
+    print(f'Final result: {len(result)} clusters')
 
 if __name__ == '__main__':
     from tqdm import tqdm
     import os
     import os.path
-    from idontwannadoresearch.mapreduce import project, segment, mapping, accumulate
     import tempfile
     import multiprocessing as mp
     import time
@@ -1,9 +1,11 @@
-import networkx as nx
 from typing import Collection, Sequence
 import sys
 import json
 import os
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..'))
+from covstore import load_coverage
+
 class CovSet:
     def __init__(self, edges: Collection[str]) -> None:
         self.edges = frozenset(edges)
@@ -21,43 +23,129 @@ class CovSet:
         return CovSet(self.edges.union(other.edges))
 
 class FuzzerSpace:
+    """Coverage sets ordered by inclusion, kept as a Hasse diagram (only the
+    covering relation, not every comparable pair). Edges are interned and
+    every set is stored as a bitset (an int); nodes are bucketed by
+    popcount, so only sets of smaller (larger) size are tested as subsets
+    (supersets) of a new element, and everything below (above) a cover that
+    was already found is skipped."""
     def __init__(self, init_element: CovSet | None = None, condense=False) -> None:
-        self.graph = nx.DiGraph()
-        self.cov_sets = set()
+        self.edge_index: dict[str, int] = {}
+        self.edge_names: list[str] = []
+        self.nodes: set[int] = set()
+        self.by_size: dict[int, list[int]] = {}
+        # Covering relation: up[a] are the minimal nodes strictly above a
+        self.up: dict[int, set[int]] = {}
+        self.down: dict[int, set[int]] = {}
         self.condense = condense
         self.init_element = init_element
         if init_element is not None:
-            self.graph.add_node(init_element)
-            self.cov_sets.add(init_element)
-    
+            self.add_element(init_element)
+
+    def to_bits(self, cov_set: CovSet) -> int:
+        bits = 0
+        for edge in cov_set.edges:
+            i = self.edge_index.get(edge)
+            if i is None:
+                i = len(self.edge_names)
+                self.edge_index[edge] = i
+                self.edge_names.append(edge)
+            bits |= 1 << i
+        return bits
+
+    def to_cov_set(self, bits: int) -> CovSet:
+        return CovSet(self.edge_names[i] for i in range(bits.bit_length()) if bits >> i & 1)
+
+    def _closure(self, start: int, rel: dict[int, set[int]], seen: set[int]) -> None:
+        stack = [start]
+        while stack:
+            n = stack.pop()
+            for m in rel[n]:
+                if m not in seen:
+                    seen.add(m)
+                    stack.append(m)
+
+    def _lower_covers(self, bits: int) -> set[int]:
+        """Maximal nodes strictly below bits"""
+        size = bits.bit_count()
+        covers: set[int] = set()
+        below_covers: set[int] = set()
+        for s in sorted((s for s in self.by_size if s < size), reverse=True):
+            for n in self.by_size[s]:
+                if n in below_covers or n & bits != n:
+                    continue
+                covers.add(n)
+                self._closure(n, self.down, below_covers)
+        return covers
+
+    def _upper_covers(self, bits: int) -> set[int]:
+        """Minimal nodes strictly above bits"""
+        size = bits.bit_count()
+        covers: set[int] = set()
+        above_covers: set[int] = set()
+        for s in sorted(s for s in self.by_size if s > size):
+            for n in self.by_size[s]:
+                if n in above_covers or n & bits != bits:
+                    continue
+                covers.add(n)
+                self._closure(n, self.up, above_covers)
+        return covers
+
+    def dominated(self, cov_set: CovSet) -> bool:
+        """Whether some node is a strict superset of cov_set"""
+        bits = self.to_bits(cov_set)
+        size = bits.bit_count()
+        return any(
+            n & bits == bits
+            for s, nodes in self.by_size.items() if s > size
+            for n in nodes
+        )
+
+    def dominates(self, a: CovSet, b: CovSet) -> bool:
+        """Whether a is a strict superset of b"""
+        a_bits, b_bits = self.to_bits(a), self.to_bits(b)
+        return a_bits != b_bits and a_bits & b_bits == b_bits
+
     def add_element(self, cov_set: CovSet):
         if self.init_element is None:
             self.init_element = cov_set
-            self.graph.add_node(cov_set)
-            self.cov_sets.add(cov_set)
+        bits = self.to_bits(cov_set)
+        if bits in self.nodes:
             return
-        if cov_set in self.cov_sets:
+        upper = self._upper_covers(bits)
+        if self.condense and upper:
             return
-        if not self.condense:
-            for node in self.cov_sets:
-                if cov_set < node:
-                    self.graph.add_edge(cov_set, node)
-                elif cov_set > node:
-                    self.graph.add_edge(node, cov_set)
-            self.cov_sets.add(cov_set)
-        else:
-            edges_to_add = set()
-            for node in self.cov_sets:
-                if cov_set < node:
-                    return
-                elif cov_set > node:
-                    edges_to_add.add((node, cov_set))
-            self.graph.add_edges_from(edges_to_add)
-            self.cov_sets.add(cov_set)
+        lower = self._lower_covers(bits)
+        # The new node sits between its covers, so direct edges between
+        # them are no longer covering ones
+        for l in lower:
+            for u in self.up[l] & upper:
+                self.up[l].discard(u)
+                self.down[u].discard(l)
+        self.up[bits] = upper
+        self.down[bits] = lower
+        for l in lower:
+            self.up[l].add(bits)
+        for u in upper:
+            self.down[u].add(bits)
+        self.nodes.add(bits)
+        self.by_size.setdefault(bits.bit_count(), []).append(bits)
+
     def __len__(self) -> int:
-        return len(self.cov_sets)
+        return len(self.nodes)
+
+    def __contains__(self, cov_set: CovSet) -> bool:
+        return self.to_bits(cov_set) in self.nodes
+
+    def hasse_edges(self) -> list[tuple[CovSet, CovSet]]:
+        return [(self.to_cov_set(l), self.to_cov_set(u)) for l, ups in self.up.items() for u in ups]
+
+    def maximal(self) -> list[CovSet]:
+        """Nodes not dominated by any other node"""
+        return [self.to_cov_set(n) for n, ups in self.up.items() if not ups]
+
     def maximum(self) -> CovSet:
-        return max(self.cov_sets, key=lambda x: len(x))
+        return self.to_cov_set(self.by_size[max(self.by_size)][0])
 
 START = 0
 END = 50
@@ -65,6 +153,17 @@ END = 50
 #     'jsoncpp': 'var_0158.infilled'
 # }
 
+def load_gen_coverage(gen_dir: str) -> dict[str, list[str]]:
+    """showmap-style coverage of each variant of the generation, from
+    logs/coverage.cov (or logs/coverage.json in older runs)"""
+    cov_path = os.path.join(gen_dir, 'logs', 'coverage.cov')
+    if not os.path.exists(cov_path):
+        cov_path = os.path.join(gen_dir, 'logs', 'coverage.json')
+    return {
+        variant: edges.to_showmap()
+        for variant, edges in load_coverage(cov_path)['CodeLlama-13b-hf'].items()
+    }
+
 def to_cov_set(cov_item: Sequence[str]) -> CovSet:
     s = set()
     for item in cov_item:
@@ -84,8 +183,7 @@ if __name__ == '__main__':
     cov_records = {}
     logtext = ''
     for i in range(START, END + 1):
-        with open(f'{dir}/gen{i}/logs/coverage.json') as cov_f:
-            json_cov = json.load(cov_f)['CodeLlama-13b-hf']
+        json_cov = load_gen_coverage(f'{dir}/gen{i}')
         
         max_cov = CovSet([])
         if len(cov_records) > 0:
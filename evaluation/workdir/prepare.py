@@ -139,6 +139,8 @@ def main(force, target, fuzzer):
     if os.path.exists(extra_scripts_dir):
         for f in os.listdir(extra_scripts_dir):
             shutil.copy(os.path.join(extra_scripts_dir, f), subdir)
+        # The callbacks take their metadata prefix from here
+        shutil.copy(os.path.join(eval_root, '..', 'prefixes.py'), subdir)
 
     match fuzzer:
         case 'elm' | 'elmalt' | 'elmnoinf' | 'elmnocomp' | 'elmnospl':
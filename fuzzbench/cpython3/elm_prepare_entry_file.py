@@ -2,6 +2,13 @@
 import sys
 
 entry_files = sys.argv[1].split(';')
+# target.harness and target.persistent_iterations, filled in by prepare_fuzzbench.py
+harness = sys.argv[2] if len(sys.argv) > 2 else 'oneshot'
+persistent_iterations = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+if harness == 'persistent':
+    main_begin, main_end = '//$persistent_main_begin$', '//$persistent_main_end$'
+else:
+    main_begin, main_end = '//$main_begin$', '//$main_end$'
 
 for f in entry_files:
     with open(f) as entry_file:
@@ -18,14 +25,16 @@ for f in entry_files:
         main_lines = []
         in_main = False
         for line in main_f:
-            if line.startswith('//$main_begin$'):
+            if line.startswith(main_begin):
                 in_main = True
-            elif line.startswith('//$main_end$'):
+            elif line.startswith(main_end):
                 in_main = False
             if in_main:
                 if line[-1] == '\n':
                     line = line[:-1]
                 main_lines.append(line)
+    if harness == 'persistent':
+        new_lines.append(f'#define ELM_PERSISTENT_ITERATIONS {persistent_iterations}')
     new_lines.extend(main_lines)
     with open(f, 'w') as entry_file:
         entry_file.write('\n'.join(new_lines))
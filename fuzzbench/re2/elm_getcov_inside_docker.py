@@ -41,7 +41,9 @@ def afl_fuzz_cov(fuzz_path, showmap_path, prog, input_dir, timeout):
 @click.option('-j', 'parallel_num', type=int, required=False, default=64)
 @click.option('--real-feedback', 'real_feedback', type=bool, default=False)
 @click.option('--afl-timeout', 'afl_timeout', type=int, default=-1)
-def main(prog: str, input: str, afl_path: str, output: str, parallel_num: int, real_feedback: bool, afl_timeout: int):
+@click.option('--prefixed', is_flag=True, default=False,
+              help='The inputs already carry the metadata prefix (written by the generator)')
+def main(prog: str, input: str, afl_path: str, output: str, parallel_num: int, real_feedback: bool, afl_timeout: int, prefixed: bool):
     if real_feedback:
         print('Using real feedbacks', flush=True)
     
@@ -60,11 +62,13 @@ def main(prog: str, input: str, afl_path: str, output: str, parallel_num: int, r
         for model, generator, gendir in worklist:
             input_files = os.listdir(gendir)
             
-            for input_file in input_files:
-                with open(f'{gendir}/{input_file}', 'rb') as tmpf:
-                    b = tmpf.read()
-                with open(f'{gendir}/{input_file}', 'wb') as tmpf:
-                    tmpf.write(random.randint(0, 0xFFFF).to_bytes(2, 'little', signed=False) + b) # Use random control flags of the fuzzer
+            # Add the metadata prefix unless the generator already wrote it
+            if not prefixed:
+                for input_file in input_files:
+                    with open(f'{gendir}/{input_file}', 'rb') as tmpf:
+                        b = tmpf.read()
+                    with open(f'{gendir}/{input_file}', 'wb') as tmpf:
+                        tmpf.write(random.randint(0, 0xFFFF).to_bytes(2, 'little', signed=False) + b) # Use random control flags of the fuzzer
             
             if not real_feedback:
                 future = executor.submit(afl_showmap_cov, f'{afl_path}/afl-showmap', prog, gendir)
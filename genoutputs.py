@@ -7,30 +7,20 @@ import glob
 import json
 import logging
 import os
+from pathlib import Path
 import re
 import shutil
 import subprocess
 import sys
-from typing import BinaryIO
-try:
-    # Not until 3.11
-    from hashlib import file_digest
-except ImportError:
-    def file_digest(f: BinaryIO):
-        import hashlib
-        BLOCKSIZE = 65536
-        hasher = hashlib.sha256()
-        buf = f.read(BLOCKSIZE)
-        while len(buf) > 0:
-            hasher.update(buf)
-            buf = f.read(BLOCKSIZE)
-        return hasher
 
 from drive_log import setup_custom_logger
-logger = setup_custom_logger('root')
+# The handler is only installed by main(), so that reading genoutputs'
+# options from another program doesn't change that program's logging
+logger = logging.getLogger('root')
 
 from tqdm import tqdm
 from driver import ExceptionInfo, Result, ResultInfo, GenResult
+from dedup import output_digests, write_manifest
 
 # Global color cycle with ANSI colors
 COLOR_GREEN = '\033[92m'
@@ -166,11 +156,7 @@ def generate_filestats(logfile):
             files = glob.glob(os.path.join(outdir, f'*{ext}'))
         except FileNotFoundError:
             return 0
-        unique_files = set([
-            file_digest(open(os.path.join(outdir, f), 'rb')).hexdigest()
-            for f in files
-        ])
-        return len(unique_files)
+        return len(set(output_digests(files)))
     def file_sizes(outdir, ext):
         try:
             return [
@@ -307,6 +293,48 @@ class filestats_action(argparse.Action):
 
         parser.exit()
 
+def driver_argv(actual_module_name, outdir, actual_logfile_name, input_seeds: str, args):
+    argv = [
+        '-n', str(args.driver.num_iterations),
+        '-o', outdir,
+        '-t', str(args.driver.timeout),
+        '-S', str(args.driver.size_limit),
+        '-M', str(args.driver.max_mem),
+        '-s', args.driver.output_suffix,
+        '-P', args.driver.metadata_prefix,
+        '-i', input_seeds,
+        actual_module_name, args.driver.function_name,
+    ]
+    if actual_logfile_name is not None:
+        argv[2:2] = ['-L', actual_logfile_name]
+    if args.driver.batch:
+        argv[:0] = ['--batch']
+    return argv
+
+def corpus_timeout(input_seeds: str, args):
+    input_seed_num = len(input_seeds.split(';'))
+    # Kill the process if 50% of the generation cannot finished in 0.5 timeout
+    return 0.5 * args.driver.timeout * input_seed_num * args.driver.num_iterations * 0.5
+
+def finish_corpus(gen_results, result, module_path, args):
+    if len(gen_results) == 1 and gen_results[0]['result_type'] == 'ImportError':
+        return gen_results
+
+    if len(gen_results) != args.driver.num_iterations:
+        if result is None:
+            result = Result(
+                error = None,
+                data = None,
+                module_path = module_path,
+                result_type = GenResult.UnknownErr,
+                function_name = args.driver.function_name,
+                args = args,
+            )
+        # Fill in the remaining entries with the error
+        for _ in range(args.driver.num_iterations - len(gen_results)):
+            gen_results.append(json.loads(result.json()))
+    return gen_results
+
 def generate_corpus(module_path, input_seeds: str, worker_dir, args):
     module_name = os.path.basename(module_path)
     # Copy the module to the output directory
@@ -317,24 +345,14 @@ def generate_corpus(module_path, input_seeds: str, worker_dir, args):
     logfile_name = f'logfile.json'
     actual_logfile_name = os.path.join(worker_dir, logfile_name)
     # if not args.driver.real_feedback:
-    cmd = [
-        'python', 'driver.py',
-        '-n', str(args.driver.num_iterations),
-        '-o', outdir,
-        '-L', actual_logfile_name,
-        '-t', str(args.driver.timeout),
-        '-S', str(args.driver.size_limit),
-        '-M', str(args.driver.max_mem),
-        '-s', args.driver.output_suffix,
-        '-i', input_seeds,
-        actual_module_name, args.driver.function_name,
-    ]
+    cmd = ['python', 'driver.py'] + driver_argv(
+        actual_module_name, outdir, actual_logfile_name, input_seeds, args,
+    )
     logger.debug(f"Running: {' '.join(cmd)}")
-    input_seed_num = len(input_seeds.split(';'))
     result = None
     try:
         # if not args.driver.real_feedback:
-        timeout = 0.5 * args.driver.timeout * input_seed_num * args.driver.num_iterations * 0.5 # Kill the process if 50% of the generation cannot finished in 0.5 timeout
+        timeout = corpus_timeout(input_seeds, args)
         subprocess.run(cmd, check=True, text=True, timeout=timeout, capture_output=True)
         # else:
         #     subprocess.run(cmd, check=True, text=True, capture_output=True, timeout=210)
@@ -377,23 +395,49 @@ def generate_corpus(module_path, input_seeds: str, worker_dir, args):
             function_name = args.driver.function_name,
             args = args,
         )
-    if len(gen_results) == 1 and gen_results[0]['result_type'] == 'ImportError':
-        return gen_results
+    write_manifest(worker_dir, gen_results)
+    return finish_corpus(gen_results, result, module_path, args)
 
-    if len(gen_results) != args.driver.num_iterations:
-        if result is None:
+def submit_corpus_warm(pool, module_path, input_seeds: str, worker_dir, args):
+    """Like generate_corpus, but runs the driver on a warm worker from pool
+    instead of a fresh `python driver.py`. Returns a future for the results."""
+    from warmpool import GenJob
+    module_name = os.path.basename(module_path)
+    copied_module_name = os.path.join(worker_dir, module_name)
+    shutil.copyfile(module_path, copied_module_name)
+    outdir = os.path.join(worker_dir, "output")
+    argv = driver_argv(copied_module_name, outdir, None, input_seeds, args)
+    # Every warm worker already runs in parallel with the others, so the
+    # job must not start a ProcessPoolExecutor of its own
+    if '--batch' not in argv:
+        argv[:0] = ['--batch']
+    job = GenJob(
+        argv=argv,
+        timeout=corpus_timeout(input_seeds, args),
+    )
+    def finalize(outcome):
+        try:
+            os.remove(copied_module_name)
+        except FileNotFoundError:
+            pass
+        result = None
+        if not outcome.timed_out and outcome.exit_status != 0:
             result = Result(
                 error = None,
-                data = None,
+                data = ResultInfo(
+                    time_taken=None,
+                    memory_used=None,
+                    stdout=None,
+                    stderr=outcome.stderr,
+                ),
                 module_path = module_path,
-                result_type = GenResult.UnknownErr,
+                result_type = GenResult.RunError,
                 function_name = args.driver.function_name,
                 args = args,
             )
-        # Fill in the remaining entries with the error
-        for _ in range(args.driver.num_iterations - len(gen_results)):
-            gen_results.append(json.loads(result.json()))
-    return gen_results
+        write_manifest(worker_dir, outcome.records)
+        return finish_corpus(list(outcome.records), result, module_path, args)
+    return pool.submit(job, finalize=finalize)
 
 import util
 from typing import Optional
@@ -416,6 +460,21 @@ def get_resample_iterations() -> int:
     assert isinstance(r, str)
     return int(r)
 
+def get_getcov_options():
+    """afl-showmap, the number of workers and the afl-showmap timeout (None
+    if unset), as configured for getcov.py."""
+    afl_dir = util.get_config('cli.getcov.afl_dir')
+    jobs = util.get_config('cli.getcov.jobs')
+    afl_timeout = util.get_config('cli.getcov.afl_timeout')
+    assert isinstance(afl_dir, str) and isinstance(jobs, str) and isinstance(afl_timeout, str)
+    timeout = int(afl_timeout) if afl_timeout not in ('', 'None') else None
+    return Path(afl_dir) / 'afl-showmap', int(jobs), timeout
+
+def dup_stats_path(coverage_path: str) -> str:
+    """Where the per-variant dedup stats (as from getcov.py --dup_stats) go
+    next to the coverage file"""
+    return os.path.splitext(coverage_path)[0] + '.dup_stats.json'
+
 def make_parser():
     parser = argparse.ArgumentParser(
         description='Create outputs using generated programs'
@@ -423,15 +482,26 @@ def make_parser():
     # Global options
     parser.add_argument(
         '-O', '--output-dir', type=str, default='.',
-        help='Output directory')
+        help='Output directory; {MODEL} is replaced by the name of the directory holding each module, '
+             'so that one run can take variants from several models')
     parser.add_argument(
         '-j', '--jobs', type=int, default=None,
         help='Maximum number of jobs to run in parallel; None means ncpu',
     )
     parser.add_argument('--raise-errors', action='store_true',
                         help="Don't catch exceptions in the main driver loop")
+    parser.add_argument('--warm-pool', action='store_true',
+                        help='Run generators on a pool of long-lived, pre-forked driver workers '
+                             'instead of one `python driver.py` per module')
     parser.add_argument('-L', '--logfile', type=str, default=None,
                         help='Log file for JSON results')
+    parser.add_argument('--coverage', type=str, default=None,
+                        help="Measure each module's outputs (as getcov.py would) as soon as they are "
+                             'generated, and write the coverage to this file (and the number of outputs and '
+                             'distinct outputs of each variant to the same name with .dup_stats.json)')
+    parser.add_argument('--delete-outputs', action='store_true',
+                        help="Delete each module's outputs once their coverage is measured "
+                             '(requires --coverage)')
     parser.add_argument('--stats-only', action=filestats_action,
                         default=argparse.SUPPRESS,
                         help='Only compute stats for the given log file')
@@ -459,6 +529,11 @@ def make_parser():
         '-s', '--driver.output-suffix', type=str, default='.gif',
         help='Suffix for output files',
     )
+    parser.add_argument(
+        '-P', '--driver.metadata_prefix', type=str, default='none',
+        help="Metadata prefix written before each output, as the target's entry point "
+             "expects (one of the schemes in prefixes.py)",
+    )
     parser.add_argument(
         '-g', '--generation', type=str, default='initial',
     )
@@ -466,6 +541,11 @@ def make_parser():
         '-n', '--driver.num_iterations', type=int, default=100,
         help='Number of times to run each function in each module (i.e., number of outputs to generate)',
     )
+    parser.add_argument(
+        '--driver.batch', action='store_true',
+        help='Run all outputs of a module in one reused process (per-run alarm, '
+             'respawn only after a crash or a memory leak)',
+    )
     # parser.add_argument(
     #     '--driver.real_feedback', default=False, action='store_true',
     # )
@@ -477,6 +557,7 @@ def init_parser(elm):
 def main():
     from idontwannadoresearch.txdm import txdm
     from elmconfig import ELMFuzzConfig
+    setup_custom_logger('root')
     parser = make_parser()
     config = ELMFuzzConfig(parents={'genoutputs': parser})
     init_parser(config)
@@ -544,8 +625,37 @@ def main():
     # if args.driver.real_feedback:
     #     print('INFO: Using real feedback', file=sys.stderr)
 
+    if args.warm_pool:
+        from warmpool import WarmWorkerPool
+        executor = WarmWorkerPool(args.jobs)
+        def submit(module_path, worker_dir):
+            return submit_corpus_warm(executor, module_path, input_seeds_str, worker_dir, args)
+    else:
+        executor = ProcessPoolExecutor(max_workers=args.jobs)
+        def submit(module_path, worker_dir):
+            return executor.submit(
+                generate_corpus,
+                module_path, input_seeds_str, worker_dir, args
+            )
+
+    collector = None
+    if args.coverage is not None:
+        from getcov import StreamingCoverage
+        showmap, cov_jobs, cov_timeout = get_getcov_options()
+        if not showmap.exists():
+            config.parser.error(f'afl-showmap not found at {showmap}')
+        if not args.target.covbin:
+            config.parser.error('Coverage binary not specified')
+        on_done = None
+        if args.delete_outputs:
+            on_done = lambda model, generator, gendir: shutil.rmtree(gendir, ignore_errors=True)
+        collector = StreamingCoverage(showmap, args.target.covbin.expanduser(), cov_jobs,
+                                      timeout=cov_timeout, on_done=on_done)
+    elif args.delete_outputs:
+        config.parser.error('--delete-outputs requires --coverage')
+
     # Call generate_all on each module in args.module_paths in parallel
-    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+    with executor:
         progress = (tqdm(total=module_count, desc="Generating", unit="mod")
                     if ON_NSF_ACCESS
                     else txdm(total=module_count, desc="Generating", unit="mod", file=sys.stdout))
@@ -554,13 +664,19 @@ def main():
             module_path = module_path.strip()
             # Make an output directory for this module's outputs
             module_base = os.path.splitext(os.path.basename(module_path))[0]
-            worker_dir = os.path.join(args.output_dir, module_base)
+            model_base = os.path.basename(os.path.dirname(os.path.abspath(module_path)))
+            worker_dir = os.path.join(args.output_dir.replace('{MODEL}', model_base), module_base)
             os.makedirs(worker_dir, exist_ok=True)
-            future = executor.submit(
-                generate_corpus,
-                module_path, input_seeds_str, worker_dir, args
-            )
+            future = submit(module_path, worker_dir)
             future.add_done_callback(lambda _: progress.update())
+            if collector is not None:
+                # Measure as soon as the module is done, while later ones
+                # are still being read and generated
+                future.add_done_callback(lambda _, worker_dir=worker_dir: collector.submit(
+                    os.path.basename(os.path.dirname(worker_dir)),
+                    os.path.basename(worker_dir),
+                    worker_dir,
+                ))
             futures_to_paths[future] = (module_path, worker_dir)
         for future in as_completed(futures_to_paths):
             module_path, worker_dir = futures_to_paths[future]
@@ -582,6 +698,12 @@ def main():
                 }), file=output_log)
         progress.close()
 
+    if collector is not None:
+        from covstore import save_coverage
+        save_coverage(args.coverage, collector.close())
+        with open(dup_stats_path(args.coverage), 'w') as f:
+            json.dump(collector.dup_stats, f)
+
     if output_log != sys.stdout:
         output_log.close()
 
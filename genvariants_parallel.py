@@ -3,10 +3,12 @@
 import json
 import random
 import os
-from typing import List, Optional, Dict
+from typing import Callable, List, NamedTuple, Optional, Dict
 from argparse import ArgumentParser
 import requests
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from elmconfig import StoreDictKeyPair
 
 def get_endpoints() -> Dict[str, str]:
     result = dict()
@@ -17,9 +19,11 @@ def get_endpoints() -> Dict[str, str]:
     return result
 
 
-def model_info():
+def model_info(endpoint=None):
     """Get information about the model."""
-    return requests.get(f'{ENDPOINT}/info').json()
+    if endpoint is None:
+        endpoint = ENDPOINT
+    return requests.get(f'{endpoint}/info').json()
 
 def generate_completion(
         prompt,
@@ -27,6 +31,7 @@ def generate_completion(
         max_new_tokens=1200,
         repetition_penalty=1.1,
         stop=None,
+        endpoint=None,
 ):
     """Generate a completion of the prompt."""
     data = {
@@ -41,7 +46,86 @@ def generate_completion(
     }
     if stop is not None:
         data['parameters']['stop'] = stop
-    return requests.post(f'{ENDPOINT}/generate', json=data).json()
+    if endpoint is None:
+        endpoint = ENDPOINT
+    return requests.post(f'{endpoint}/generate', json=data).json()
+
+def endpoint_list(endpoint: str) -> List[str]:
+    """A model's endpoint may list several TGI servers, separated by commas."""
+    return [e.strip() for e in endpoint.split(',') if e.strip()]
+
+# Transient statuses worth retrying (TGI answers 429 when its queue is full)
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class AsyncTGIClient:
+    """Keep-alive TGI client for asyncio. At most `window` requests are in
+    flight at once; each one goes to the endpoint with the fewest requests
+    outstanding and is retried with exponential backoff on failure."""
+    def __init__(self, endpoints: List[str], window: int = 64, retries: int = 3, backoff: float = 1.0):
+        self.endpoints = endpoints
+        self.window = window
+        self.retries = retries
+        self.backoff = backoff
+        self.in_flight = {e: 0 for e in endpoints}
+        self.session = None
+        self.semaphore = None
+
+    async def __aenter__(self):
+        import aiohttp
+        import asyncio
+        self.semaphore = asyncio.Semaphore(self.window)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.window, keepalive_timeout=300),
+            timeout=aiohttp.ClientTimeout(total=None),
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.session.close()
+
+    def _pick_endpoint(self) -> str:
+        return min(self.endpoints, key=lambda e: self.in_flight[e])
+
+    async def generate_completion(
+            self,
+            prompt,
+            temperature=0.2,
+            max_new_tokens=1200,
+            repetition_penalty=1.1,
+            stop=None,
+    ):
+        """Generate a completion of the prompt (see generate_completion)."""
+        import aiohttp
+        import asyncio
+        data = {
+            'inputs': prompt,
+            'parameters': {
+                'temperature': temperature,
+                'max_new_tokens': max_new_tokens,
+                'do_sample': True,
+                'repetition_penalty': repetition_penalty,
+                'details': True, # So we get the finish_reason
+            },
+        }
+        if stop is not None:
+            data['parameters']['stop'] = stop
+        res = None
+        async with self.semaphore:
+            for attempt in range(self.retries + 1):
+                if attempt > 0:
+                    await asyncio.sleep(self.backoff * 2**(attempt - 1) * (1 + random.random()))
+                endpoint = self._pick_endpoint()
+                self.in_flight[endpoint] += 1
+                try:
+                    async with self.session.post(f'{endpoint}/generate', json=data) as resp:
+                        res = await resp.json(content_type=None)
+                        if resp.status not in RETRY_STATUSES:
+                            return res
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    res = {'error': f'{type(e).__name__}: {e}', 'endpoint': endpoint}
+                finally:
+                    self.in_flight[endpoint] -= 1
+        return res
 
 def infilling_prompt_llama(
     pre: str,
@@ -74,6 +158,30 @@ def infilling_prompt_starcoder(
 
 infilling_prompt = None
 
+def pick_infilling_prompt(model: str):
+    """Get the infilling prompt formatter for a model ID, or None if the
+    model doesn't support FIM."""
+    if model == 'bigcode/starcoder':
+        return infilling_prompt_starcoder
+    elif model in ('codellama/CodeLlama-13b-hf',
+                   'codellama/CodeLlama-7b-hf'):
+        return infilling_prompt_llama
+    elif model.startswith('Qwen/Qwen2.5-Coder'):
+        return infilling_prompt_qwen
+    return None
+
+class ModelSpec(NamedTuple):
+    # Name as configured in model.names
+    name: str
+    # Model ID reported by the TGI server
+    model: str
+    endpoints: List[str]
+    infilling_prompt: Optional[Callable[[str, str], str]]
+    # Maximum number of requests in flight for this model
+    jobs: int
+    output_dir: str
+    log_dir: str
+
 def continue_completion(text: str) -> tuple[str, str]:
     text_lines = text.split('\n')
     # Pick a random line number to cut at
@@ -148,7 +256,20 @@ def new_base(filename: str) -> tuple[str, str]:
         base = base[:first]
         return base, ext
 
-def generate_variant(i, generators, model, filename, args):
+class VariantPrompt(NamedTuple):
+    generator: str
+    prompt: str
+    stop: List[str]
+    prefix: str
+    suffix: str
+    orig: str
+    base: str
+    base2: str
+    ext: str
+
+def prepare_variant(generators, filename, args, infilling_prompt=None) -> VariantPrompt:
+    if infilling_prompt is None:
+        infilling_prompt = globals()['infilling_prompt']
     # Pick a random generator
     generator = random.choice(generators)
     if generator == 'infilled':
@@ -185,20 +306,22 @@ def generate_variant(i, generators, model, filename, args):
         base2, _ = new_base(filename2)
     else:
         base2 = base
+    return VariantPrompt(generator, prompt, stop, prefix, suffix, orig, base, base2, ext)
+
+def write_variant(i, v: VariantPrompt, res, model, output_dir, log_dir):
+    generator = v.generator
+    prompt, stop = v.prompt, v.stop
+    prefix, suffix, orig = v.prefix, v.suffix, v.orig
+    base, base2 = v.base, v.base2
     # Count lines
     plines = prefix.count('\n')
     slines = suffix.count('\n')
     olines = orig.count('\n')
     # Output filenames
-    out_file = f'var_{i:04}.{generator}{ext}'
-    out_path = os.path.join(args.output_dir,out_file)
-    meta_file = os.path.join(args.log_dir, out_file + '.json')
+    out_file = f'var_{i:04}.{generator}{v.ext}'
+    out_path = os.path.join(output_dir,out_file)
+    meta_file = os.path.join(log_dir, out_file + '.json')
 
-    res = generate_completion(
-        prompt,
-        stop=stop,
-        **vars(args.gen),
-    )
     if 'generated_text' not in res:
         meta = {
             'model': model,
@@ -262,6 +385,45 @@ def generate_variant(i, generators, model, filename, args):
 
     return out_path
 
+def generate_variant(i, generators, spec: ModelSpec, filename, args):
+    v = prepare_variant(generators, filename, args, spec.infilling_prompt)
+    res = generate_completion(
+        v.prompt,
+        stop=v.stop,
+        endpoint=random.choice(spec.endpoints),
+        **vars(args.gen),
+    )
+    return write_variant(i, v, res, spec.model, spec.output_dir, spec.log_dir)
+
+async def generate_variant_async(client: AsyncTGIClient, i, generators, spec: ModelSpec, filename, args):
+    v = prepare_variant(generators, filename, args, spec.infilling_prompt)
+    res = await client.generate_completion(
+        v.prompt,
+        stop=v.stop,
+        **vars(args.gen),
+    )
+    return write_variant(i, v, res, spec.model, spec.output_dir, spec.log_dir)
+
+async def run_worklist_async(worklists, generators, args):
+    import asyncio
+    from contextlib import AsyncExitStack
+    async with AsyncExitStack() as stack:
+        tasks = []
+        # One client (and so one in-flight window) per model
+        for spec, worklist in worklists:
+            client = await stack.enter_async_context(
+                AsyncTGIClient(spec.endpoints, spec.jobs, args.retries, args.backoff)
+            )
+            tasks.extend(
+                asyncio.ensure_future(generate_variant_async(client, i, generators, spec, filename, args))
+                for i, filename in worklist
+            )
+        # Stream variants to genoutputs as soon as they are written
+        for task in asyncio.as_completed(tasks):
+            res = await task
+            if res is not None:
+                print(res, flush=True)
+
 def make_parser():
     parser = ArgumentParser(
         description='Use a code model to generate variants of a file.'
@@ -269,6 +431,13 @@ def make_parser():
     parser.add_argument('files', type=str, nargs='+')
     parser.add_argument('-M', '--model_name', type=str, default='codellama/CodeLlama-13b-hf',
                         help='Model to use for generation')
+    parser.add_argument('-A', '--all-models', action='store_true',
+                        help='Generate with every model in model.names at once; '
+                        '{MODEL} in the output and log directories is replaced by the model basename')
+    parser.add_argument('--model_jobs', type=str, nargs='+', action=StoreDictKeyPair,
+                        metavar='NAME:JOBS',
+                        help='Per-model limit on requests in flight, formatted as name:jobs '
+                        '(default: --window with --async, otherwise --jobs)')
     parser.add_argument('--no-completion', action='store_true',
                         help='Disable the completion mutator')
     parser.add_argument('--no-fim', action='store_true',
@@ -286,6 +455,14 @@ def make_parser():
                         'Allows specifying an immutable region not subject to mutation.')
     parser.add_argument('-j', '--jobs', type=int, default=16,
                         help='Number of inference jobs to run in parallel')
+    parser.add_argument('--async', dest='async_client', action='store_true',
+                        help='Use the asyncio keep-alive client instead of one thread per job')
+    parser.add_argument('-w', '--window', type=int, default=64,
+                        help='Maximum number of requests in flight with --async')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='Number of times to retry a failed request with --async')
+    parser.add_argument('--backoff', type=float, default=1.0,
+                        help='Initial retry backoff (in seconds) with --async; doubles on every retry')
     # Generation params
     parser.add_argument('-t', '--gen.temperature', type=float, default=0.2, help='Generation temperature')
     parser.add_argument('-m', '--gen.max-new-tokens', type=int, default=2048, help='Maximum number of tokens to generate')
@@ -305,32 +482,48 @@ def main():
     init_parser(config)
     args = config.parse_args()
 
-    try:
-        access_info = on_nsf_access()
-        ENDPOINT = args.model.endpoints[args.model_name] if access_info is None else access_info['endpoint']
-    except KeyError:
-        print(f'WARNING: no endpoint for model {args.model_name}, using default: {ENDPOINT}', file=sys.stderr)
-
-    info = model_info()
-    model = info['model_id']
-    if model != args.model_name:
-        print(f'WARNING: Expected model {args.model_name}, but {ENDPOINT} is actually {model}', file=sys.stderr)
-
-    if model == 'bigcode/starcoder':
-        infilling_prompt = infilling_prompt_starcoder
-    elif model in ('codellama/CodeLlama-13b-hf',
-                   'codellama/CodeLlama-7b-hf'):
-        infilling_prompt = infilling_prompt_llama
-    elif model.startswith('Qwen/Qwen2.5-Coder'):
-        infilling_prompt = infilling_prompt_qwen
-
-    if infilling_prompt is None and not args.no_fim:
-        config.parser.error(f'Model {model} does not support FIM')
     if args.no_completion and args.no_fim and args.no_splice:
         config.parser.error(f'Nothing to do')
 
-    os.makedirs(args.output_dir, exist_ok=True)
-    os.makedirs(args.log_dir, exist_ok=True)
+    model_names = args.model.names if args.all_models else [args.model_name]
+    access_info = on_nsf_access()
+    model_jobs = args.model_jobs or {}
+    specs = []
+    for model_name in model_names:
+        try:
+            endpoint = args.model.endpoints[model_name] if access_info is None else access_info['endpoint']
+        except KeyError:
+            print(f'WARNING: no endpoint for model {model_name}, using default: {ENDPOINT}', file=sys.stderr)
+            endpoint = ENDPOINT
+        endpoints = endpoint_list(endpoint)
+
+        info = model_info(endpoints[0])
+        model = info['model_id']
+        if model != model_name:
+            print(f'WARNING: Expected model {model_name}, but {endpoints[0]} is actually {model}', file=sys.stderr)
+
+        model_prompt = pick_infilling_prompt(model)
+        if model_prompt is None and not args.no_fim:
+            config.parser.error(f'Model {model} does not support FIM')
+
+        model_base = os.path.basename(model_name)
+        specs.append(ModelSpec(
+            name=model_name,
+            model=model,
+            endpoints=endpoints,
+            infilling_prompt=model_prompt,
+            jobs=int(model_jobs.get(model_name, args.window if args.async_client else args.jobs)),
+            output_dir=args.output_dir.replace('{MODEL}', model_base),
+            log_dir=args.log_dir.replace('{MODEL}', model_base),
+        ))
+    # Single-model runs keep using the module-level defaults
+    if len(specs) == 1:
+        ENDPOINT = specs[0].endpoints[0]
+        infilling_prompt = specs[0].infilling_prompt
+
+    for spec in specs:
+        os.makedirs(spec.output_dir, exist_ok=True)
+        os.makedirs(spec.log_dir, exist_ok=True)
 
     forbidden = os.environ.get('ELFUZZ_FORBIDDEN_MUTATORS', '').split(',')
     forbidden = [f.strip() for f in forbidden if f.strip()]
@@ -346,21 +539,31 @@ def main():
 
     # Print the number of variants we'll generate so that the next
     # stage (genoutputs) knows how many to expect.
-    print(len(args.files) * args.num_variants, flush=True)
-
-    worklist = []
-    i = 0
-    for _ in range(args.num_variants):
-        for filename in args.files:
-            worklist.append((i, filename))
-            i += 1
+    print(len(specs) * len(args.files) * args.num_variants, flush=True)
+
+    worklists = []
+    for spec in specs:
+        worklist = []
+        i = 0
+        for _ in range(args.num_variants):
+            for filename in args.files:
+                worklist.append((i, filename))
+                i += 1
+        worklists.append((spec, worklist))
+    if args.async_client:
+        import asyncio
+        asyncio.run(run_worklist_async(worklists, generators, args))
+        return
     # pbar = tqdm(total=len(worklist), desc='Generating', unit='variant')
-    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+    # One executor per model so that each model gets its own concurrency limit
+    with ExitStack() as stack:
         futures = []
-        for i, filename in worklist:
-            future = executor.submit(generate_variant, i, generators, model, filename, args)
-            # future.add_done_callback(lambda _: pbar.update())
-            futures.append(future)
+        for spec, worklist in worklists:
+            executor = stack.enter_context(ThreadPoolExecutor(max_workers=spec.jobs))
+            for i, filename in worklist:
+                future = executor.submit(generate_variant, i, generators, spec, filename, args)
+                # future.add_done_callback(lambda _: pbar.update())
+                futures.append(future)
         for future in as_completed(futures):
             res = future.result()
             if res is not None:
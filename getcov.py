@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 import json
 from pathlib import Path
 import subprocess
@@ -10,34 +10,209 @@ from tqdm import tqdm
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import glob
 import os
+import queue
+import shutil
+import sys
+import threading
+
+from covstore import EdgeSet, parse_showmap_line, save_coverage
+from dedup import output_digests
 
 AFL_DIR = '/usr/bin'
-# ./afl-showmap -q -i {} -o {/}.cov -C -- ./gifread @@
-def afl_cov(showmap_path, prog, input_dir):
-    with tempfile.NamedTemporaryFile() as f:
-        cov_file = f.name
-        cmd = [showmap_path, '-q', '-i', input_dir, '-o', cov_file, '-m', 'none', '-C', '--', prog, '@@']
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def showmap_inputs(showmap_path, prog, inputs, timeout=None, workdir=None):
+    """Run all inputs through prog with a single afl-showmap invocation, so a
+    single forkserver serves all of them. Yields (input index, [(edge, hits)])
+    for every input that produced a map."""
+    # afl-showmap -i skips symlinks, so the inputs are hard-linked (or copied
+    # if workdir is on another filesystem) into one directory, named by index
+    with tempfile.TemporaryDirectory(dir=workdir, prefix='.showmap-') as tmpdir:
+        in_dir = os.path.join(tmpdir, 'in')
+        out_dir = os.path.join(tmpdir, 'out')
+        os.mkdir(in_dir)
+        os.mkdir(out_dir)
+        for i, path in enumerate(inputs):
+            link_or_copy(path, os.path.join(in_dir, f'{i:08}'))
+        cmd = [showmap_path, '-q', '-i', in_dir, '-o', out_dir, '-m', 'none']
+        if timeout is not None:
+            cmd += ['-t', str(timeout)]
+        cmd += ['--', prog, '@@']
         subprocess.run(
             cmd,
             stdout=subprocess.DEVNULL,
             stderr=subprocess.DEVNULL,
             env={'AFL_QUIET': '1'},
         )
-        with open(cov_file, 'r') as f:
-            return set(l.strip() for l in f)
+        for name in os.listdir(out_dir):
+            with open(os.path.join(out_dir, name), 'r') as f:
+                yield int(name), [parse_showmap_line(l) for l in f if l.strip()]
+
+def variant_inputs(gendir):
+    return [
+        path for path in sorted(glob.glob(os.path.join(gendir, '*')))
+        if os.path.isfile(path)
+    ]
+
+def merge_hits(variant_hits, pairs):
+    """Fold (edge, hits) pairs into variant_hits, keeping the highest
+    hit-count bucket per edge."""
+    for edge, count in pairs:
+        if count > variant_hits.get(edge, 0):
+            variant_hits[edge] = count
+
+def afl_cov_payloads(showmap_path, prog, payloads, timeout=None, workdir=None):
+    """Run each (path, owners) payload once, all with a single afl-showmap
+    run, and fold its map into each owning variant. Returns
+    {variant: {edge: hits}}."""
+    hits = defaultdict(dict)
+    for i, pairs in showmap_inputs(showmap_path, prog, [path for path, _ in payloads], timeout, workdir):
+        for owner in payloads[i][1]:
+            merge_hits(hits[owner], pairs)
+    return hits
+
+def distinct_payloads(worklist):
+    """Group the outputs of all (model, generator, gendir) variants by content.
+    Returns [(path, owning variant indices)] with one entry per distinct
+    payload, and {model: {generator: {'files': n, 'unique': m}}}."""
+    owners = {}
+    dup_stats = {}
+    for idx, (model, generator, gendir) in enumerate(worklist):
+        files = variant_inputs(gendir)
+        digests = output_digests(files)
+        for path, digest in zip(files, digests):
+            if digest not in owners:
+                owners[digest] = (path, set())
+            owners[digest][1].add(idx)
+        dup_stats.setdefault(model, {})[generator] = {'files': len(files), 'unique': len(set(digests))}
+    return list(owners.values()), dup_stats
+
+class StreamingCoverage:
+    """Coverage of variant output directories handed in one at a time, e.g.
+    by genoutputs as each module finishes. Each of the jobs worker threads
+    takes whatever directories are pending (up to batch_size) and measures
+    them with one afl-showmap run. Payloads already measured in an earlier
+    batch reuse their cached map (up to cache_size of them).
+
+    on_done(model, generator, gendir), if given, is called once a
+    directory's coverage is recorded, e.g. to delete it."""
+    def __init__(self, showmap_path, prog, jobs, timeout=None, batch_size=64, cache_size=10000, on_done=None):
+        self.showmap_path = showmap_path
+        self.prog = prog
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.on_done = on_done
+        self.coverage = {}
+        self.dup_stats = {}
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._errors = []
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(max(jobs, 1))]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, model, generator, gendir):
+        self._queue.put((model, generator, gendir))
+
+    def _work(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                self._measure(batch)
+            except Exception as e:
+                self._errors.append(e)
+
+    def _cached(self, digest):
+        with self._lock:
+            pairs = self._cache.get(digest)
+            if pairs is not None:
+                self._cache.move_to_end(digest)
+            return pairs
+
+    def _remember(self, digest, pairs):
+        with self._lock:
+            self._cache[digest] = pairs
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _measure(self, batch):
+        hits = [dict() for _ in batch]
+        pending = {}
+        dup_stats = []
+        for idx, (_, _, gendir) in enumerate(batch):
+            files = variant_inputs(gendir)
+            digests = output_digests(files)
+            dup_stats.append({'files': len(files), 'unique': len(set(digests))})
+            for path, digest in zip(files, digests):
+                pairs = self._cached(digest)
+                if pairs is not None:
+                    merge_hits(hits[idx], pairs)
+                else:
+                    pending.setdefault(digest, (path, set()))[1].add(idx)
+        payloads = list(pending.items())
+        if payloads:
+            # Link next to the outputs so that hard links work
+            workdir = os.path.dirname(os.path.abspath(batch[0][2]))
+            inputs = [path for _, (path, _) in payloads]
+            for i, pairs in showmap_inputs(self.showmap_path, self.prog, inputs, self.timeout, workdir):
+                digest, (_, owners) = payloads[i]
+                self._remember(digest, pairs)
+                for owner in owners:
+                    merge_hits(hits[owner], pairs)
+        with self._lock:
+            for (model, generator, _), variant_hits, stats in zip(batch, hits, dup_stats):
+                self.coverage.setdefault(model, {})[generator] = EdgeSet.from_pairs(variant_hits.items())
+                self.dup_stats.setdefault(model, {})[generator] = stats
+        if self.on_done is not None:
+            for model, generator, gendir in batch:
+                self.on_done(model, generator, gendir)
+
+    def close(self):
+        """Wait for everything submitted so far; returns the coverage as
+        {model: {generator: EdgeSet}}."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        if self._errors:
+            raise self._errors[0]
+        return self.coverage
 
 def make_parser():
     parser = argparse.ArgumentParser(description="Get coverage for generated inputs")
     parser.add_argument('gendir', help='Base directory for generated inputs, structure: gendir/[model]/[generator]/[files]')
     parser.add_argument('-O', '--output', type=str, default='output.json',
-                        help='Output file where coverage will be written')
+                        help='Output file where coverage will be written (JSON if it ends in .json, '
+                        'otherwise the binary format from covstore.py)')
     parser.add_argument('-j', '--jobs', type=int, default=64,
-                        help='Number of parallel jobs')
+                        help='Number of parallel afl-showmap workers')
     parser.add_argument("--afl_dir", type=Path,
                         help="Path to AFL++ directory (for afl-showmap)",
                         default=Path(AFL_DIR))
     parser.add_argument('--real_feedback', default=False, action="store_true")
     parser.add_argument('--afl_timeout', type=int)
+    parser.add_argument('--dup_stats', type=str, default=None,
+                        help='Write the number of outputs and distinct outputs of each variant to this JSON file')
     return parser
 
 def init_parser(elm):
@@ -57,37 +232,41 @@ def main():
     covbin = args.target.covbin.expanduser()
     if not covbin:
         config.parser.error(f'Coverage binary not found at {args.target.covbin}')
-    combined_cov = {}
-    with ThreadPoolExecutor(max_workers=64) as executor:
-        worklist = []
-        for model in glob.glob(os.path.join(args.gendir, '*')):
-            for generator in glob.glob(os.path.join(model, '*')):
-                    worklist.append((
-                        os.path.basename(model),
-                        os.path.basename(generator),
-                        generator,
-                    ))
+    worklist = []
+    for model in glob.glob(os.path.join(args.gendir, '*')):
+        for generator in glob.glob(os.path.join(model, '*')):
+            worklist.append((
+                os.path.basename(model),
+                os.path.basename(generator),
+                generator,
+            ))
+    # Each distinct payload runs once, however many variants produced it
+    payloads, dup_stats = distinct_payloads(worklist)
+    total_files = sum(s['files'] for gens in dup_stats.values() for s in gens.values())
+    print(f'{total_files} outputs, {len(payloads)} distinct', file=sys.stderr)
+    # One afl-showmap (and so one forkserver) per job for the whole worklist
+    num_shards = max(min(args.jobs, len(payloads)), 1)
+    shards = [payloads[i::num_shards] for i in range(num_shards)]
+    hits = [dict() for _ in worklist]
+    progress = (tqdm(total=len(payloads), desc='Coverage')
+                if not ON_NSF_ACCESS else txdm(len(payloads), desc='Coverage'))
+    with ThreadPoolExecutor(max_workers=num_shards) as executor:
         futures = {}
-        progress = (tqdm(total=len(worklist), desc='Coverage')
-                    if not ON_NSF_ACCESS else txdm(len(worklist), desc='Coverage'))
-        for model, generator, gendir in worklist:
-            future = executor.submit(afl_cov, showmap, covbin, gendir)
-            futures[future] = (model, generator, gendir)
-            future.add_done_callback(lambda _: progress.update())
+        for shard in shards:
+            future = executor.submit(afl_cov_payloads, showmap, covbin, shard, args.afl_timeout, args.gendir)
+            futures[future] = shard
         for future in as_completed(futures):
-            model, generator, gendir = futures[future]
-            cov = future.result()
-            combined_cov[(model, generator)] = cov
-        progress.close()
-    # for (model, generator), cov in combined_cov.items():
-    #     print(f'{model:>20} {generator} {len(cov)}')
+            for idx, shard_hits in future.result().items():
+                merge_hits(hits[idx], shard_hits.items())
+            progress.update(len(futures[future]))
+    progress.close()
     cov_dict = {}
-    for (model, generator), cov in combined_cov.items():
-        if model not in cov_dict:
-            cov_dict[model] = {}
-        cov_dict[model][generator] = list(cov)
-    with open(args.output, 'w') as f:
-        json.dump(cov_dict, f)
+    for (model, generator, _), variant_hits in zip(worklist, hits):
+        cov_dict.setdefault(model, {})[generator] = EdgeSet.from_pairs(variant_hits.items())
+    if args.dup_stats is not None:
+        with open(args.dup_stats, 'w') as f:
+            json.dump(dup_stats, f)
+    save_coverage(args.output, cov_dict)
         
 ON_NSF_ACCESS = False
 
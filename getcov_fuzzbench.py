@@ -4,6 +4,8 @@ import shutil
 import sys
 import os.path
 from util import *
+from covstore import load_coverage, save_coverage
+from covdaemon import CovDaemonClient, fuzzdata_prefix
 import logging
 from idontwannadoresearch import MailLogger, watch
 
@@ -20,14 +22,40 @@ def on_nsf_access() -> dict[str, str] | None:
         'sif_root': sif_root,
     }
 
+def write_covfile(cov_json: str, covfile: str):
+    if covfile.endswith('.json'):
+        shutil.copy(cov_json, covfile)
+    else:
+        save_coverage(covfile, load_coverage(cov_json))
+
+def run_on_daemon(client: CovDaemonClient, input: str, covfile: str, prog: str,
+                  parallel_num: int, real_feedback: bool, afl_timeout: int, prefixed: bool):
+    # The outputs are read where they are when the daemon can see them;
+    # otherwise they are moved into its spool
+    staged = None
+    if not client.visible(input):
+        staged = tempfile.mkdtemp(dir=client.inputs_dir())
+        shutil.move(input, os.path.join(staged, 'input'))
+        input = os.path.join(staged, 'input')
+    try:
+        job_id = client.submit(input, prog, parallel_num, real_feedback, afl_timeout, prefixed)
+        for _, result in client.results([job_id]):
+            write_covfile(result, covfile)
+            os.remove(result)
+    finally:
+        if staged is not None:
+            shutil.rmtree(staged, ignore_errors=True)
+
 @click.command()
 @click.option('--image', type=str, required=True)
 @click.option('--input', type=str, required=True)
 @click.option('--persist/--no-persist', type=bool, default=False)
 @click.option('--covfile', type=str, default='./cov.json')
 @click.option('-j', 'parallel_num', type=int, default=64, required=False)
+@click.option('--daemon', type=str, envvar='ELMFUZZ_COVDAEMON', default=None,
+              help='Spool directory of a running coverage daemon (see covdaemon.py)')
 @watch(mailogger)
-def main(image: str, input: str, persist: bool, covfile: str, parallel_num: int):
+def main(image: str, input: str, persist: bool, covfile: str, parallel_num: int, daemon: str | None):
     covbin = get_config('target.covbin')
     if isinstance(covbin, list):
         covbin_str = ' '.join(covbin)
@@ -36,17 +64,17 @@ def main(image: str, input: str, persist: bool, covfile: str, parallel_num: int)
     access_info = on_nsf_access()
     real_feedback = get_config('cli.getcov.real_feedback') == 'true'
     afl_timeout = int(get_config('cli.getcov.afl_timeout'))
+    # The generator already wrote the metadata prefix
+    prefixed = get_config('cli.genoutputs.driver.metadata_prefix') != 'none'
     
-    cwd = os.path.dirname(os.path.abspath(__file__))
-    if access_info is not None:
-        prefix = os.path.join(cwd, 'tmp', 'fuzzdata') + '/'
-    elif bool(os.environ.get('REPROUDCE_MODE', 'false')):
-        prefix = '/tmp/host/fuzzdata/'
-    else:
-        prefix = '/tmp/fuzzdata/'
-    if not os.path.exists(prefix):
-        os.makedirs(prefix)
-    
+    if daemon:
+        client = CovDaemonClient(daemon)
+        if client.alive():
+            run_on_daemon(client, input, covfile, covbin_str, parallel_num, real_feedback, afl_timeout, prefixed)
+            return
+        logger.warning(f'Coverage daemon at {daemon} is not running; starting a container')
+
+    prefix = fuzzdata_prefix()
     with tempfile.TemporaryDirectory(prefix=prefix) as tmpdir:
         target_dir = os.path.join(tmpdir, 'input')
         shutil.move(input, target_dir)
@@ -60,7 +88,7 @@ def main(image: str, input: str, persist: bool, covfile: str, parallel_num: int)
             cmd.extend([
                 '-v', f'{tmpdir}:/tmp',
                 image,
-                f'/usr/bin/bash', '-c', f'python3 /src/elm_getcov_inside_docker.py --input /tmp/input --output /tmp/cov -j {parallel_num} --prog="{covbin_str}" --real-feedback {real_feedback} --afl-timeout={afl_timeout}'
+                f'/usr/bin/bash', '-c', f'python3 /src/elm_getcov_inside_docker.py --input /tmp/input --output /tmp/cov -j {parallel_num} --prog="{covbin_str}" --real-feedback {real_feedback} --afl-timeout={afl_timeout}' + (' --prefixed' if prefixed else '')
             ])
         else:
             cmd = [
@@ -68,11 +96,11 @@ def main(image: str, input: str, persist: bool, covfile: str, parallel_num: int)
                 '--cleanenv',
                 '--bind', f'{tmpdir}:/tmp:rw',
                 os.path.join(access_info['sif_root'], image),
-                '/usr/bin/bash', '-c', f'python3 /src/elm_getcov_inside_docker.py --input /tmp/input --output /tmp/cov -j {parallel_num} --prog="{covbin_str}" --real-feedback {real_feedback} --afl-timeout={afl_timeout}'
+                '/usr/bin/bash', '-c', f'python3 /src/elm_getcov_inside_docker.py --input /tmp/input --output /tmp/cov -j {parallel_num} --prog="{covbin_str}" --real-feedback {real_feedback} --afl-timeout={afl_timeout}' + (' --prefixed' if prefixed else '')
             ]
         print(' '.join(cmd))
         subprocess.run(cmd, check=True, stdout=sys.stdout, stderr=sys.stderr)
-        shutil.copy(f'{tmpdir}/cov', covfile)
+        write_covfile(f'{tmpdir}/cov', covfile)
     if os.path.exists(tmpdir):
         shutil.rmtree(tmpdir, ignore_errors=True)
 
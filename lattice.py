@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# Dominance and coverage selection over edge bitsets (see covstore.to_bits).
+# Variants are given as {key: (edge bitset, size)}; a variant dominates
+# another if its edge set is a strict superset.
+
+import heapq
+import sys
+from typing import Dict, Iterator, List, Set, Tuple
+
+import numpy as np
+
+from covstore import popcount
+
+Variants = Dict[str, Tuple[int, int]]
+
+# Narrow down candidate supersets by at most this many of the rarest edges,
+# or until this few candidates are left; the rest are tested directly
+_PIVOT_EDGES = 64
+_DIRECT_CHECK = 8
+
+def iter_bits(bits: int) -> Iterator[int]:
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+def dedup_by_edges(variants: Variants) -> Variants:
+    """Keep only the smallest variant among those with identical edge sets."""
+    best: Dict[int, Tuple[str, int]] = {}
+    for key, (edges, size) in variants.items():
+        if edges not in best or size < best[edges][1]:
+            best[edges] = (key, size)
+    return {key: (edges, size) for edges, (key, size) in best.items()}
+
+class SupersetIndex:
+    """Answers "is this set a strict subset of one of the others" for a fixed
+    family of distinct edge sets.
+
+    The family is sorted by decreasing popcount. For each edge there is a
+    column bitset (bit j set iff the j-th set has that edge), built on first
+    use. Candidates for a superset of S are then the larger sets, intersected
+    with the column of each edge of S, rarest edge first; that usually narrows
+    things down to a handful of sets within a few edges."""
+    def __init__(self, family: List[int]):
+        self.family = sorted(family, key=lambda edges: -popcount(edges))
+        self.counts = [popcount(edges) for edges in self.family]
+        n = len(self.family)
+        self.nbytes = max((edges.bit_length() + 7) // 8 for edges in self.family) if n else 0
+        rows = np.frombuffer(
+            b''.join(edges.to_bytes(self.nbytes, 'little') for edges in self.family), dtype=np.uint8
+        ).reshape(n, self.nbytes)
+        self._rows = rows
+        self._rows_t = np.ascontiguousarray(rows.T)
+        freq = np.zeros((self.nbytes, 8), dtype=np.int64)
+        for bit in range(8):
+            freq[:, bit] = ((rows >> bit) & 1).sum(axis=0)
+        self._rarest_first = np.argsort(freq.reshape(-1), kind='stable')
+        self._column_cache: Dict[int, int] = {}
+        # Sets 0 .. first_of_size[i] - 1 are strictly larger than set i
+        self._first_of_size = []
+        first = 0
+        for i in range(n):
+            if self.counts[i] != self.counts[first]:
+                first = i
+            self._first_of_size.append(first)
+
+    def _column(self, edge: int) -> int:
+        col = self._column_cache.get(edge)
+        if col is None:
+            col_bits = (self._rows_t[edge >> 3] >> (edge & 7)) & 1
+            col = int.from_bytes(np.packbits(col_bits, bitorder='little').tobytes(), 'little')
+            self._column_cache[edge] = col
+        return col
+
+    def is_dominated(self, i: int) -> bool:
+        """Whether the i-th set (in self.family order) has a strict superset."""
+        edges = self.family[i]
+        candidates = (1 << self._first_of_size[i]) - 1
+        if not candidates:
+            return False
+        own = np.unpackbits(self._rows[i], bitorder='little').view(bool)
+        pivots = self._rarest_first[np.flatnonzero(own[self._rarest_first])[:_PIVOT_EDGES]]
+        for edge in pivots.tolist():
+            candidates &= self._column(edge)
+            if popcount(candidates) <= _DIRECT_CHECK:
+                break
+        return any(edges | self.family[j] == self.family[j] for j in iter_bits(candidates))
+
+def maximal_elements(variants: Variants) -> Set[str]:
+    """Keys whose edge set is not a strict subset of another variant's. The
+    edge sets must be distinct (see dedup_by_edges)."""
+    by_edges = {edges: key for key, (edges, _) in variants.items()}
+    index = SupersetIndex(list(by_edges))
+    return {by_edges[edges] for i, edges in enumerate(index.family) if not index.is_dominated(i)}
+
+def greedy_cover(set_family: List[Tuple[str, int, int]], num: int, baseline: int = 0) -> List[Tuple[str, int, int]]:
+    """Pick num (key, edges, size) items that together cover as many edges
+    beyond baseline as possible, preferring smaller variants on ties."""
+    # Lazy greedy: marginal gains only shrink as coverage grows, so a heap
+    # entry is re-evaluated only when it reaches the top
+    covered = baseline
+    heap = [(-popcount(edges & ~baseline), size, key, i) for i, (key, edges, size) in enumerate(set_family)]
+    heapq.heapify(heap)
+    chosen: List[Tuple[str, int, int]] = []
+    while heap and len(chosen) < num:
+        neg_gain, size, key, i = heapq.heappop(heap)
+        gain = popcount(set_family[i][1] & ~covered)
+        if gain < -neg_gain:
+            heapq.heappush(heap, (-gain, size, key, i))
+            continue
+        chosen.append(set_family[i])
+        covered |= set_family[i][1]
+    max_size = max((size for _, _, size in chosen), default=0)
+    print(f'Greedy cover: {popcount(covered)} edges, max size {max_size}', file=sys.stderr)
+    return chosen
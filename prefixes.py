@@ -0,0 +1,62 @@
+# Metadata prefixes of test cases.
+#
+# Some targets' entry points read control bytes from the start of each input
+# before the payload (e.g. sqlite3 reads one flag byte and a newline). The
+# prefix is written by the generator's output writer, ahead of the payload:
+# driver.py does it for genoutputs (cli.genoutputs.driver.metadata_prefix),
+# and the evaluation drivers through their extra/<target>/callback.py. Each
+# scheme has the signature of those callbacks: it reads randomness from rng
+# and writes the prefix to out.
+
+import io
+import random
+from typing import BinaryIO, Callable
+
+PrefixScheme = Callable[[BinaryIO, BinaryIO], None]
+
+def none(rng: BinaryIO, out: BinaryIO):
+    pass
+
+def sqlite3(rng: BinaryIO, out: BinaryIO):
+    out.write(rng.read(1) + b'\n') # Use the random control flags of the fuzzer
+
+def sqlite3_sometimes(rng: BinaryIO, out: BinaryIO):
+    # Half of the inputs keep the fuzzer's default flags
+    if rng.read(1)[0] & 1:
+        sqlite3(rng, out)
+
+def cpython3(rng: BinaryIO, out: BinaryIO):
+    out.write(b'\x02' + rng.read(1))
+
+def cpython3_low(rng: BinaryIO, out: BinaryIO):
+    # Only the two lowest flag bits set
+    out.write(b'\x02' + bytes([rng.read(1)[0] & 0x3]))
+
+def re2(rng: BinaryIO, out: BinaryIO):
+    out.write(rng.read(2))
+
+def jsoncpp(rng: BinaryIO, out: BinaryIO):
+    out.write(rng.read(4))
+
+PREFIXES: dict[str, PrefixScheme] = {
+    'none': none,
+    'sqlite3': sqlite3,
+    'sqlite3_sometimes': sqlite3_sometimes,
+    'cpython3': cpython3,
+    'cpython3_low': cpython3_low,
+    're2': re2,
+    'jsoncpp': jsoncpp,
+}
+
+def prefix_bytes(name: str, rng: BinaryIO) -> bytes:
+    out = io.BytesIO()
+    PREFIXES[name](rng, out)
+    return out.getvalue()
+
+class RandomReader:
+    """rng for the schemes, backed by random.Random"""
+    def __init__(self, rand: random.Random | None = None) -> None:
+        self.rand = rand if rand is not None else random.Random()
+
+    def read(self, size: int) -> bytes:
+        return self.rand.randbytes(size)
@@ -40,6 +40,13 @@ def make_build_dir(fuzzbench_dir: str, patch_info: tuple[str, str, str] | None =
         template = template.replace('#$include_dockerfile$', original)
         template = template.replace('$__PROJECT_DIR', dirmap.project_dir)
         template = template.replace('$__ENTRY_FILE', dirmap.entry_file)
+        harness = get_config('target.harness')
+        if harness not in HARNESSES:
+            raise ValueError(f'Unknown harness {harness!r} (one of: {", ".join(HARNESSES)})')
+        if harness != 'oneshot' and '$__HARNESS' not in template:
+            raise ValueError(f'The {project_name} template does not support the {harness!r} harness')
+        template = template.replace('$__HARNESS', harness)
+        template = template.replace('$__PERSISTENT_ITERATIONS', get_config('target.persistent_iterations'))
         
         if ON_GLADE and patch_info is not None:
             template = template.replace(f'#$ON_GLADE$', '')
@@ -156,6 +163,9 @@ PATCHES = {
 
 ON_GLADE = False
 
+# Entry points elm_prepare_entry_file.py can splice in (see target.harness)
+HARNESSES = ['oneshot', 'persistent']
+
 @click.command()
 @click.option('--fuzzbench-dir', '-d', 'fuzzbench_dir', type=str, default='/home/appuser/fuzzbench')
 @click.option('--preset-type', '-t', 'preset_type', type=str, default='fuzzbench')
@@ -23,3 +23,42 @@ int main(int argc, char **argv) {
     return 0;
 }
 //$main_end$
+
+// Persistent mode (target.harness: persistent): initialization runs once,
+// before the deferred forkserver starts, and each forked process then runs
+// up to ELM_PERSISTENT_ITERATIONS inputs delivered through AFL's shared
+// memory before it is respawned. Outside AFL, argv[1] is run once.
+//$persistent_main_begin$
+#include <unistd.h>
+
+__AFL_FUZZ_INIT();
+
+int main(int argc, char **argv) {
+    LLVMFuzzerInitialize(0, 0);
+    // Only afl-fuzz delivers test cases in shared memory; every other AFL
+    // tool (e.g. afl-showmap with @@) passes a file
+    if (!getenv("__AFL_SHM_FUZZ_ID") && argc > 1) {
+        FILE *fp = fopen(argv[1], "rb");
+        if (!fp) {
+            return 1;
+        }
+        fseek(fp, 0, SEEK_END);
+        size_t size = ftell(fp);
+        fseek(fp, 0, SEEK_SET);
+        unsigned char *data = (unsigned char *) malloc(size);
+        fread(data, 1, size, fp);
+        fclose(fp);
+        LLVMFuzzerTestOneInput(data, size);
+        return 0;
+    }
+#ifdef __AFL_HAVE_MANUAL_CONTROL
+    __AFL_INIT();
+#endif
+    unsigned char *buf = __AFL_FUZZ_TESTCASE_BUF;
+    while (__AFL_LOOP(ELM_PERSISTENT_ITERATIONS)) {
+        int len = __AFL_FUZZ_TESTCASE_LEN;
+        LLVMFuzzerTestOneInput(buf, len);
+    }
+    return 0;
+}
+//$persistent_main_end$
@@ -1,14 +1,12 @@
-import subprocess
 from typing import Union
 
 def get_config(key: str) -> Union[str, list[str]]:
-    cmd = [
-        './elmconfig.py',
-        'get',
-        key
-    ]
-    p = subprocess.run(cmd, capture_output=True, check=True)
-    r = p.stdout.decode().strip()
+    # Same as `./elmconfig.py get key`, but resolved in-process; the config
+    # is parsed on the first call and cached for the rest of the process
+    # Only the program that owns the key is imported, since importing one
+    # can have side effects (genoutputs sets up logging, for one)
+    from elmconfig import get_value, owner_progs
+    r = get_value(key, progs=owner_progs(key)).strip()
     if r.count(' ') > 0:
         return r.split(' ')
     else:
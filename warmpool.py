@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+# A long-lived pool of pre-forked generator workers. Each worker already has
+# driver.py (and its imports) loaded, and accepts jobs of the form
+# (driver argv, hard timeout) over a pipe. For each job the worker forks a
+# fresh child that runs driver.run_generator() exactly as `python driver.py`
+# would, streaming Result records back as JSON lines. Forking from a warm
+# worker replaces interpreter startup + imports for every variant, while the
+# child still gets its own Sandbox, memory limit and module namespace.
+
+import json
+import multiprocessing
+import os
+import select
+import signal
+import sys
+import tempfile
+import threading
+import time
+import queue
+from concurrent.futures import Future
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+import driver
+
+class GenJob(NamedTuple):
+    # Arguments for driver.make_parser(), i.e. what would follow `python driver.py`
+    argv: List[str]
+    # Kill the job (and everything it spawned) after this many seconds
+    timeout: Optional[float] = None
+
+class JobOutcome(NamedTuple):
+    # One dict per Result record emitted by the job, in completion order
+    records: List[dict]
+    timed_out: bool
+    # Exit status of the job process (as returned by os.waitpid), None if killed
+    exit_status: Optional[int]
+    stderr: str
+
+def _run_job_child(argv: List[str], out_fd: int, err_file) -> None:
+    # Runs in the forked child; never returns
+    status = 0
+    try:
+        os.dup2(err_file.fileno(), 1)
+        os.dup2(err_file.fileno(), 2)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        args = driver.make_parser('Run an input generator function in a loop').parse_args(argv)
+        driver.set_loglevel(driver.logger, args)
+        with os.fdopen(out_fd, 'w') as out:
+            def emit(r: driver.Result):
+                out.write(r.json() + '\n')
+                out.flush()
+            driver.run_generator(args, emit)
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+def _run_job(job: GenJob, send: Callable[[tuple], None]) -> None:
+    r, w = os.pipe()
+    err_file = tempfile.TemporaryFile()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        # New process group so that a timeout also takes out the child's
+        # own batch process
+        os.setpgrp()
+        _run_job_child(job.argv, w, err_file)
+    os.close(w)
+    deadline = time.monotonic() + job.timeout if job.timeout is not None else None
+    timed_out = False
+    buf = b''
+    with os.fdopen(r, 'rb', buffering=0) as rf:
+        while True:
+            wait = None if deadline is None else deadline - time.monotonic()
+            if wait is not None and wait <= 0:
+                timed_out = True
+                break
+            ready, _, _ = select.select([rf], [], [], wait)
+            if not ready:
+                continue
+            chunk = rf.read(65536)
+            if not chunk:
+                break
+            buf += chunk
+            *lines, buf = buf.split(b'\n')
+            for line in lines:
+                if line.strip():
+                    send(('result', line.decode()))
+    if timed_out:
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        os.waitpid(pid, 0)
+        exit_status = None
+    else:
+        _, exit_status = os.waitpid(pid, 0)
+    err_file.seek(0)
+    stderr = err_file.read().decode(errors='replace')
+    err_file.close()
+    send(('done', timed_out, exit_status, stderr))
+
+def _worker_loop(conn) -> None:
+    # The pool owner handles Ctrl-C and tears us down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        _run_job(job, conn.send)
+    conn.close()
+
+class _Worker:
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        # Not a daemon: jobs fork their own batch processes
+        self.process = ctx.Process(target=_worker_loop, args=(child_conn,), daemon=False)
+        self.process.start()
+        child_conn.close()
+
+    def stop(self) -> None:
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+class WarmWorkerPool:
+    """Pool of warm driver workers; see the module comment."""
+    def __init__(self, num_workers: Optional[int] = None):
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        self._ctx = multiprocessing.get_context('fork')
+        self._jobs: queue.Queue = queue.Queue()
+        self._threads = []
+        for _ in range(num_workers):
+            t = threading.Thread(target=self._dispatch, daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self,
+               job: GenJob,
+               finalize: Optional[Callable[[JobOutcome], object]] = None,
+               on_record: Optional[Callable[[dict], None]] = None,
+               ) -> Future:
+        """Queue a job. The future resolves to finalize(outcome), or to the
+        JobOutcome itself if no finalize is given. on_record, if given, is
+        called for every Result record as soon as it arrives."""
+        future: Future = Future()
+        self._jobs.put((job, finalize, on_record, future))
+        return future
+
+    def _dispatch(self) -> None:
+        worker = _Worker(self._ctx)
+        try:
+            while True:
+                item = self._jobs.get()
+                if item is None:
+                    break
+                job, finalize, on_record, future = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    outcome, alive = self._run_on(worker, job, on_record)
+                    if not alive:
+                        # The worker itself died; replace it
+                        worker.stop()
+                        worker = _Worker(self._ctx)
+                    future.set_result(finalize(outcome) if finalize is not None else outcome)
+                except BaseException as e:
+                    future.set_exception(e)
+        finally:
+            worker.stop()
+
+    @staticmethod
+    def _run_on(worker: _Worker, job: GenJob, on_record) -> Tuple[JobOutcome, bool]:
+        records = []
+        try:
+            worker.conn.send(job)
+            while True:
+                msg = worker.conn.recv()
+                if msg[0] == 'result':
+                    record = json.loads(msg[1])
+                    records.append(record)
+                    if on_record is not None:
+                        on_record(record)
+                else:
+                    _, timed_out, exit_status, stderr = msg
+                    return JobOutcome(records, timed_out, exit_status, stderr), True
+        except (EOFError, BrokenPipeError, OSError):
+            return JobOutcome(records, False, None, 'warm worker exited unexpectedly'), False
+
+    def shutdown(self) -> None:
+        for _ in self._threads:
+            self._jobs.put(None)
+        for t in self._threads:
+            t.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()